@@ -7,11 +7,15 @@ import os
 import re
 import shutil
 import sqlite3
+import stat
 import subprocess
 import tarfile
 import tempfile
 import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timezone
 from pathlib import Path
 from zoneinfo import ZoneInfo
@@ -20,13 +24,31 @@ from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 
+from config_service import bump_config_version
 from extensions import db
-from models import BackupConfig, BackupRun, Image, MaintenanceState
+from folder_service import FOLDER_PATH_BACKFILL_SQL
+from metrics_service import record_run_stage
+from models import BackupConfig, BackupRun, DeferredDelete, Image, MaintenanceState
+from sqlite_service import dispose_engines
+from stats_service import view_counter
+from usage_service import USAGE_BACKFILL_SQL
+from utils import remove_upload_files
 
 
 IDENTITY_REMOTE_NAME = "fastimg-age-identity.json.enc"
 RECOVERY_KIT_NAME = "fastimg-recovery-kit.enc"
 BACKUP_PREFIX = "fastimg-backup"
+SNAPSHOT_PREFIX = "fastimg-snapshot"
+BACKUP_MODES = ("full", "incremental")
+PACK_DIR = "packs"
+PACK_SUFFIX = ".pack.age"
+REFS_DIR = "refs"
+# 单个 pack 的目标大小（未压缩），新文件按这个大小分组加密上传
+PACK_TARGET_BYTES = 128 * 1024 * 1024
+# build_manifest 中并行计算新文件 sha256 的线程数（hashlib 计算时会释放 GIL）
+HASH_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+# 备份占用上传文件超过这个时间仍未释放，视为进程已崩溃，下一次备份可以接管
+FILE_PIN_TIMEOUT = 6 * 3600
 AD = b"fastimg-backup-v1"
 _scheduler_started = False
 _scheduler_lock = threading.Lock()
@@ -174,6 +196,7 @@ def _clamp_percent(value):
 def set_run_progress(run, stage, percent=None, message=None, bytes_done=None, bytes_total=None):
     if not run:
         return
+    record_run_stage(run.id, 'restore' if run.trigger == 'restore' else 'backup', stage)
     run.progress_stage = stage
     if percent is not None:
         run.progress_percent = _clamp_percent(percent)
@@ -482,6 +505,11 @@ def update_backup_config(data):
         cfg.timezone = value
     if "retention_count" in data:
         cfg.retention_count = max(1, min(int(data.get("retention_count") or 7), 365))
+    if "backup_mode" in data:
+        value = (data.get("backup_mode") or "full").strip()
+        if value not in BACKUP_MODES:
+            raise BackupError("backup_mode must be one of: " + ", ".join(BACKUP_MODES))
+        cfg.backup_mode = value
     db.session.commit()
     return cfg
 
@@ -573,6 +601,61 @@ def current_maintenance():
     return state if state and state.active else None
 
 
+def pin_upload_files(owner):
+    """Mark upload files as being read by a backup. Must be called while the
+    maintenance lock is held, right after the file list is frozen."""
+    state = db.session.get(MaintenanceState, 1)
+    if state.pin_owner and state.pin_owner != owner and state.pinned_at:
+        pinned_at = state.pinned_at
+        if pinned_at.tzinfo is None:
+            pinned_at = pinned_at.replace(tzinfo=timezone.utc)
+        # 超时的占用视为上次备份进程已崩溃，直接接管
+        if (utcnow() - pinned_at).total_seconds() < FILE_PIN_TIMEOUT:
+            raise BackupError("Another backup is still packing upload files")
+    state.pin_owner = owner
+    state.pinned_at = utcnow()
+    db.session.commit()
+
+
+def upload_files_pinned():
+    state = db.session.get(MaintenanceState, 1)
+    return bool(state and state.pin_owner)
+
+
+def unpin_upload_files(app, owner):
+    state = db.session.get(MaintenanceState, 1)
+    if not state or state.pin_owner != owner:
+        return 0
+    state.pin_owner = None
+    state.pinned_at = None
+    db.session.commit()
+    return apply_deferred_deletes(app)
+
+
+def apply_deferred_deletes(app, batch_size=500):
+    """Remove upload files queued in deferred_delete (by a delete while a
+    backup was packing them, or by a bulk delete). Files that an image row
+    references again are kept. Works through the queue batch_size rows per
+    transaction and stops as soon as a backup pins the files again."""
+    removed = 0
+    while not upload_files_pinned():
+        rows = DeferredDelete.query.order_by(DeferredDelete.id.asc()).limit(batch_size).all()
+        if not rows:
+            break
+        names = {row.filename for row in rows}
+        live = {
+            filename for (filename,) in
+            db.session.query(Image.filename).filter(Image.filename.in_(names)).all()
+        }
+        for name in names - live:
+            remove_upload_files(name, app.config["UPLOAD_FOLDER"])
+            removed += 1
+        DeferredDelete.query.filter(DeferredDelete.id.in_([row.id for row in rows]))\
+            .delete(synchronize_session=False)
+        db.session.commit()
+    return removed
+
+
 def sha256_file(path):
     h = hashlib.sha256()
     with open(path, "rb") as f:
@@ -588,6 +671,20 @@ def sqlite_online_backup(src_db, dst_db):
     try:
         with dst:
             src.backup(dst)
+        # 在线库是 WAL 模式时副本会继承 WAL 标记，改回 DELETE 让副本是自包含的单个文件
+        dst.execute("PRAGMA journal_mode = DELETE")
+    finally:
+        dst.close()
+        src.close()
+
+
+def replace_sqlite_db(src_db, live_db):
+    """Overwrite live_db with the contents of src_db through the backup API,
+    so the live file keeps its journal mode and open connections stay valid."""
+    src = sqlite3.connect(src_db)
+    dst = sqlite3.connect(live_db, timeout=30)
+    try:
+        src.backup(dst)
     finally:
         dst.close()
         src.close()
@@ -604,6 +701,9 @@ def sanitize_snapshot_db(snapshot_db):
                 SET active = 0, mode = NULL, reason = NULL, owner = NULL, started_at = NULL
                 WHERE id = 1
             """)
+            cur.execute("PRAGMA table_info(maintenance_state)")
+            if "pin_owner" in {row[1] for row in cur.fetchall()}:
+                cur.execute("UPDATE maintenance_state SET pin_owner = NULL, pinned_at = NULL WHERE id = 1")
         cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='backup_run'")
         if cur.fetchone():
             cur.execute("""
@@ -642,26 +742,246 @@ def ensure_backup_run_progress_columns(db_path):
         conn.close()
 
 
-def build_manifest(app, snapshot_db):
+def ensure_image_stat_columns(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='image_stat'")
+        if not cur.fetchone():
+            return
+
+        cur.execute("PRAGMA table_info(image_stat)")
+        columns = {row[1] for row in cur.fetchall()}
+        additions = {
+            "day_date": "ALTER TABLE image_stat ADD COLUMN day_date VARCHAR(10)",
+            "day_count": "ALTER TABLE image_stat ADD COLUMN day_count INTEGER DEFAULT 0",
+        }
+        for column, statement in additions.items():
+            if column not in columns:
+                cur.execute(statement)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def ensure_maintenance_state_columns(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='maintenance_state'")
+        if not cur.fetchone():
+            return
+
+        cur.execute("PRAGMA table_info(maintenance_state)")
+        columns = {row[1] for row in cur.fetchall()}
+        additions = {
+            "pin_owner": "ALTER TABLE maintenance_state ADD COLUMN pin_owner VARCHAR(128)",
+            "pinned_at": "ALTER TABLE maintenance_state ADD COLUMN pinned_at DATETIME",
+        }
+        for column, statement in additions.items():
+            if column not in columns:
+                cur.execute(statement)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def ensure_backup_config_columns(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='backup_config'")
+        if not cur.fetchone():
+            return
+
+        cur.execute("PRAGMA table_info(backup_config)")
+        columns = {row[1] for row in cur.fetchall()}
+        if "backup_mode" not in columns:
+            cur.execute("ALTER TABLE backup_config ADD COLUMN backup_mode VARCHAR(16) DEFAULT 'full'")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def ensure_user_usage_columns(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='user'")
+        if not cur.fetchone():
+            return
+
+        cur.execute("PRAGMA table_info(user)")
+        columns = {row[1] for row in cur.fetchall()}
+        if "used_bytes" not in columns:
+            cur.execute("ALTER TABLE user ADD COLUMN used_bytes BIGINT NOT NULL DEFAULT 0")
+            cur.execute("ALTER TABLE user ADD COLUMN image_count INTEGER NOT NULL DEFAULT 0")
+            cur.execute(USAGE_BACKFILL_SQL)
+        if "purge_pending" not in columns:
+            cur.execute("ALTER TABLE user ADD COLUMN purge_pending BOOLEAN NOT NULL DEFAULT 0")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def ensure_folder_path_columns(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='folder'")
+        if not cur.fetchone():
+            return
+
+        cur.execute("PRAGMA table_info(folder)")
+        columns = {row[1] for row in cur.fetchall()}
+        if "path" not in columns:
+            cur.execute("ALTER TABLE folder ADD COLUMN path VARCHAR(512)")
+            cur.execute("ALTER TABLE folder ADD COLUMN name_path VARCHAR(1024)")
+            cur.execute(FOLDER_PATH_BACKFILL_SQL)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def ensure_image_variant_column(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='image'")
+        if not cur.fetchone():
+            return
+
+        cur.execute("PRAGMA table_info(image)")
+        columns = {row[1] for row in cur.fetchall()}
+        if "variants" not in columns:
+            cur.execute("ALTER TABLE image ADD COLUMN variants VARCHAR(32)")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def hash_cache_path(app):
+    return os.path.join(backup_config_dir(app), "hash-cache.db")
+
+
+class FileHashCache:
+    """Sidecar SQLite cache of upload digests keyed by (filename, size,
+    mtime_ns, inode). Lives next to the backup config rather than in the app
+    database so it is never snapshotted or replaced by a restore."""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS file_hash (
+                filename TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                sha256 TEXT NOT NULL
+            )
+        """)
+
+    def load(self):
+        rows = self.conn.execute("SELECT filename, size, mtime_ns, inode, sha256 FROM file_hash")
+        return {row[0]: (row[1], row[2], row[3], row[4]) for row in rows}
+
+    def replace(self, rows, keep):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO file_hash (filename, size, mtime_ns, inode, sha256) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            stale = [(name,) for name in self._filenames() if name not in keep]
+            self.conn.executemany("DELETE FROM file_hash WHERE filename = ?", stale)
+
+    def _filenames(self):
+        return [row[0] for row in self.conn.execute("SELECT filename FROM file_hash")]
+
+    def close(self):
+        self.conn.close()
+
+
+def hash_uploads(app, uploads_dir, stats):
+    """Return {filename: sha256} for the stat results in stats, re-hashing only
+    files whose (size, mtime_ns, inode) changed since the last run."""
+    cache = FileHashCache(hash_cache_path(app))
+    try:
+        known = cache.load()
+        digests = {}
+        todo = []
+        for filename, st in stats.items():
+            key = (st.st_size, st.st_mtime_ns, st.st_ino)
+            cached = known.get(filename)
+            if cached and cached[:3] == key:
+                digests[filename] = cached[3]
+            else:
+                todo.append(filename)
+
+        if todo:
+            workers = min(HASH_WORKERS, len(todo))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                paths = [os.path.join(uploads_dir, name) for name in todo]
+                for filename, digest in zip(todo, pool.map(sha256_file, paths)):
+                    digests[filename] = digest
+            rows = [
+                (name, stats[name].st_size, stats[name].st_mtime_ns, stats[name].st_ino, digests[name])
+                for name in todo
+            ]
+        else:
+            rows = []
+        cache.replace(rows, set(stats))
+        return digests
+    finally:
+        cache.close()
+
+
+def freeze_upload_list(app, snapshot_db):
+    """Stat every upload the snapshot database references. This is the only
+    filesystem work done under the maintenance lock; the returned
+    [(image_id, filename, stat_result)] is what the backup will pack."""
     uploads_dir = app.config["UPLOAD_FOLDER"]
-    images = Image.query.order_by(Image.id.asc()).all()
-    files = []
+    conn = sqlite3.connect(snapshot_db)
+    try:
+        rows = conn.execute("SELECT id, filename FROM image ORDER BY id ASC").fetchall()
+    finally:
+        conn.close()
+    frozen = []
     missing = []
-    for img in images:
-        path = os.path.join(uploads_dir, img.filename)
-        if not os.path.isfile(path):
-            missing.append(img.filename)
+    for image_id, filename in rows:
+        try:
+            st = os.stat(upload_file_path(uploads_dir, filename))
+        except FileNotFoundError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            missing.append(filename)
             continue
-        files.append({
-            "id": img.id,
-            "filename": img.filename,
-            "size": os.path.getsize(path),
-            "sha256": sha256_file(path),
-        })
+        frozen.append((image_id, filename, st))
     if missing:
         raise BackupError("Database references missing upload files: " + ", ".join(missing[:10]))
+    return frozen
+
+
+def build_manifest(app, snapshot_db, frozen):
+    uploads_dir = app.config["UPLOAD_FOLDER"]
+    stats = {filename: st for _, filename, st in frozen}
+    digests = hash_uploads(app, uploads_dir, stats)
+    files = []
+    first_by_digest = {}
+    for image_id, filename, _ in frozen:
+        item = {
+            "id": image_id,
+            "filename": filename,
+            "size": stats[filename].st_size,
+            "sha256": digests[filename],
+        }
+        # 内容相同的文件只打包一次，恢复时按 same_as 重新建立
+        if item["sha256"] in first_by_digest:
+            item["same_as"] = first_by_digest[item["sha256"]]
+        else:
+            first_by_digest[item["sha256"]] = filename
+        files.append(item)
     return {
-        "version": 1,
+        "version": 2,
         "created_at": utcnow().isoformat(),
         "app": "FastImg",
         "database": {
@@ -706,6 +1026,45 @@ def tar_zstd_age(app, cfg, source_dir, manifest, output_path, progress_callback=
     restore_info = os.path.join(source_dir, "README-RESTORE.txt")
     write_restore_info(restore_info)
 
+    total_items = max(1, len(manifest["uploads"]) + 4)
+    completed_items = 0
+    last_progress_at = 0
+
+    def bump_progress(message):
+        nonlocal completed_items, last_progress_at
+        completed_items += 1
+        if not progress_callback:
+            return
+        now = time.monotonic()
+        if now - last_progress_at >= 0.75 or completed_items >= total_items:
+            progress_callback(completed_items / total_items, message)
+            last_progress_at = now
+
+    with age_zstd_tar(cfg.encryption_recipient, output_path) as tar:
+        tar.add(os.path.join(source_dir, "data", "database.db"), arcname="data/database.db")
+        bump_progress("Packing database snapshot")
+        tar.add(manifest_path, arcname="manifest.json")
+        bump_progress("Packing backup manifest")
+        tar.add(env_path, arcname="config/fastimg-env.json")
+        bump_progress("Packing environment metadata")
+        tar.add(restore_info, arcname="README-RESTORE.txt")
+        bump_progress("Packing restore guide")
+        uploads_dir = app.config["UPLOAD_FOLDER"]
+        uploads_info = tarfile.TarInfo("uploads")
+        uploads_info.type = tarfile.DIRTYPE
+        uploads_info.mode = 0o755
+        tar.addfile(uploads_info)
+        for item in manifest["uploads"]:
+            # 增量快照只带索引，文件内容在 packs/ 里
+            if not item.get("same_as") and not item.get("pack"):
+                tar.add(os.path.join(uploads_dir, item["filename"]), arcname=f"uploads/{item['filename']}")
+            bump_progress("Compressing and encrypting uploads")
+
+
+@contextmanager
+def age_zstd_tar(recipient, output_path):
+    """Yield a streaming tar writer whose output is piped through zstd and
+    encrypted with age to output_path."""
     zstd = subprocess.Popen(
         ["zstd", "-T0", "-q", "-c"],
         stdin=subprocess.PIPE,
@@ -713,7 +1072,7 @@ def tar_zstd_age(app, cfg, source_dir, manifest, output_path, progress_callback=
         stderr=subprocess.PIPE,
     )
     age = subprocess.Popen(
-        ["age", "-r", cfg.encryption_recipient, "-o", output_path],
+        ["age", "-r", recipient, "-o", output_path],
         stdin=zstd.stdout,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
@@ -721,44 +1080,14 @@ def tar_zstd_age(app, cfg, source_dir, manifest, output_path, progress_callback=
     zstd.stdout.close()
 
     try:
-        total_items = max(1, len(manifest["uploads"]) + 4)
-        completed_items = 0
-        last_progress_at = 0
-
-        def bump_progress(message):
-            nonlocal completed_items, last_progress_at
-            completed_items += 1
-            if not progress_callback:
-                return
-            now = time.monotonic()
-            if now - last_progress_at >= 0.75 or completed_items >= total_items:
-                progress_callback(completed_items / total_items, message)
-                last_progress_at = now
-
         with tarfile.open(fileobj=zstd.stdin, mode="w|") as tar:
-            tar.add(os.path.join(source_dir, "data", "database.db"), arcname="data/database.db")
-            bump_progress("Packing database snapshot")
-            tar.add(manifest_path, arcname="manifest.json")
-            bump_progress("Packing backup manifest")
-            tar.add(env_path, arcname="config/fastimg-env.json")
-            bump_progress("Packing environment metadata")
-            tar.add(restore_info, arcname="README-RESTORE.txt")
-            bump_progress("Packing restore guide")
-            uploads_dir = app.config["UPLOAD_FOLDER"]
-            uploads_info = tarfile.TarInfo("uploads")
-            uploads_info.type = tarfile.DIRTYPE
-            uploads_info.mode = 0o755
-            tar.addfile(uploads_info)
-            for item in manifest["uploads"]:
-                tar.add(os.path.join(uploads_dir, item["filename"]), arcname=f"uploads/{item['filename']}")
-                bump_progress("Compressing and encrypting uploads")
+            yield tar
     finally:
         if zstd.stdin:
             zstd.stdin.close()
-
-    age_stdout, age_stderr = age.communicate()
-    zstd_stderr = zstd.stderr.read() if zstd.stderr else b""
-    zstd_rc = zstd.wait()
+        age_stdout, age_stderr = age.communicate()
+        zstd_stderr = zstd.stderr.read() if zstd.stderr else b""
+        zstd_rc = zstd.wait()
     if zstd_rc != 0:
         raise BackupError(zstd_stderr.decode("utf-8", errors="replace") or "zstd failed")
     if age.returncode != 0:
@@ -766,6 +1095,157 @@ def tar_zstd_age(app, cfg, source_dir, manifest, output_path, progress_callback=
         raise BackupError(detail or "age encryption failed")
 
 
+def incremental_index_path(app):
+    return os.path.join(backup_config_dir(app), "incremental-index.json")
+
+
+def load_incremental_index(app, cfg):
+    """Local map of digest -> remote pack. It never leaves this machine, so the
+    remote only ever sees opaque pack names."""
+    path = incremental_index_path(app)
+    index = None
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = None
+    if (
+        not isinstance(index, dict)
+        or index.get("remote_path") != cfg.remote_path
+        or index.get("recipient") != cfg.encryption_recipient
+    ):
+        index = {"remote_path": cfg.remote_path, "recipient": cfg.encryption_recipient, "objects": {}}
+    index.setdefault("objects", {})
+    return index
+
+
+def save_incremental_index(app, index):
+    path = incremental_index_path(app)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, path)
+
+
+def list_remote_files(app, remote_dir):
+    proc = run_cmd(["rclone", "lsf", remote_dir, "--files-only"], app=app, timeout=600)
+    return {line.strip() for line in proc.stdout.decode("utf-8", errors="replace").splitlines() if line.strip()}
+
+
+def plan_incremental_packs(manifest, known_objects):
+    """Mark every upload with the pack holding its bytes and return the groups
+    of (pack_name, items) that still have to be written. Digests already in a
+    remote pack are skipped."""
+    pending = []
+    for item in manifest["uploads"]:
+        if item.get("same_as"):
+            continue
+        pack = known_objects.get(item["sha256"])
+        if pack:
+            item["pack"] = pack
+        else:
+            pending.append(item)
+
+    groups = []
+    current = []
+    current_size = 0
+    for item in pending:
+        if current and current_size + item["size"] > PACK_TARGET_BYTES:
+            groups.append(current)
+            current = []
+            current_size = 0
+        current.append(item)
+        current_size += item["size"]
+    if current:
+        groups.append(current)
+
+    planned = []
+    for items in groups:
+        pack_name = f"{uuid.uuid4().hex}{PACK_SUFFIX}"
+        for item in items:
+            item["pack"] = pack_name
+        planned.append((pack_name, items))
+
+    manifest["mode"] = "incremental"
+    manifest["packs"] = sorted({item["pack"] for item in manifest["uploads"] if item.get("pack")})
+    return planned
+
+
+def write_pack(cfg, uploads_dir, items, output_path):
+    with age_zstd_tar(cfg.encryption_recipient, output_path) as tar:
+        for item in items:
+            tar.add(os.path.join(uploads_dir, item["filename"]), arcname=f"objects/{item['sha256']}")
+
+
+def _read_snapshot_refs(app, cfg, snapshot_name):
+    refs_remote = remote_join(remote_join(cfg.remote_path, REFS_DIR), f"{snapshot_name}.json")
+    proc = run_cmd(["rclone", "cat", refs_remote], app=app, timeout=120)
+    data = json.loads(proc.stdout.decode("utf-8"))
+    return set(data.get("packs") or [])
+
+
+def gc_incremental_packs(app, cfg, retained, removed):
+    """Delete packs that no retained snapshot references. Skipped entirely if
+    any retained snapshot's reference list cannot be read, since a pack must
+    never be dropped while a kept snapshot might still need it."""
+    refs_dir = remote_join(cfg.remote_path, REFS_DIR)
+    for name in removed:
+        try:
+            run_cmd(["rclone", "deletefile", remote_join(refs_dir, f"{name}.json")], app=app, timeout=120)
+        except BackupError:
+            pass
+
+    referenced = set()
+    for name in retained:
+        if not name.startswith(SNAPSHOT_PREFIX):
+            continue
+        try:
+            referenced |= _read_snapshot_refs(app, cfg, name)
+        except (BackupError, ValueError):
+            app.logger.warning("Skipping pack GC: cannot read references of %s", name)
+            return 0
+
+    packs_dir = remote_join(cfg.remote_path, PACK_DIR)
+    try:
+        existing = list_remote_files(app, packs_dir)
+    except BackupError:
+        return 0
+    orphaned = sorted(name for name in existing if name.endswith(PACK_SUFFIX) and name not in referenced)
+    for name in orphaned:
+        run_cmd(["rclone", "deletefile", remote_join(packs_dir, name)], app=app, timeout=120)
+
+    if orphaned:
+        index = load_incremental_index(app, cfg)
+        dropped = set(orphaned)
+        index["objects"] = {digest: pack for digest, pack in index["objects"].items() if pack not in dropped}
+        save_incremental_index(app, index)
+    return len(orphaned)
+
+
+def fetch_incremental_uploads(app, cfg, manifest, extract_dir, identity_path, progress_callback=None):
+    """Stream every pack an incremental snapshot references and lay the
+    objects out under extract_dir/uploads like a full backup. Returns the set
+    of filenames whose digest was verified while streaming."""
+    uploads_dir = os.path.join(extract_dir, "uploads")
+    os.makedirs(uploads_dir, exist_ok=True)
+    by_pack = {}
+    for item in manifest.get("uploads", []):
+        if item.get("pack") and not item.get("same_as"):
+            by_pack.setdefault(item["pack"], []).append(item)
+
+    packs_dir = remote_join(cfg.remote_path, PACK_DIR)
+    total = max(1, len(by_pack))
+    verified = set()
+    for done, (pack_name, items) in enumerate(sorted(by_pack.items()), start=1):
+        if os.path.basename(pack_name) != pack_name or not pack_name.endswith(PACK_SUFFIX):
+            raise BackupError(f"Unsafe pack name in manifest: {pack_name}")
+        verified |= stream_extract_pack(app, remote_join(packs_dir, pack_name), identity_path, uploads_dir, items)
+        if progress_callback:
+            progress_callback(done / total, f"Restoring packs ({done}/{total})")
+    return verified
+
+
 def create_backup_run(trigger="manual"):
     run = BackupRun(
         trigger=trigger,
@@ -804,7 +1284,24 @@ def execute_backup(app, run_id):
             run.status = "running"
             run.started_at = utcnow()
             set_run_progress(run, "preparing", 3, "Preparing backup")
-            acquire_maintenance("backup", "Creating encrypted backup snapshot", owner)
+            incremental = (cfg.backup_mode or "full") == "incremental"
+            known_objects = {}
+            index = None
+            new_packs = []
+            if incremental:
+                set_run_progress(run, "preparing", 5, "Reading remote pack store")
+                packs_remote = remote_join(cfg.remote_path, PACK_DIR)
+                run_cmd(["rclone", "mkdir", packs_remote], app=app, timeout=120)
+                remote_packs = list_remote_files(app, packs_remote)
+                index = load_incremental_index(app, cfg)
+                # 本地索引里指向已被清理的 pack 的条目作废，这些文件会重新打包
+                known_objects = {
+                    digest: pack for digest, pack in index["objects"].items()
+                    if pack in remote_packs
+                }
+                index["objects"] = dict(known_objects)
+
+            acquire_maintenance("backup", "Creating database snapshot", owner)
             encrypted_path = None
             try:
                 work_root = tempfile.mkdtemp(prefix="fastimg-backup-", dir=backup_work_dir(app))
@@ -816,21 +1313,45 @@ def execute_backup(app, run_id):
                 sqlite_online_backup(db_file, snapshot_db)
                 set_run_progress(run, "snapshot", 15, "Sanitizing snapshot")
                 sanitize_snapshot_db(snapshot_db)
+                frozen = freeze_upload_list(app, snapshot_db)
+                pin_upload_files(owner)
+            finally:
+                # 上传文件名是不可变的 UUID：锁只需覆盖数据库快照和文件列表，
+                # 之后的删除会延后到打包结束，新上传不在快照里
+                release_maintenance(owner)
+
+            try:
                 set_run_progress(run, "manifest", 22, "Building backup manifest")
-                manifest = build_manifest(app, snapshot_db)
+                manifest = build_manifest(app, snapshot_db, frozen)
 
                 stamp = datetime.now(ZoneInfo(cfg.timezone or "Asia/Shanghai")).strftime("%Y%m%d-%H%M%S")
-                name = f"{BACKUP_PREFIX}-{stamp}-{run_id}.age"
+                prefix = SNAPSHOT_PREFIX if incremental else BACKUP_PREFIX
+                name = f"{prefix}-{stamp}-{run_id}.age"
                 encrypted_path = os.path.join(work_root, name)
                 run.backup_name = name
 
+                index_start = 30
+                if incremental:
+                    new_packs = plan_incremental_packs(manifest, known_objects)
+                    local_packs = os.path.join(work_root, PACK_DIR)
+                    os.makedirs(local_packs, exist_ok=True)
+                    for done, (pack_name, items) in enumerate(new_packs, start=1):
+                        set_run_progress(
+                            run,
+                            "encrypting",
+                            30 + (done - 1) * 20 / len(new_packs),
+                            f"Encrypting new pack {done}/{len(new_packs)} ({len(items)} files)",
+                        )
+                        write_pack(cfg, app.config["UPLOAD_FOLDER"], items, os.path.join(local_packs, pack_name))
+                    index_start = 50
+
                 def pack_progress(fraction, message):
-                    set_run_progress(run, "encrypting", 30 + (fraction * 25), message)
+                    set_run_progress(run, "encrypting", index_start + (fraction * (55 - index_start)), message)
 
-                set_run_progress(run, "encrypting", 30, "Compressing and encrypting backup")
+                set_run_progress(run, "encrypting", index_start, "Compressing and encrypting backup")
                 tar_zstd_age(app, cfg, source_dir, manifest, encrypted_path, progress_callback=pack_progress)
             finally:
-                release_maintenance(owner)
+                unpin_upload_files(app, owner)
 
             encrypted_sha = sha256_file(encrypted_path)
             encrypted_size = os.path.getsize(encrypted_path)
@@ -843,17 +1364,43 @@ def execute_backup(app, run_id):
             _upload_identity_if_possible(app, cfg)
             set_run_progress(run, "creating_remote_dir", 59, "Preparing remote directory")
             run_cmd(["rclone", "mkdir", cfg.remote_path], app=app, timeout=120)
+            upload_start = 60
+            if new_packs:
+                local_packs = os.path.join(work_root, PACK_DIR)
+                packs_size = sum(os.path.getsize(os.path.join(local_packs, pack_name)) for pack_name, _ in new_packs)
+                rclone_copyto_with_progress(
+                    app,
+                    local_packs,
+                    remote_join(cfg.remote_path, PACK_DIR),
+                    run,
+                    "uploading_packs",
+                    60,
+                    88,
+                    total_bytes=packs_size,
+                    timeout=6 * 3600,
+                )
+                for pack_name, items in new_packs:
+                    for item in items:
+                        index["objects"][item["sha256"]] = pack_name
+                run.size_bytes = encrypted_size + packs_size
+                upload_start = 88
+            if incremental:
+                save_incremental_index(app, index)
             rclone_copyto_with_progress(
                 app,
                 encrypted_path,
                 remote_dest,
                 run,
                 "uploading_backup",
-                60,
+                upload_start,
                 94,
                 total_bytes=encrypted_size,
                 timeout=3600,
             )
+            if incremental:
+                refs = json.dumps({"snapshot": name, "packs": manifest["packs"]}).encode("utf-8")
+                refs_remote = remote_join(remote_join(cfg.remote_path, REFS_DIR), f"{name}.json")
+                run_cmd(["rclone", "rcat", refs_remote], app=app, input_data=refs, timeout=300)
             set_run_progress(run, "retention", 96, "Applying remote retention policy", bytes_done=encrypted_size, bytes_total=encrypted_size)
             apply_retention(app, cfg)
 
@@ -863,7 +1410,9 @@ def execute_backup(app, run_id):
             set_run_progress(run, "done", 100, "Encrypted backup uploaded successfully", bytes_done=encrypted_size, bytes_total=encrypted_size)
             shutil.rmtree(work_root, ignore_errors=True)
         except Exception as exc:
+            db.session.rollback()
             release_maintenance(owner)
+            unpin_upload_files(app, owner)
             if run:
                 run.status = "failed"
                 run.error = str(exc)
@@ -891,10 +1440,11 @@ def list_remote_backups(app, cfg=None, limit=None):
                 "name": name,
                 "size": item.get("Size"),
                 "mod_time": item.get("ModTime"),
-                "is_backup": name.startswith(BACKUP_PREFIX) and name.endswith(".age"),
+                "is_backup": is_backup_name(name),
+                "kind": "incremental" if name.startswith(SNAPSHOT_PREFIX) else "full",
                 "remote_path": remote_join(cfg.remote_path, name),
             })
-    result.sort(key=lambda x: x.get("name") or "", reverse=True)
+    result.sort(key=lambda x: backup_sort_key(x.get("name") or ""), reverse=True)
     if limit:
         keep = max(1, int(limit))
         backups = [item for item in result if item["is_backup"]]
@@ -903,12 +1453,30 @@ def list_remote_backups(app, cfg=None, limit=None):
     return result
 
 
+def is_backup_name(name):
+    return name.endswith(".age") and (name.startswith(BACKUP_PREFIX + "-") or name.startswith(SNAPSHOT_PREFIX + "-"))
+
+
+def backup_sort_key(name):
+    """Full backups and incremental snapshots share one timeline: order by the
+    timestamp after the prefix, not by the prefix itself."""
+    for prefix in (BACKUP_PREFIX, SNAPSHOT_PREFIX):
+        if name.startswith(prefix + "-"):
+            return name[len(prefix) + 1:]
+    return name
+
+
 def apply_retention(app, cfg):
     keep = max(1, cfg.retention_count or 7)
     backups = [b for b in list_remote_backups(app, cfg) if b["is_backup"]]
-    backups.sort(key=lambda x: x["name"], reverse=True)
+    backups.sort(key=lambda x: backup_sort_key(x["name"]), reverse=True)
+    removed = []
     for old in backups[keep:]:
         run_cmd(["rclone", "deletefile", old["remote_path"]], app=app, timeout=120)
+        removed.append(old["name"])
+    retained = [b["name"] for b in backups[:keep]]
+    if any(name.startswith(SNAPSHOT_PREFIX) for name in retained + removed):
+        gc_incremental_packs(app, cfg, retained, [name for name in removed if name.startswith(SNAPSHOT_PREFIX)])
 
 
 def test_remote(app):
@@ -921,32 +1489,189 @@ def test_remote(app):
     return proc.stdout.decode("utf-8", errors="replace")
 
 
-def safe_extract_tar(tar_path, dest):
+@contextmanager
+def open_remote_tar_stream(app, remote_src, identity_path):
+    """Yield a tarfile stream reader over `rclone cat | age -d | zstd -d`, so
+    nothing but the extracted files ever touches the disk."""
+    env = os.environ.copy()
+    rc_path = rclone_config_path(app)
+    if os.path.exists(rc_path):
+        env["RCLONE_CONFIG"] = rc_path
+
+    stages = []
+    killed = set()
+    errors = [tempfile.TemporaryFile() for _ in range(3)]
+
+    def stop_stages(grace):
+        for _, proc in stages:
+            try:
+                proc.wait(timeout=grace)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                killed.add(proc)
+                proc.wait()
+
+    def check_stages(failed_only):
+        for (label, proc), err in zip(stages, errors):
+            if proc in killed or proc.returncode == 0:
+                continue
+            # 我们提前关闭管道时上游会被 SIGPIPE 结束（负返回码），那不是它自己的错误
+            if failed_only and proc.returncode < 0:
+                continue
+            err.seek(0)
+            detail = err.read().decode("utf-8", errors="replace").strip() or f"exit code {proc.returncode}"
+            raise BackupError(f"Command failed: {label} {remote_src}\n{detail}")
+
+    try:
+        rclone = subprocess.Popen(["rclone", "cat", remote_src], stdout=subprocess.PIPE, stderr=errors[0], env=env)
+        stages.append(("rclone cat", rclone))
+        age = subprocess.Popen(["age", "-d", "-i", identity_path], stdin=rclone.stdout, stdout=subprocess.PIPE, stderr=errors[1])
+        stages.append(("age -d", age))
+        rclone.stdout.close()
+        zstd = subprocess.Popen(["zstd", "-d", "-q", "-c"], stdin=age.stdout, stdout=subprocess.PIPE, stderr=errors[2])
+        stages.append(("zstd -d", zstd))
+        age.stdout.close()
+
+        try:
+            with tarfile.open(fileobj=zstd.stdout, mode="r|") as tar:
+                yield tar
+            # 读完 tar 结束块后把剩余的填充数据读干净，让上游进程正常退出
+            while zstd.stdout.read(1024 * 1024):
+                pass
+        except BaseException as exc:
+            zstd.stdout.close()
+            stop_stages(5)
+            # 流读取出错时多半是上游命令先失败（身份不匹配、远端文件不存在），优先报告它
+            if not isinstance(exc, BackupError):
+                check_stages(failed_only=True)
+            raise
+        zstd.stdout.close()
+        stop_stages(60)
+        check_stages(failed_only=False)
+    finally:
+        for _, proc in stages:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        for err in errors:
+            err.close()
+
+
+def _stream_member_path(dest, member):
+    if not (member.isfile() or member.isdir()):
+        raise BackupError("Backup archive contains unsupported link entries")
     dest_real = os.path.realpath(dest)
-    with tarfile.open(tar_path, "r") as tar:
-        for member in tar.getmembers():
-            if member.issym() or member.islnk():
+    member_path = os.path.realpath(os.path.join(dest, member.name))
+    if not member_path.startswith(dest_real + os.sep) and member_path != dest_real:
+        raise BackupError("Unsafe path in backup archive")
+    return member_path
+
+
+def _write_stream_member(tar, member, path):
+    """Copy one regular file out of a tar stream, returning its sha256."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    h = hashlib.sha256()
+    source = tar.extractfile(member)
+    with open(path, "wb") as f:
+        for chunk in iter(lambda: source.read(1024 * 1024), b""):
+            h.update(chunk)
+            f.write(chunk)
+    return h.hexdigest()
+
+
+def stream_extract_backup(app, remote_src, identity_path, dest):
+    """Stream a backup package into dest. Upload files are checked against
+    the manifest (which is packed before them) as they are written. Returns
+    the set of upload filenames that were verified this way."""
+    expected = None
+    verified = set()
+    with open_remote_tar_stream(app, remote_src, identity_path) as tar:
+        for member in tar:
+            path = _stream_member_path(dest, member)
+            if member.isdir():
+                os.makedirs(path, exist_ok=True)
+                continue
+            digest = _write_stream_member(tar, member, path)
+            if member.name == "manifest.json":
+                with open(path, "r", encoding="utf-8") as f:
+                    manifest = json.load(f)
+                expected = {item["filename"]: item["sha256"] for item in manifest.get("uploads", [])}
+            elif expected is not None and member.name.startswith("uploads/"):
+                filename = member.name[len("uploads/"):]
+                if filename not in expected:
+                    raise BackupError(f"Backup contains upload not listed in manifest: {filename}")
+                if digest != expected[filename]:
+                    raise BackupError(f"Upload checksum mismatch: {filename}")
+                verified.add(filename)
+    return verified
+
+
+def stream_extract_pack(app, remote_src, identity_path, uploads_dir, items):
+    """Stream one incremental pack and write each object straight to the
+    upload filename that references it, verifying the digest on the way."""
+    targets = {item["sha256"]: item["filename"] for item in items}
+    written = set()
+    with open_remote_tar_stream(app, remote_src, identity_path) as tar:
+        for member in tar:
+            if member.isdir():
+                continue
+            if not member.isfile():
                 raise BackupError("Backup archive contains unsupported link entries")
-            member_path = os.path.realpath(os.path.join(dest, member.name))
-            if not member_path.startswith(dest_real + os.sep) and member_path != dest_real:
-                raise BackupError("Unsafe path in backup archive")
-        tar.extractall(dest)
+            digest_name = member.name[len("objects/"):] if member.name.startswith("objects/") else None
+            filename = targets.get(digest_name)
+            if filename is None:
+                continue
+            path = upload_file_path(uploads_dir, filename)
+            if _write_stream_member(tar, member, path) != digest_name:
+                raise BackupError(f"Upload checksum mismatch: {filename}")
+            written.add(filename)
+    missing = [name for name in targets.values() if name not in written]
+    if missing:
+        raise BackupError("Pack is missing objects for: " + ", ".join(missing[:10]))
+    return written
 
 
-def validate_extracted_backup(extract_dir):
+def materialize_duplicate_uploads(uploads_dir, manifest):
+    """Recreate uploads that were packed once per digest (manifest "same_as"),
+    as hard links where possible so restored duplicates keep sharing storage."""
+    for item in manifest.get("uploads", []):
+        source_name = item.get("same_as")
+        if not source_name:
+            continue
+        source = upload_file_path(uploads_dir, source_name)
+        dest = upload_file_path(uploads_dir, item["filename"])
+        if os.path.exists(dest) or not os.path.isfile(source):
+            continue
+        try:
+            os.link(source, dest)
+        except OSError:
+            shutil.copy2(source, dest)
+
+
+def read_extracted_manifest(extract_dir):
     manifest_path = os.path.join(extract_dir, "manifest.json")
     db_path = os.path.join(extract_dir, "data", "database.db")
-    uploads_dir = os.path.join(extract_dir, "uploads")
     if not os.path.isfile(manifest_path) or not os.path.isfile(db_path):
         raise BackupError("Backup package is missing manifest or database")
     with open(manifest_path, "r", encoding="utf-8") as f:
-        manifest = json.load(f)
+        return json.load(f)
+
+
+def validate_extracted_backup(extract_dir, verified=()):
+    """Check the extracted package against its manifest. Files in verified
+    were already hashed while streaming and are only checked for presence."""
+    db_path = os.path.join(extract_dir, "data", "database.db")
+    uploads_dir = os.path.join(extract_dir, "uploads")
+    manifest = read_extracted_manifest(extract_dir)
+    materialize_duplicate_uploads(uploads_dir, manifest)
     if sha256_file(db_path) != manifest["database"]["sha256"]:
         raise BackupError("Database checksum mismatch")
     for item in manifest.get("uploads", []):
         path = upload_file_path(uploads_dir, item["filename"])
         if not os.path.isfile(path):
             raise BackupError(f"Backup is missing upload file: {item['filename']}")
+        if item["filename"] in verified or item.get("same_as") in verified:
+            continue
         if sha256_file(path) != item["sha256"]:
             raise BackupError(f"Upload checksum mismatch: {item['filename']}")
 
@@ -989,10 +1714,12 @@ def start_restore_async(app, backup_name, password):
 
 
 def record_restore_result(app, backup_name, remote_path, status, message, error=None, started_at=None):
-    db.session.remove()
-    db.engine.dispose()
+    dispose_engines(app)
     db.create_all()
     ensure_backup_run_progress_columns(db_file_from_uri(app.config["SQLALCHEMY_DATABASE_URI"]))
+    ensure_image_stat_columns(db_file_from_uri(app.config["SQLALCHEMY_DATABASE_URI"]))
+    ensure_backup_config_columns(db_file_from_uri(app.config["SQLALCHEMY_DATABASE_URI"]))
+    ensure_maintenance_state_columns(db_file_from_uri(app.config["SQLALCHEMY_DATABASE_URI"]))
 
     run = BackupRun(
         trigger="restore",
@@ -1102,36 +1829,40 @@ def execute_restore(app, run_id, backup_name, password):
             set_run_progress(run, "preparing_restore", 5, "Preparing restore")
 
             work_root = tempfile.mkdtemp(prefix="fastimg-restore-", dir=backup_work_dir(app))
-            backup_age = os.path.join(work_root, backup_name)
             identity_path = os.path.join(work_root, "identity.txt")
-            tar_zst = os.path.join(work_root, "backup.tar.zst")
-            tar_path = os.path.join(work_root, "backup.tar")
             extract_dir = os.path.join(work_root, "extract")
             os.makedirs(extract_dir, exist_ok=True)
 
             set_run_progress(run, "downloading_identity", 15, "Downloading recovery identity")
             identity_blob = _download_identity_blob(app, cfg)
             identity = decrypt_secret(identity_blob, password)
-            with open(identity_path, "wb") as f:
+            fd = os.open(identity_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "wb") as f:
                 f.write(identity)
 
-            set_run_progress(run, "downloading_backup", 25, "Downloading encrypted backup")
-            run_cmd(["rclone", "copyto", run.remote_path, backup_age], app=app, timeout=3600)
-            set_run_progress(run, "decrypting", 55, "Decrypting backup package")
-            run_cmd(["age", "-d", "-i", identity_path, "-o", tar_zst, backup_age], app=app, timeout=3600)
-            set_run_progress(run, "decompressing", 68, "Decompressing backup package")
-            run_cmd(["zstd", "-d", "-f", tar_zst, "-o", tar_path], app=app, timeout=3600)
-            safe_extract_tar(tar_path, extract_dir)
+            set_run_progress(run, "downloading_backup", 25, "Downloading, decrypting and extracting backup")
+            verified = stream_extract_backup(app, run.remote_path, identity_path, extract_dir)
+            manifest = read_extracted_manifest(extract_dir)
+            if manifest.get("mode") == "incremental":
+                def pack_progress(fraction, message):
+                    set_run_progress(run, "downloading_packs", 55 + fraction * 20, message)
+
+                set_run_progress(run, "downloading_packs", 55, "Downloading referenced packs")
+                verified |= fetch_incremental_uploads(app, cfg, manifest, extract_dir, identity_path, pack_progress)
             set_run_progress(run, "validating", 78, "Validating backup package")
-            validate_extracted_backup(extract_dir)
+            validate_extracted_backup(extract_dir, verified)
 
             set_run_progress(run, "restoring", 88, "Restoring files and database")
+            if upload_files_pinned():
+                raise BackupError("A backup is still packing upload files; retry once it finishes")
             acquire_maintenance("restore", "Restoring encrypted backup", owner)
             try:
-                db.session.remove()
-                db.engine.dispose()
+                dispose_engines(app)
                 restore_into_app(app, extract_dir)
                 restored_db_applied = True
+                # 缓冲中的访问计数属于旧数据库，不能写进恢复后的库
+                view_counter.discard()
+                bump_config_version(app)
             finally:
                 if not restored_db_applied:
                     release_maintenance(owner)
@@ -1184,7 +1915,8 @@ def restore_into_app(app, extract_dir):
 
     rollback_db = os.path.join(rollback_data, "database.db")
     if os.path.exists(db_file):
-        shutil.copy2(db_file, rollback_db)
+        # 在线库可能处于 WAL 模式，直接复制主文件会丢掉尚未 checkpoint 的提交
+        sqlite_online_backup(db_file, rollback_db)
     if os.path.exists(uploads_dir):
         shutil.copytree(uploads_dir, rollback_uploads, dirs_exist_ok=True)
 
@@ -1198,13 +1930,21 @@ def restore_into_app(app, extract_dir):
             copy_directory_contents(restore_uploads, uploads_dir)
         validate_uploads_available_for_db(restore_db, uploads_dir)
 
-        shutil.copy2(restore_db, db_file)
-        ensure_backup_run_progress_columns(db_file)
-        sanitize_snapshot_db(db_file)
+        # 先在解包出来的副本上补列、清理，再通过 backup API 写进在线库：
+        # 覆盖文件会和残留的 -wal/-shm 以及其他 worker 的连接冲突
+        ensure_backup_run_progress_columns(restore_db)
+        ensure_image_stat_columns(restore_db)
+        ensure_backup_config_columns(restore_db)
+        ensure_user_usage_columns(restore_db)
+        ensure_folder_path_columns(restore_db)
+        ensure_image_variant_column(restore_db)
+        ensure_maintenance_state_columns(restore_db)
+        sanitize_snapshot_db(restore_db)
+        replace_sqlite_db(restore_db, db_file)
         validate_uploads_available_for_db(db_file, uploads_dir)
     except Exception:
         if os.path.exists(rollback_db):
-            shutil.copy2(rollback_db, db_file)
+            replace_sqlite_db(rollback_db, db_file)
         if os.path.exists(rollback_uploads):
             replace_directory_contents(rollback_uploads, uploads_dir)
         raise
@@ -0,0 +1,244 @@
+import json
+import threading
+from datetime import datetime, timezone
+
+from sqlalchemy import case, delete, exists, func, insert, literal, or_, select, update
+
+from backup_service import apply_deferred_deletes, current_maintenance
+from extensions import db
+from folder_service import subtree_condition
+from models import Blob, DeferredDelete, Folder, Image, ImageStat, User
+from storage_service import backfill_content_hashes
+from usage_service import adjust_usage
+
+
+# 每个事务最多删除这么多张图片；大批量删除分段提交，写锁每次只占用很短时间
+BULK_CHUNK_SIZE = 2000
+# 一次请求最多带多少个图片 id
+MAX_BULK_IDS = 5000
+
+
+def images_in_folder(user_id, folder, recursive=False):
+    """Condition for the images of user_id directly in folder (None = root),
+    or in its whole subtree when recursive."""
+    if folder is None:
+        if recursive:
+            return Image.user_id == user_id
+        return (Image.user_id == user_id) & Image.folder_id.is_(None)
+    if recursive:
+        subtree = select(Folder.id).where(Folder.user_id == user_id, subtree_condition(folder))
+        return (Image.user_id == user_id) & Image.folder_id.in_(subtree)
+    return (Image.user_id == user_id) & (Image.folder_id == folder.id)
+
+
+def _id_list(ids):
+    """ids as a one-column subquery over json_each, bound as a single JSON
+    parameter instead of one bind parameter per id."""
+    return select(func.json_each(json.dumps(ids)).table_valued('value').c.value)
+
+
+def _delete_chunk(ids):
+    """Delete the given image rows with set-based statements. Files are only
+    queued in deferred_delete; the reclaimer thread unlinks them later."""
+    id_list = _id_list(ids)
+    chosen = Image.id.in_(id_list)
+
+    usage = db.session.query(Image.user_id, func.coalesce(func.sum(Image.size), 0), func.count(Image.id))\
+        .filter(chosen).group_by(Image.user_id).all()
+    for user_id, size, count in usage:
+        if user_id is not None:
+            adjust_usage(user_id, -size, -count)
+
+    db.session.execute(
+        insert(DeferredDelete).from_select(
+            ['filename', 'created_at'],
+            select(Image.filename, literal(datetime.now(timezone.utc), DeferredDelete.created_at.type)).where(chosen),
+        )
+    )
+
+    # 引用计数按本批删除的张数扣减；若 blob 的链接源正好被删，换成剩下的任意一张
+    digests = [h for (h,) in db.session.query(Image.content_hash).filter(chosen, Image.content_hash.isnot(None)).distinct()]
+    if digests:
+        removed = select(func.count(Image.id))\
+            .where(chosen, Image.content_hash == Blob.digest).scalar_subquery()
+        survivor = select(Image.filename)\
+            .where(~chosen, Image.content_hash == Blob.digest)\
+            .order_by(Image.id).limit(1).scalar_subquery()
+        db.session.execute(
+            update(Blob)
+            .where(Blob.digest.in_(digests))
+            .values(
+                ref_count=func.coalesce(Blob.ref_count, 0) - removed,
+                filename=case(
+                    (Blob.filename.in_(select(Image.filename).where(chosen)), func.coalesce(survivor, Blob.filename)),
+                    else_=Blob.filename,
+                ),
+            )
+            .execution_options(synchronize_session=False)
+        )
+
+    db.session.execute(delete(ImageStat).where(ImageStat.image_id.in_(id_list)).execution_options(synchronize_session=False))
+    db.session.execute(delete(Image).where(chosen).execution_options(synchronize_session=False))
+    if digests:
+        db.session.execute(
+            delete(Blob)
+            .where(
+                Blob.digest.in_(digests),
+                or_(Blob.ref_count <= 0, ~exists().where(Image.content_hash == Blob.digest)),
+            )
+            .execution_options(synchronize_session=False)
+        )
+
+
+def delete_images(condition, chunk_size=BULK_CHUNK_SIZE):
+    """Delete every image matching condition, committing every chunk_size
+    rows. Returns the number of images deleted."""
+    deleted = 0
+    while True:
+        # 不加 ORDER BY：删掉的行不会再被选中，按索引顺序取前 chunk_size 个即可
+        ids = [i for (i,) in db.session.query(Image.id).filter(condition).limit(chunk_size)]
+        if not ids:
+            break
+        try:
+            _delete_chunk(ids)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        deleted += len(ids)
+    db.session.expire_all()
+    if deleted:
+        wake_file_reclaimer()
+    return deleted
+
+
+def delete_folder_tree(folder):
+    """Delete folder, its subfolders and every image below them."""
+    deleted = delete_images(images_in_folder(folder.user_id, folder, recursive=True))
+    db.session.execute(
+        delete(Folder)
+        .where(Folder.user_id == folder.user_id, subtree_condition(folder))
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    db.session.expire_all()
+    return deleted
+
+
+def delete_user_content(user_id):
+    """Delete all images and folders of a user (the user row is left to the caller)."""
+    deleted = delete_images(Image.user_id == user_id)
+    db.session.execute(delete(Folder).where(Folder.user_id == user_id).execution_options(synchronize_session=False))
+    db.session.commit()
+    return deleted
+
+
+def purge_user(user_id):
+    """Delete the content of a user marked purge_pending, then the user row."""
+    deleted = delete_user_content(user_id)
+    db.session.execute(
+        delete(User)
+        .where(User.id == user_id, User.purge_pending.is_(True))
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return deleted
+
+
+def move_images(condition, folder_id):
+    """Move every image matching condition into folder_id (None = root) with
+    one UPDATE, in the caller's transaction. Returns the number of images moved."""
+    result = db.session.execute(
+        update(Image)
+        .where(condition)
+        .values(folder_id=folder_id)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.expire_all()
+    return result.rowcount
+
+
+_reclaimer_lock = threading.Lock()
+_reclaimer_started = False
+_reclaimer_wakeup = threading.Event()
+_purge_lock = threading.Lock()
+_pending_purges = set()
+# 旧图片补摘要的进度（image id）；扫到末尾后从头再来，恢复进来的旧库也会被补上
+_hash_backfill_after = 0
+
+
+def wake_file_reclaimer():
+    """Ask this process's reclaimer thread to drain its queues now."""
+    _reclaimer_wakeup.set()
+
+
+def queue_user_purge(user_id):
+    """Hand the images and folders of a user marked purge_pending to the
+    reclaimer thread, so the admin request only has to flag the user row."""
+    with _purge_lock:
+        _pending_purges.add(user_id)
+    wake_file_reclaimer()
+
+
+def pending_purge_ids():
+    """Users flagged for purging whose purge has not finished, e.g. one that
+    was interrupted by a restart."""
+    return {user_id for (user_id,) in db.session.query(User.id).filter(User.purge_pending.is_(True))}
+
+
+def reclaim(app, sweep=False):
+    """One reclaimer pass: purge deleted users' content, unlink queued files,
+    then record the digests of a batch of pre-hashing images. Returns the
+    number of files removed."""
+    global _hash_backfill_after
+    with app.app_context():
+        try:
+            # 恢复期间数据库和上传目录正在被替换，等维护结束再处理
+            if current_maintenance():
+                return 0
+            with _purge_lock:
+                user_ids = set(_pending_purges)
+                _pending_purges.clear()
+            if sweep:
+                user_ids |= pending_purge_ids()
+            for user_id in sorted(user_ids):
+                user = db.session.get(User, user_id)
+                if user is not None and user.purge_pending:
+                    purge_user(user_id)
+            removed = apply_deferred_deletes(app)
+            _, after_id = backfill_content_hashes(app.config['UPLOAD_FOLDER'], _hash_backfill_after)
+            _hash_backfill_after = after_id or 0
+            return removed
+        finally:
+            db.session.remove()
+
+
+def _reclaimer_loop(app, interval):
+    sweep = True
+    while True:
+        try:
+            reclaim(app, sweep=sweep)
+            sweep = False
+        except Exception:
+            with app.app_context():
+                app.logger.exception("File reclaimer failed")
+        _reclaimer_wakeup.wait(interval)
+        _reclaimer_wakeup.clear()
+
+
+def start_file_reclaimer(app):
+    """Background thread that deletes the rows of purged users and unlinks
+    files queued by bulk deletes. It is woken right after such a delete
+    commits and also polls every FILE_RECLAIM_INTERVAL seconds, so work queued
+    by other workers is picked up; its first pass also resumes the purges of
+    users that were cut short by a restart. Images uploaded before content
+    hashing get their digest here, a batch per pass, so they gain a strong
+    ETag without the serving path ever writing to the database."""
+    global _reclaimer_started
+    with _reclaimer_lock:
+        if _reclaimer_started:
+            return
+        _reclaimer_started = True
+        interval = app.config.get("FILE_RECLAIM_INTERVAL", 60)
+        thread = threading.Thread(target=_reclaimer_loop, args=(app, interval), daemon=True)
+        thread.start()
@@ -11,11 +11,49 @@ class Config:
         'sqlite:///' + os.path.join(data_dir, 'database.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # SQLite 性能配置：WAL + synchronous=NORMAL + busy_timeout + mmap/cache，
+    # GET 请求的查询走单独的只读连接池，后台定期 wal_checkpoint(TRUNCATE)
+    SQLITE_PROFILE = (os.environ.get('FASTIMG_SQLITE_PROFILE') or 'true').lower() != 'false'
+    SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('FASTIMG_SQLITE_BUSY_TIMEOUT_MS') or 5000)
+    SQLITE_MMAP_MB = int(os.environ.get('FASTIMG_SQLITE_MMAP_MB') or 256)
+    SQLITE_CACHE_MB = int(os.environ.get('FASTIMG_SQLITE_CACHE_MB') or 64)
+    SQLITE_READ_ENGINE = (os.environ.get('FASTIMG_SQLITE_READ_ENGINE') or 'true').lower() != 'false'
+    SQLITE_READ_POOL_SIZE = int(os.environ.get('FASTIMG_SQLITE_READ_POOL_SIZE') or 8)
+    SQLITE_CHECKPOINT_INTERVAL = float(os.environ.get('FASTIMG_SQLITE_CHECKPOINT_INTERVAL') or 300)
+
     # 上传配置
     UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER') or os.path.join(basedir, 'uploads')
     FASTIMG_CONFIG_DIR = os.environ.get('FASTIMG_CONFIG_DIR') or os.path.join(basedir, 'config')
     FASTIMG_BACKUP_WORK_DIR = os.environ.get('FASTIMG_BACKUP_WORK_DIR') or os.path.join(basedir, 'data', 'backup-work')
     RCLONE_CONFIG_PATH = os.environ.get('RCLONE_CONFIG') or os.path.join(FASTIMG_CONFIG_DIR, 'rclone', 'rclone.conf')
+    # 图片编码进程池：0 = 在请求线程内直接处理
+    IMAGE_WORKERS = int(os.environ.get('FASTIMG_IMAGE_WORKERS') or min(os.cpu_count() or 1, 4))
+    IMAGE_WORKER_TIMEOUT = float(os.environ.get('FASTIMG_IMAGE_WORKER_TIMEOUT') or 120)
+
+    # 动态变换 (/i/<filename>?w=&h=...) 派生图缓存，超过上限后按 LRU 淘汰
+    DERIVATIVE_CACHE_DIR = os.environ.get('FASTIMG_DERIVATIVE_CACHE_DIR') or os.path.join(basedir, 'data', 'derivatives')
+    DERIVATIVE_CACHE_MAX_BYTES = int(float(os.environ.get('FASTIMG_DERIVATIVE_CACHE_MB') or 1024) * 1024 * 1024)
+    # 缓存未命中需要真正渲染时按客户端 IP 限流（命中不受限）
+    TRANSFORM_RENDER_LIMIT = os.environ.get('FASTIMG_TRANSFORM_RENDER_LIMIT') or '60 per minute'
+
+    # 图片字节交给前置服务器发送：'' = Python 直接发送，'x-accel' = nginx X-Accel-Redirect，
+    # 'x-sendfile' = Apache/lighttpd X-Sendfile。x-accel 需要在 nginx 中配置 internal location
+    SENDFILE_MODE = (os.environ.get('FASTIMG_SENDFILE_MODE') or '').strip().lower()
+    ACCEL_REDIRECT_PREFIX = (os.environ.get('FASTIMG_ACCEL_PREFIX') or '/_fastimg').rstrip('/')
+    # GIF 帧数 × 画面像素超过该值（百万像素）时不再重新编码/转 WebP，直接保存原始字节
+    ANIMATION_MAX_PIXELS = int(float(os.environ.get('FASTIMG_ANIMATION_MAX_MP') or 200) * 1000 * 1000)
+    # /api/upload/batch 单次请求最多文件数（总大小仍受 MAX_CONTENT_LENGTH 限制）
+    UPLOAD_BATCH_MAX_FILES = int(os.environ.get('FASTIMG_UPLOAD_BATCH_MAX_FILES') or 100)
+    # 批量删除只登记文件，由后台回收线程分批删除；这是兜底轮询间隔（秒）
+    FILE_RECLAIM_INTERVAL = float(os.environ.get('FASTIMG_FILE_RECLAIM_INTERVAL') or 60)
+
+    # /metrics: 各 worker 定期把指标快照写到 METRICS_DIR，抓取时汇总；令牌供 Prometheus 以 Bearer 方式访问
+    METRICS_ENABLED = (os.environ.get('FASTIMG_METRICS_ENABLED') or 'true').lower() != 'false'
+    METRICS_DIR = os.environ.get('FASTIMG_METRICS_DIR') or os.path.join(basedir, 'data', 'metrics')
+    METRICS_FLUSH_INTERVAL = float(os.environ.get('FASTIMG_METRICS_FLUSH_INTERVAL') or 5)
+    METRICS_TOKEN = os.environ.get('FASTIMG_METRICS_TOKEN') or ''
+    # 上传接口的响应里附带分阶段耗时 (meta.timing)；Server-Timing 响应头始终输出
+    UPLOAD_TIMING_DEBUG = (os.environ.get('FASTIMG_UPLOAD_TIMING_DEBUG') or 'false').lower() == 'true'
     MAX_CONTENT_LENGTH = 100 * 1024 * 1024  # Flask Limit increased to 100MB, app logic handles specific limits
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp', 'bmp'}
     
@@ -31,6 +69,10 @@ class Config:
     RATELIMIT_DEFAULT = "5000 per day"
     RATELIMIT_STORAGE_URL = "memory://"
     RATELIMIT_HEADERS_ENABLED = True
+
+    # 访问计数写回 (write-behind)：每隔 N 秒或累计 M 次访问批量写一次数据库
+    VIEW_COUNT_FLUSH_INTERVAL = float(os.environ.get('FASTIMG_VIEW_FLUSH_INTERVAL') or 5)
+    VIEW_COUNT_FLUSH_EVENTS = int(os.environ.get('FASTIMG_VIEW_FLUSH_EVENTS') or 1000)
     
     # Session 安全
     SESSION_COOKIE_HTTPONLY = True
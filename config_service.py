@@ -0,0 +1,92 @@
+import os
+import threading
+import time
+
+from flask import current_app
+
+
+# 其他 worker 修改配置后，本进程最多隔这么久（秒）检查一次版本文件
+VERSION_CHECK_INTERVAL = 1.0
+VERSION_FILE_NAME = "system-config.version"
+
+
+class ConfigSnapshot:
+    """进程内的 system_config 快照，一次查询读出全部行。
+
+    跨 gunicorn worker 的失效靠配置目录下的版本文件：SystemConfig.set 提交后
+    改写它，各进程每隔 VERSION_CHECK_INTERVAL 秒 stat 一次，mtime/内容变化就
+    整表重新加载。热路径上最多一次 stat，不查数据库。
+    """
+
+    def __init__(self, version_path):
+        self.version_path = version_path
+        self._lock = threading.Lock()
+        self._values = None
+        self._stamp = None
+        self._checked_at = 0.0
+        self.generation = 0
+
+    def _read_stamp(self):
+        try:
+            st = os.stat(self.version_path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def values(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._values is not None and now - self._checked_at < VERSION_CHECK_INTERVAL:
+                return self._values
+            stamp = self._read_stamp()
+            self._checked_at = now
+            if self._values is not None and stamp == self._stamp:
+                return self._values
+
+        from extensions import db
+        from models import SystemConfig
+
+        rows = db.session.query(SystemConfig.key, SystemConfig.value).all()
+        values = {key: value for key, value in rows}
+        with self._lock:
+            self._values = values
+            self._stamp = stamp
+            self.generation += 1
+            return values
+
+    def invalidate(self):
+        with self._lock:
+            self._values = None
+
+    def bump(self):
+        """Invalidate this process and tell the other workers to reload."""
+        os.makedirs(os.path.dirname(self.version_path), exist_ok=True)
+        tmp_path = f"{self.version_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as handle:
+            handle.write(f"{time.time_ns()}\n")
+        # rename 换 inode，同一 mtime 粒度内的两次修改也能被区分
+        os.replace(tmp_path, self.version_path)
+        self.invalidate()
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def get_config_snapshot(app=None):
+    app = app or current_app
+    path = os.path.join(app.config["FASTIMG_CONFIG_DIR"], VERSION_FILE_NAME)
+    with _snapshots_lock:
+        snapshot = _snapshots.get(path)
+        if snapshot is None:
+            snapshot = ConfigSnapshot(path)
+            _snapshots[path] = snapshot
+        return snapshot
+
+
+def config_values(app=None):
+    return get_config_snapshot(app).values()
+
+
+def bump_config_version(app=None):
+    get_config_snapshot(app).bump()
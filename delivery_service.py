@@ -0,0 +1,138 @@
+import hashlib
+import hmac
+import mimetypes
+import os
+import threading
+from urllib.parse import quote
+
+from flask import g, request, send_file
+from werkzeug.utils import send_file as werkzeug_send_file
+
+from config_service import config_values
+
+
+DEFAULT_MAX_AGE = 31536000
+
+_settings = None
+_settings_lock = threading.Lock()
+
+
+def delivery_settings():
+    """Typed settings the /i/ hot path needs, rebuilt only when the process
+    config snapshot reloads."""
+    global _settings
+    values = config_values()
+    with _settings_lock:
+        if _settings is not None and _settings[0] is values:
+            return _settings[1]
+
+    from models import SystemConfig
+
+    settings = {
+        'immutable': SystemConfig.get('IMAGE_CACHE_IMMUTABLE', 'false') == 'true',
+        'max_age': max(0, SystemConfig.get('IMAGE_CACHE_MAX_AGE', DEFAULT_MAX_AGE, type_func=int)),
+        'compress_quality': SystemConfig.get('compress_quality', 80, type_func=int),
+        'per_image_limit': SystemConfig.get('rate_limit_per_image', 0, type_func=int),
+        'variants': SystemConfig.get('ENABLE_FORMAT_VARIANTS', 'false') == 'true',
+    }
+    with _settings_lock:
+        _settings = (values, settings)
+    return settings
+
+
+def image_etag(secret, filename, content_hash):
+    """Strong ETag for an original upload: its sha256 plus a short HMAC over
+    filename and digest, so a revalidation can be answered without looking
+    the image up. The bytes behind a filename never change, so any tag we
+    issued for it stays valid."""
+    sig = hmac.new(secret.encode('utf-8'), f"{filename}\0{content_hash}".encode('utf-8'), hashlib.sha256)
+    return f"{content_hash}.{sig.hexdigest()[:16]}"
+
+
+def variant_etag(etag, fmt):
+    """ETag of a format variant: the original's tag plus the format."""
+    return f"{etag}.{fmt}" if isinstance(etag, str) else etag
+
+
+def match_image_etag(secret, filename, if_none_match, formats=()):
+    """Return the If-None-Match tag we issued for filename, or None. Tags of
+    format variants only match while their format is in formats."""
+    for tag in if_none_match.as_set(include_weak=True):
+        content_hash, _, rest = tag.partition('.')
+        sig, _, fmt = rest.partition('.')
+        if len(content_hash) != 64 or not sig:
+            continue
+        if fmt and fmt not in formats:
+            continue
+        if hmac.compare_digest(image_etag(secret, filename, content_hash), f"{content_hash}.{sig}"):
+            return tag
+    return None
+
+
+def accepted_formats(accept, formats):
+    """The formats (webp, avif, ...) the client lists by name with q > 0.
+    Wildcards do not count: */* clients get the original."""
+    listed = {value.lower(): q for value, q in accept}
+    return [fmt for fmt in formats if listed.get(f"image/{fmt}", 0) > 0]
+
+
+def cache_max_age(settings):
+    """max_age for send_file: None keeps Werkzeug's default no-cache."""
+    return settings['max_age'] if settings['immutable'] else None
+
+
+def apply_cache_headers(response, settings):
+    if settings['immutable']:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = settings['max_age']
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def _accel_location(app, path):
+    real = os.path.realpath(path)
+    roots = (
+        (app.config['UPLOAD_FOLDER'], 'uploads'),
+        (app.config['DERIVATIVE_CACHE_DIR'], 'derivatives'),
+    )
+    for root, location in roots:
+        root = os.path.realpath(root)
+        if real.startswith(root + os.sep):
+            rel = os.path.relpath(real, root).replace(os.sep, '/')
+            return f"{app.config['ACCEL_REDIRECT_PREFIX']}/{location}/{quote(rel)}"
+    return None
+
+
+def send_image_file(app, path, settings, mimetype=None, etag=True):
+    """Send an image from disk, or only its headers when SENDFILE_MODE hands
+    the bytes to the front server. path must already be validated."""
+    mode = app.config.get('SENDFILE_MODE')
+    max_age = cache_max_age(settings)
+    if mode == 'x-accel':
+        location = _accel_location(app, path)
+        if location:
+            response = app.response_class(mimetype=mimetype or mimetypes.guess_type(path)[0] or 'application/octet-stream')
+            response.headers['X-Accel-Redirect'] = location
+            # 正文由前端服务器发送，留给 /metrics 统计字节数
+            g.fastimg_sent_bytes = os.path.getsize(path)
+            if isinstance(etag, str):
+                response.set_etag(etag)
+            return apply_cache_headers(response, settings)
+    elif mode == 'x-sendfile':
+        response = werkzeug_send_file(
+            path,
+            request.environ,
+            mimetype=mimetype,
+            etag=etag,
+            max_age=max_age,
+            use_x_sendfile=True,
+            response_class=app.response_class,
+            _root_path=app.root_path,
+        )
+        return apply_cache_headers(response, settings)
+
+    response = send_file(path, mimetype=mimetype, etag=etag, max_age=max_age)
+    return apply_cache_headers(response, settings)
@@ -0,0 +1,195 @@
+import hashlib
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX
+    fcntl = None
+
+
+# 命中时最多每隔这么久刷新一次文件 mtime，作为跨进程共享的 LRU 时间戳
+TOUCH_INTERVAL = 300
+
+
+def derivative_key(filename, transform):
+    """Content address of a derivative. Upload filenames are immutable UUIDs,
+    so filename + normalized transform fully identifies the output bytes."""
+    raw = "|".join([
+        filename,
+        str(transform.get("w") or ""),
+        str(transform.get("h") or ""),
+        transform.get("fit") or "",
+        transform.get("fmt") or "",
+        str(transform.get("q") or ""),
+    ])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class DerivativeCache:
+    """磁盘上的派生图缓存，按 key 寻址、总大小封顶、按 mtime 做 LRU 淘汰。
+
+    同一个 key 的并发渲染会被合并：进程内用线程锁，跨 gunicorn worker 用
+    flock 文件锁，后到的请求等第一个渲染完成后直接读取结果。
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._total = None
+
+    def path_for(self, key, ext):
+        return os.path.join(self.root, key[:2], f"{key}.{ext}")
+
+    def get(self, key, ext):
+        path = self.path_for(key, ext)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if time.time() - st.st_mtime > TOUCH_INTERVAL:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return path
+
+    def get_or_render(self, key, ext, render):
+        """Return the cached path for key, calling render(path) at most once
+        across concurrent requests when it is missing."""
+        path = self.get(key, ext)
+        if path:
+            return path
+
+        lock = self._acquire_inflight(key)
+        try:
+            with lock:
+                path = self.get(key, ext)
+                if path:
+                    return path
+                os.makedirs(os.path.dirname(self.path_for(key, ext)), exist_ok=True)
+                with self._file_lock(key):
+                    path = self.get(key, ext)
+                    if path:
+                        return path
+                    path = self.path_for(key, ext)
+                    render(path)
+                    self._account(os.path.getsize(path))
+        finally:
+            self._release_inflight(key)
+
+        self.evict_if_needed()
+        return path
+
+    def _acquire_inflight(self, key):
+        with self._lock:
+            entry = self._inflight.get(key)
+            if entry is None:
+                entry = [threading.Lock(), 0]
+                self._inflight[key] = entry
+            entry[1] += 1
+            return entry[0]
+
+    def _release_inflight(self, key):
+        with self._lock:
+            entry = self._inflight.get(key)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] <= 0:
+                self._inflight.pop(key, None)
+
+    def _file_lock(self, key):
+        return _FileLock(os.path.join(self.root, key[:2], f"{key}.lock"))
+
+    def _scan(self):
+        entries = []
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith((".lock", ".tmp")):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _account(self, size):
+        with self._lock:
+            if self._total is None:
+                self._total = sum(item[1] for item in self._scan())
+            else:
+                self._total += size
+
+    def evict_if_needed(self):
+        """Drop least recently used derivatives until the cache is at 90% of
+        its cap. Rescans disk so files written by other workers are counted."""
+        if not self.max_bytes or self.max_bytes <= 0:
+            return 0
+        with self._lock:
+            if self._total is not None and self._total <= self.max_bytes:
+                return 0
+            entries = self._scan()
+            total = sum(item[1] for item in entries)
+            removed = 0
+            if total > self.max_bytes:
+                target = int(self.max_bytes * 0.9)
+                entries.sort()
+                for _, size, path in entries:
+                    if total <= target:
+                        break
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    except OSError:
+                        continue
+                    try:
+                        os.remove(os.path.splitext(path)[0] + ".lock")
+                    except OSError:
+                        pass
+                    total -= size
+                    removed += 1
+            self._total = total
+            return removed
+
+
+class _FileLock:
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def __enter__(self):
+        if fcntl is None:
+            return self
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._fd is None:
+            return
+        # 锁文件留给淘汰时清理；这里删除会让正在等待的进程锁到已解链的 inode
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_derivative_cache(app):
+    root = app.config["DERIVATIVE_CACHE_DIR"]
+    with _caches_lock:
+        cache = _caches.get(root)
+        if cache is None:
+            os.makedirs(root, exist_ok=True)
+            cache = DerivativeCache(root, app.config.get("DERIVATIVE_CACHE_MAX_BYTES", 0))
+            _caches[root] = cache
+        return cache
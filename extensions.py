@@ -1,10 +1,34 @@
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from flask_login import LoginManager
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_migrate import Migrate
+from sqlalchemy import event
 
-db = SQLAlchemy()
+
+class RoutingSession(Session):
+    """GET/HEAD 请求里的纯 SELECT 走只读连接池（见 sqlite_service），
+    一旦本事务写过（flush / DML），后续语句都留在写连接上以读到自己的写入。"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            from sqlite_service import reader_bind_for
+            reader = reader_bind_for(self, clause)
+            if reader is not None:
+                return reader
+            if self._flushing or clause is not None:
+                self.info['fastimg_wrote'] = True
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def _reset_write_flag(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('fastimg_wrote', None)
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 login_manager = LoginManager()
 migrate = Migrate()
 
@@ -15,7 +39,10 @@ limiter = Limiter(key_func=get_remote_address)
 @login_manager.user_loader
 def load_user(user_id):
     from models import User
-    return User.query.get(int(user_id))
+    user = User.query.get(int(user_id))
+    if user is None or user.purge_pending:
+        return None
+    return user
 
 # 前后端分离不使用 login_view 重定向
 login_manager.login_view = None
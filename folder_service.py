@@ -0,0 +1,117 @@
+from sqlalchemy import func, literal, update
+
+from extensions import db
+from models import Folder
+
+
+# 旧库加列后 / 恢复旧备份后按 parent_id 链一次性算出物化路径
+FOLDER_PATH_BACKFILL_SQL = """
+    WITH RECURSIVE tree(id, path, name_path) AS (
+        SELECT id, '/' || id || '/', name FROM folder WHERE parent_id IS NULL
+        UNION ALL
+        SELECT folder.id, tree.path || folder.id || '/', tree.name_path || '/' || folder.name
+        FROM folder JOIN tree ON folder.parent_id = tree.id
+    )
+    UPDATE folder SET
+        path = (SELECT path FROM tree WHERE tree.id = folder.id),
+        name_path = (SELECT name_path FROM tree WHERE tree.id = folder.id)
+"""
+
+
+def ancestor_ids(folder):
+    """Ids from the root down to folder itself, parsed from its path."""
+    return [int(part) for part in folder.path.strip('/').split('/') if part]
+
+
+def folder_breadcrumbs(folder):
+    """Root-to-folder chain in one primary-key lookup."""
+    ids = ancestor_ids(folder)
+    rows = {f.id: f for f in Folder.query.filter(Folder.id.in_(ids), Folder.user_id == folder.user_id)}
+    return [{'id': rows[i].id, 'name': rows[i].name} for i in ids if i in rows]
+
+
+def subtree_condition(folder):
+    """SQL condition matching folder and every folder below it."""
+    # 用区间代替 LIKE 'prefix%'，SQLite 才能走 path 索引；path 以 '/' 结尾，'0' 是 '/' 的下一个字符
+    return (Folder.path >= folder.path) & (Folder.path < folder.path[:-1] + '0')
+
+
+def _create_folder(user_id, name, parent):
+    folder = Folder(name=name, user_id=user_id, parent_id=parent.id if parent else None)
+    db.session.add(folder)
+    db.session.flush()  # 需要 id 才能拼出 path
+    folder.path = f"{parent.path if parent else '/'}{folder.id}/"
+    folder.name_path = f"{parent.name_path}/{name}" if parent else name
+    return folder
+
+
+def resolve_folder_path(user_id, base_folder_id, path_str, memo=None):
+    """Return the folder id for path_str (a/b/c) below base_folder_id,
+    creating missing levels. Existing levels are found with one query on
+    (user_id, name_path); memo caches results across files of one batch."""
+    parts = [p for p in path_str.split('/') if p]
+    if not parts:
+        return base_folder_id
+    memo = {} if memo is None else memo
+    key = (user_id, base_folder_id, '/'.join(parts))
+    if key in memo:
+        return memo[key]
+
+    base = None
+    if base_folder_id:
+        base = db.session.get(Folder, base_folder_id)
+        if not base or base.user_id != user_id:
+            raise ValueError('Invalid folder')
+
+    prefix = f"{base.name_path}/" if base else ''
+    wanted = [prefix + '/'.join(parts[:i + 1]) for i in range(len(parts))]
+    existing = {}
+    for folder in Folder.query.filter(Folder.user_id == user_id, Folder.name_path.in_(wanted)).order_by(Folder.id):
+        existing.setdefault(folder.name_path, folder)
+
+    parent = base
+    for part, name_path in zip(parts, wanted):
+        folder = existing.get(name_path)
+        if folder is None:
+            folder = _create_folder(user_id, part, parent)
+        parent = folder
+
+    memo[key] = parent.id
+    return parent.id
+
+
+def move_folder(folder, name=None, parent=None, keep_parent=True):
+    """Rename and/or reparent folder, rewriting the paths of its subtree
+    with one UPDATE. parent=None with keep_parent=False moves it to the root."""
+    name = name if name is not None else folder.name
+    if keep_parent:
+        parent = folder.parent
+    if parent is not None:
+        if parent.user_id != folder.user_id:
+            raise ValueError('Invalid folder')
+        if parent.path.startswith(folder.path):
+            raise ValueError('Cannot move a folder into itself')
+
+    old_path, old_name_path = folder.path, folder.name_path
+    new_path = f"{parent.path if parent else '/'}{folder.id}/"
+    new_name_path = f"{parent.name_path}/{name}" if parent else name
+    if new_path == old_path and new_name_path == old_name_path:
+        return folder
+
+    db.session.execute(
+        update(Folder)
+        .where(Folder.user_id == folder.user_id, subtree_condition(folder))
+        .values(
+            path=literal(new_path).concat(func.substr(Folder.path, len(old_path) + 1)),
+            name_path=literal(new_name_path).concat(func.substr(Folder.name_path, len(old_name_path) + 1)),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    db.session.execute(
+        update(Folder)
+        .where(Folder.id == folder.id)
+        .values(name=name, parent_id=parent.id if parent else None)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.expire_all()
+    return db.session.get(Folder, folder.id)
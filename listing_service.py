@@ -0,0 +1,81 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+from models import Image
+
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# sort 参数 -> 排序列；都配有 (user_id, folder_id, <列>, id) 复合索引
+SORT_COLUMNS = {
+    'time': Image.upload_time,
+    'size': Image.size,
+    'name': Image.original_name,
+}
+
+
+def _cursor_value(sort_by, image):
+    value = getattr(image, SORT_COLUMNS[sort_by].key)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def encode_cursor(sort_by, order, image):
+    """Opaque position after image in the given ordering."""
+    raw = json.dumps([sort_by, order, _cursor_value(sort_by, image), image.id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, sort_by, order):
+    """Return (value, id) from a cursor issued for the same sort and order.
+    Raises ValueError for anything else."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        c_sort, c_order, value, image_id = json.loads(raw)
+    except (binascii.Error, ValueError, TypeError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+    if c_sort != sort_by or c_order != order or not isinstance(image_id, int):
+        raise ValueError('Cursor does not match the requested sort order')
+    if sort_by == 'time':
+        try:
+            value = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            raise ValueError('Invalid cursor')
+    elif sort_by == 'size' and not isinstance(value, int):
+        raise ValueError('Invalid cursor')
+    elif sort_by == 'name' and not isinstance(value, str):
+        raise ValueError('Invalid cursor')
+    return value, image_id
+
+
+def keyset_page(query, sort_by, order, cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """Fetch one page ordered by (sort column, id) starting after cursor.
+
+    Returns (items, next_cursor); next_cursor is None on the last page. Uses a
+    row-value comparison so SQLite can seek the composite index instead of
+    counting and skipping OFFSET rows.
+    """
+    column = SORT_COLUMNS[sort_by]
+    if cursor:
+        value, image_id = decode_cursor(cursor, sort_by, order)
+        key = tuple_(column, Image.id)
+        if order == 'asc':
+            query = query.filter(key > tuple_(value, image_id))
+        else:
+            query = query.filter(key < tuple_(value, image_id))
+
+    if order == 'asc':
+        query = query.order_by(column.asc(), Image.id.asc())
+    else:
+        query = query.order_by(column.desc(), Image.id.desc())
+
+    rows = query.limit(limit + 1).all()
+    items = rows[:limit]
+    next_cursor = encode_cursor(sort_by, order, items[-1]) if len(rows) > limit else None
+    return items, next_cursor
@@ -0,0 +1,467 @@
+import json
+import math
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows dev machines
+    fcntl = None
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+STAGE_BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600, 10800)
+
+# name -> (type, help, buckets)
+METRICS = {
+    'fastimg_requests_total': ('counter', 'HTTP requests by endpoint and status class.', None),
+    'fastimg_upload_seconds': ('histogram', 'Upload request latency.', LATENCY_BUCKETS),
+    'fastimg_upload_stage_seconds': ('histogram', 'Upload pipeline stage durations, by source->output format.', LATENCY_BUCKETS),
+    'fastimg_serve_seconds': ('histogram', '/i/ request latency, up to handing the file to the server.', LATENCY_BUCKETS),
+    'fastimg_serve_bytes': ('histogram', 'Size of images sent by /i/.', BYTES_BUCKETS),
+    'fastimg_db_queries_total': ('counter', 'SQL statements executed, by endpoint.', None),
+    'fastimg_db_query_seconds_total': ('counter', 'Time spent in SQL statements, by endpoint.', None),
+    'fastimg_backup_stage_seconds': ('histogram', 'Duration of backup/restore progress stages.', STAGE_BUCKETS),
+    'fastimg_image_pool_pending_jobs': ('gauge', 'Image jobs submitted to the worker pool and not finished yet.', None),
+    'fastimg_metrics_workers': ('gauge', 'Worker processes contributing to this scrape.', None),
+}
+
+# 按 endpoint 计时的上传接口
+UPLOAD_ENDPOINTS = ('upload', 'upload_batch')
+RETIRED_FILE = 'retired.json'
+# 每个 worker 为每种格式保留最近多少次上传的分阶段耗时，用于管理后台的分位数表
+UPLOAD_TIMING_WINDOW = 200
+
+_writer_lock = threading.Lock()
+_writer_started = False
+_snapshot_written = False
+
+
+class MetricsRegistry:
+    """进程内的指标聚合器。
+
+    请求路径上只做内存累加；后台线程定期把快照写到 METRICS_DIR/<pid>.json，
+    /metrics 把所有 worker 的快照相加后输出 Prometheus 文本格式。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (name, labels) -> value; labels 为 ((key, value), ...)
+        self._counters = {}
+        # (name, labels) -> [每个桶的计数 (最后一个是 +Inf), sum]
+        self._histograms = {}
+        self._gauges = {}
+        # group -> 最近的样本 (dict)，只保留 UPLOAD_TIMING_WINDOW 条
+        self._samples = {}
+
+    def inc(self, name, value=1, labels=()):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        buckets = METRICS[name][2]
+        index = bisect_left(buckets, value)
+        key = (name, labels)
+        with self._lock:
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = [[0] * (len(buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def set_gauge(self, name, value, labels=()):
+        with self._lock:
+            self._gauges[(name, labels)] = value
+
+    def add_sample(self, group, sample):
+        with self._lock:
+            window = self._samples.get(group)
+            if window is None:
+                window = self._samples[group] = deque(maxlen=UPLOAD_TIMING_WINDOW)
+            window.append(sample)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._gauges.clear()
+            self._samples.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                'histograms': [[name, list(labels), list(counts), total] for (name, labels), (counts, total) in self._histograms.items()],
+                'gauges': [[name, list(labels), value] for (name, labels), value in self._gauges.items()],
+                'samples': {group: list(window) for group, window in self._samples.items()},
+            }
+
+
+metrics = MetricsRegistry()
+
+
+def _labels(pairs):
+    return tuple(tuple(pair) for pair in pairs)
+
+
+def _merge(into, snapshot, gauges=True):
+    """Add snapshot (the JSON form) into the dicts of into. Gauges and
+    samples only describe live workers and are skipped unless gauges is set."""
+    counters, histograms, live_gauges, samples = into
+    for name, labels, value in snapshot.get('counters', []):
+        key = (name, _labels(labels))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, counts, total in snapshot.get('histograms', []):
+        key = (name, _labels(labels))
+        entry = histograms.get(key)
+        if entry is None or len(entry[0]) != len(counts):
+            entry = histograms[key] = [[0] * len(counts), 0.0]
+        entry[0] = [a + b for a, b in zip(entry[0], counts)]
+        entry[1] += total
+    if gauges:
+        for name, labels, value in snapshot.get('gauges', []):
+            key = (name, _labels(labels))
+            live_gauges[key] = live_gauges.get(key, 0) + value
+        for group, window in snapshot.get('samples', {}).items():
+            samples.setdefault(group, []).extend(window)
+
+
+def _write_json(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as handle:
+        json.dump(data, handle, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path, encoding='utf-8') as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return None
+
+
+def _stale_after(app):
+    return max(30.0, app.config.get('METRICS_FLUSH_INTERVAL', 5) * 6)
+
+
+def write_snapshot(app):
+    """Write this process's metrics to METRICS_DIR/<pid>.json."""
+    from worker_pool import pending_jobs
+
+    global _snapshot_written
+    directory = app.config['METRICS_DIR']
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    if _snapshot_written and not os.path.exists(path):
+        # 写快照停顿太久被别的 worker 当成已退出、计数已并入 retired.json，从零重新累计
+        metrics.reset()
+    metrics.set_gauge('fastimg_image_pool_pending_jobs', pending_jobs())
+    metrics.set_gauge('fastimg_metrics_workers', 1)
+    _write_json(path, metrics.snapshot())
+    _snapshot_written = True
+
+
+def retire_stale_snapshots(app):
+    """Fold the counters of workers that stopped writing (exited or were
+    recycled) into retired.json, so totals do not go backwards."""
+    directory = app.config['METRICS_DIR']
+    cutoff = time.time() - _stale_after(app)
+    own = f"{os.getpid()}.json"
+    stale = []
+    for name in os.listdir(directory):
+        if not name.endswith('.json') or name in (own, RETIRED_FILE):
+            continue
+        try:
+            if os.path.getmtime(os.path.join(directory, name)) < cutoff:
+                stale.append(name)
+        except FileNotFoundError:
+            continue
+    if not stale or fcntl is None:
+        return 0
+
+    with open(os.path.join(directory, 'retired.lock'), 'a+') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            merged = ({}, {}, {}, {})
+            _merge(merged, _read_json(os.path.join(directory, RETIRED_FILE)) or {}, gauges=False)
+            retired = []
+            for name in stale:
+                # 另一个 worker 可能已经先合并并删掉了
+                data = _read_json(os.path.join(directory, name))
+                if data is None:
+                    continue
+                _merge(merged, data, gauges=False)
+                retired.append(name)
+            if not retired:
+                return 0
+            counters, histograms, _, _ = merged
+            _write_json(os.path.join(directory, RETIRED_FILE), {
+                'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+                'histograms': [[name, list(labels), counts, total] for (name, labels), (counts, total) in histograms.items()],
+            })
+            for name in retired:
+                try:
+                    os.remove(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+            return len(retired)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def collect(app):
+    """Sum the snapshots of every live worker (plus retired counters).
+    Returns (counters, histograms, gauges) dicts keyed by (name, labels) and
+    the recent upload timing samples by format."""
+    write_snapshot(app)
+    directory = app.config['METRICS_DIR']
+    # 与归档互斥，避免同一份计数在快照和 retired.json 里各算一次
+    with open(os.path.join(directory, 'retired.lock'), 'a+') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+        try:
+            return _collect_files(app, directory)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _collect_files(app, directory):
+    cutoff = time.time() - _stale_after(app)
+    merged = ({}, {}, {}, {})
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(directory, name)
+        if name == RETIRED_FILE:
+            _merge(merged, _read_json(path) or {}, gauges=False)
+            continue
+        try:
+            live = os.path.getmtime(path) >= cutoff
+        except FileNotFoundError:
+            continue
+        # 过期快照的计数器照样算 (等待归档)，gauge 只取存活的 worker
+        _merge(merged, _read_json(path) or {}, gauges=live)
+    return merged
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    body = ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in pairs
+    )
+    return '{' + body + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render_metrics(app):
+    """Prometheus text exposition (version 0.0.4) of all workers."""
+    counters, histograms, gauges, _ = collect(app)
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == 'histogram':
+            for (metric, labels), (counts, total) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ['+Inf'], counts):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else _format_value(float(bound))
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', le)])} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        else:
+            source = counters if kind == 'counter' else gauges
+            for (metric, labels), value in sorted(source.items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+def _endpoint():
+    if has_request_context():
+        return request.endpoint or 'other'
+    return 'background'
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('fastimg_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('fastimg_query_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    labels = (('endpoint', _endpoint()),)
+    metrics.inc('fastimg_db_queries_total', 1, labels)
+    metrics.inc('fastimg_db_query_seconds_total', elapsed, labels)
+
+
+def instrument_engine(engine):
+    if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def init_metrics(app):
+    """Install the request timers and SQL statement counters. Call before the
+    other before_request hooks so their time is included."""
+    from extensions import db
+    from sqlite_service import read_engine
+
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+    with app.app_context():
+        instrument_engine(db.engine)
+        engine = read_engine(app)
+        if engine is not None:
+            instrument_engine(engine)
+
+    @app.before_request
+    def start_request_timer():
+        g.fastimg_request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        start = g.get('fastimg_request_start')
+        if start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        endpoint = request.endpoint or 'other'
+        metrics.inc('fastimg_requests_total', 1, (('endpoint', endpoint), ('status', f"{response.status_code // 100}xx")))
+        if endpoint == 'serve_image':
+            metrics.observe('fastimg_serve_seconds', elapsed)
+            sent = response.content_length
+            if sent is None:
+                # X-Accel-Redirect 响应没有正文，字节数由 send_image_file 记下
+                sent = g.get('fastimg_sent_bytes')
+            if sent is not None and response.status_code == 200:
+                metrics.observe('fastimg_serve_bytes', sent)
+        elif endpoint in UPLOAD_ENDPOINTS:
+            metrics.observe('fastimg_upload_seconds', elapsed, (('endpoint', endpoint), ('status', f"{response.status_code // 100}xx")))
+        return response
+
+
+def record_upload_timing(timing):
+    """Feed one upload's meta['timing'] into the stage histograms and the
+    rolling per-format window."""
+    group = timing['format']
+    for stage, ms in timing['stages'].items():
+        metrics.observe('fastimg_upload_stage_seconds', ms / 1000, (('format', group), ('stage', stage)))
+    metrics.add_sample(group, {
+        'stages': timing['stages'],
+        'total_ms': timing['total_ms'],
+        'pixels': timing['pixels'],
+        'input_bytes': timing['input_bytes'],
+        'output_bytes': timing['output_bytes'],
+    })
+
+
+def server_timing(stages):
+    """Server-Timing header value for {stage: ms}."""
+    return ', '.join(f"{name};dur={ms:.1f}" for name, ms in stages.items())
+
+
+def _percentiles(values):
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+
+    def rank(p):
+        # nearest-rank
+        return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+    return {'p50': rank(50), 'p95': rank(95), 'p99': rank(99)}
+
+
+def upload_timing_table(app):
+    """p50/p95/p99 of the recent uploads of every worker, per source->output
+    format: per stage and total (ms), pixels and input/output bytes."""
+    samples = collect(app)[3]
+    rows = []
+    for group, window in sorted(samples.items()):
+        stage_names = []
+        for sample in window:
+            for name in sample['stages']:
+                if name not in stage_names:
+                    stage_names.append(name)
+        rows.append({
+            'format': group,
+            'count': len(window),
+            # 列表保持流水线顺序 (jsonify 会给 dict 的键排序)
+            'stages': [
+                dict(stage=name, **_percentiles([s['stages'].get(name) for s in window]))
+                for name in stage_names
+            ],
+            'total_ms': _percentiles([s['total_ms'] for s in window]),
+            'pixels': _percentiles([s['pixels'] for s in window]),
+            'input_bytes': _percentiles([s['input_bytes'] for s in window]),
+            'output_bytes': _percentiles([s['output_bytes'] for s in window]),
+        })
+    return {'window': UPLOAD_TIMING_WINDOW, 'formats': rows}
+
+
+_stage_lock = threading.Lock()
+# run id -> (operation, stage, started perf_counter)
+_run_stages = {}
+FINAL_STAGES = ('done', 'failed')
+
+
+def record_run_stage(run_id, operation, stage):
+    """Called on every backup/restore progress update; observes how long the
+    previous stage took once the stage changes."""
+    now = time.perf_counter()
+    with _stage_lock:
+        previous = _run_stages.get(run_id)
+        if previous is not None and previous[1] == stage:
+            return
+        if stage in FINAL_STAGES:
+            _run_stages.pop(run_id, None)
+        else:
+            _run_stages[run_id] = (operation, stage, now)
+    if previous is not None:
+        metrics.observe('fastimg_backup_stage_seconds', now - previous[2],
+                        (('operation', previous[0]), ('stage', previous[1])))
+
+
+def _writer_loop(app, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            write_snapshot(app)
+            retire_stale_snapshots(app)
+        except Exception as exc:
+            app.logger.warning(f"Writing metrics snapshot failed: {exc}")
+
+
+def start_metrics_writer(app):
+    global _writer_started
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+    with _writer_lock:
+        if _writer_started:
+            return
+        _writer_started = True
+        interval = app.config.get('METRICS_FLUSH_INTERVAL', 5)
+        thread = threading.Thread(target=_writer_loop, args=(app, interval), daemon=True)
+        thread.start()
@@ -11,6 +11,11 @@ class User(UserMixin, db.Model):
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     is_active_user = db.Column(db.Boolean, default=True)
     quota_bytes = db.Column(db.BigInteger, nullable=True)  # null = use global default
+    # 冗余的用量计数，随上传/删除在同一事务内增减，避免每次 SUM(image.size)
+    used_bytes = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    image_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # 管理员已删除、等待后台回收图片/文件夹；行要留到内容删完，避免 id 被新注册用户复用后接管旧内容
+    purge_pending = db.Column(db.Boolean, nullable=False, default=False, server_default='0')
     
     # 关系
     images = db.relationship('Image', backref='owner', lazy='dynamic')
@@ -51,16 +56,25 @@ class Folder(db.Model):
     parent_id = db.Column(db.Integer, db.ForeignKey('folder.id'), nullable=True) # Null = Root
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    # 物化路径：path 为祖先 id 链 "/1/5/9/"（含自身），name_path 为 "a/b/c"，
+    # 由 folder_service 在创建/移动时维护
+    path = db.Column(db.String(512), index=True)
+    name_path = db.Column(db.String(1024))
     
     # 关系: 级联删除，删文件夹时删掉下面的子文件夹
     subfolders = db.relationship('Folder', backref=db.backref('parent', remote_side=[id]), lazy='dynamic', cascade="all, delete-orphan")
     images = db.relationship('Image', backref='folder', lazy='dynamic')
 
+    __table_args__ = (
+        db.Index('ix_folder_user_name_path', 'user_id', 'name_path'),
+    )
+
     def to_dict(self):
         return {
             'id': self.id,
             'name': self.name,
             'parent_id': self.parent_id,
+            'path': self.name_path,
             'user_id': self.user_id,
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
@@ -76,11 +90,22 @@ class Image(db.Model):
     height = db.Column(db.Integer)
     mime_type = db.Column(db.String(64))
     upload_time = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    content_hash = db.Column(db.String(64), index=True)  # 磁盘文件 sha256，对应 Blob.digest
+    # 预生成的 WebP/AVIF 副本，小的在前: NULL = 不生成, '' = 排队中, 'avif,webp' = 已就绪, 'none' = 都不比原图小
+    variants = db.Column(db.String(32))
     
     # 统计信息关联
     stats = db.relationship('ImageStat', backref='image', uselist=False, cascade="all, delete-orphan")
 
+    # 图库列表按 (排序列, id) 做 keyset 分页
+    __table_args__ = (
+        db.Index('ix_image_owner_folder_time', 'user_id', 'folder_id', 'upload_time', 'id'),
+        db.Index('ix_image_owner_folder_size', 'user_id', 'folder_id', 'size', 'id'),
+        db.Index('ix_image_owner_folder_name', 'user_id', 'folder_id', 'original_name', 'id'),
+    )
+
     def to_dict(self):
+        from utils import thumbnail_urls
         return {
             'id': self.id,
             'filename': self.filename,
@@ -91,9 +116,19 @@ class Image(db.Model):
             'height': self.height,
             'mime_type': self.mime_type,
             'upload_time': self.upload_time.isoformat(),
-            'views': self.stats.view_count if self.stats else 0
+            'views': self.stats.view_count if self.stats else 0,
+            'thumbnails': thumbnail_urls(self.filename)
         }
 
+class Blob(db.Model):
+    # 按内容去重：相同 sha256 的上传通过硬链接共享同一份物理数据，
+    # ref_count 为引用它的 Image 数量，最后一个引用删除时数据才真正释放
+    digest = db.Column(db.String(64), primary_key=True)
+    filename = db.Column(db.String(128), nullable=False)  # 当前作为硬链接源的上传文件名
+    size = db.Column(db.BigInteger)
+    ref_count = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
 class ImageStat(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     image_id = db.Column(db.Integer, db.ForeignKey('image.id'), unique=True)
@@ -102,6 +137,9 @@ class ImageStat(db.Model):
     last_view = db.Column(db.DateTime)
     # 简化处理：Referer 可以记 top N 或最近的，这里为节省空间暂存最近一次非空 referer
     last_referer = db.Column(db.String(256))
+    # 单图每日访问计数 (day_date 为 UTC 日期 YYYY-MM-DD)，由 stats_service 批量写回
+    day_date = db.Column(db.String(10))
+    day_count = db.Column(db.Integer, default=0)
 
 class SystemConfig(db.Model):
     key = db.Column(db.String(64), primary_key=True)
@@ -110,28 +148,36 @@ class SystemConfig(db.Model):
     
     @staticmethod
     def get(key, default=None, type_func=str):
-        from extensions import db
-        conf = db.session.get(SystemConfig, key)
-        if conf:
+        # 读进程内快照，不再每次查库；快照由 config_service 按版本文件失效
+        from config_service import config_values
+        value = config_values().get(key)
+        if value is not None:
             try:
                 if type_func == bool:
-                    return conf.value.lower() == 'true'
-                return type_func(conf.value)
+                    return value.lower() == 'true'
+                return type_func(value)
             except (ValueError, TypeError, AttributeError):
                 return default
         return default
 
     @staticmethod
     def set(key, value, description=None):
+        SystemConfig.set_many({key: value}, descriptions={key: description} if description else None)
+
+    @staticmethod
+    def set_many(items, descriptions=None):
         from extensions import db
-        conf = db.session.get(SystemConfig, key)
-        if not conf:
-            conf = SystemConfig(key=key)
-            db.session.add(conf)
-        conf.value = str(value)
-        if description:
-            conf.description = description
+        from config_service import bump_config_version
+        for key, value in items.items():
+            conf = db.session.get(SystemConfig, key)
+            if not conf:
+                conf = SystemConfig(key=key)
+                db.session.add(conf)
+            conf.value = str(value)
+            if descriptions and descriptions.get(key):
+                conf.description = descriptions[key]
         db.session.commit()
+        bump_config_version()
 
 class InviteCode(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -181,6 +227,7 @@ class BackupConfig(db.Model):
     schedule_time = db.Column(db.String(5), default='03:30')
     timezone = db.Column(db.String(64), default='Asia/Shanghai')
     retention_count = db.Column(db.Integer, default=7)
+    backup_mode = db.Column(db.String(16), default='full')
     encryption_recipient = db.Column(db.String(256), nullable=True)
     encrypted_identity = db.Column(db.Text, nullable=True)
     last_scheduled_for = db.Column(db.String(10), nullable=True)
@@ -196,6 +243,7 @@ class BackupConfig(db.Model):
             'schedule_time': self.schedule_time or '03:30',
             'timezone': self.timezone or 'Asia/Shanghai',
             'retention_count': self.retention_count or 7,
+            'backup_mode': self.backup_mode or 'full',
             'has_identity': bool(self.encrypted_identity and self.encryption_recipient),
             'encryption_recipient': self.encryption_recipient,
             'last_scheduled_for': self.last_scheduled_for,
@@ -252,6 +300,9 @@ class MaintenanceState(db.Model):
     reason = db.Column(db.String(256), nullable=True)
     owner = db.Column(db.String(128), nullable=True)
     started_at = db.Column(db.DateTime, nullable=True)
+    # 备份打包期间占用上传文件，删除请求只登记到 deferred_delete，打包结束后再删
+    pin_owner = db.Column(db.String(128), nullable=True)
+    pinned_at = db.Column(db.DateTime, nullable=True)
     updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc),
                            onupdate=lambda: datetime.now(timezone.utc))
 
@@ -261,6 +312,14 @@ class MaintenanceState(db.Model):
             'mode': self.mode,
             'reason': self.reason,
             'owner': self.owner,
+            'pin_owner': self.pin_owner,
             'started_at': self.started_at.isoformat() if self.started_at else None,
             'updated_at': self.updated_at.isoformat() if self.updated_at else None
         }
+
+
+class DeferredDelete(db.Model):
+    # 待删除的上传文件队列：备份打包期间的删除与批量删除都登记在这里，由回收线程清理
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(256), nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Compare full decoding with reduced-resolution decoding for the outputs
+that are smaller than the source (thumbnails, ?w= transforms).
+
+    python scripts/bench_decode.py                 # synthetic 24 MP JPEG
+    python scripts/bench_decode.py photo.jpg ...   # your own files
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageOps  # noqa: E402
+
+from utils import decode_for_target, fit_within, probe_image  # noqa: E402
+
+
+def synthetic_jpeg(path, width=6000, height=4000):
+    # 渐变 + 低幅噪声，压缩率接近普通照片（纯噪声图的熵解码开销会掩盖缩放解码的收益）
+    base = Image.radial_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width // 4, height // 4), 24).resize((width, height), Image.BILINEAR)
+    img = Image.merge("RGB", (base, noise, Image.linear_gradient("L").resize((width, height))))
+    img.save(path, "JPEG", quality=85)
+
+
+def full_decode(path, box):
+    with Image.open(path) as src:
+        img = ImageOps.exif_transpose(src)
+        img.thumbnail(box, Image.LANCZOS)
+        return img.size
+
+
+def scaled_decode(path, box):
+    with Image.open(path) as src:
+        img = decode_for_target(src, fit_within(probe_image(src)[:2], box))
+        img.thumbnail(box, Image.LANCZOS)
+        return img.size
+
+
+def measure(fn, path, box, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        size = fn(path, box)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="*")
+    parser.add_argument("--sizes", default="256,1024,2048", help="comma separated output boxes")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    images = args.images
+    tmp_dir = None
+    if not images:
+        tmp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(tmp_dir.name, "synthetic.jpg")
+        synthetic_jpeg(path)
+        images = [path]
+
+    try:
+        for path in images:
+            with Image.open(path) as src:
+                print(f"{os.path.basename(path)}: {src.format} {src.size[0]}x{src.size[1]}")
+            for box in (int(s) for s in args.sizes.split(",")):
+                full, full_size = measure(full_decode, path, (box, box), args.rounds)
+                scaled, scaled_size = measure(scaled_decode, path, (box, box), args.rounds)
+                print(f"  box {box:>5}: full {full * 1000:8.1f} ms  scaled {scaled * 1000:8.1f} ms  "
+                      f"x{full / scaled:5.1f}  -> {scaled_size[0]}x{scaled_size[1]}"
+                      + ("" if full_size == scaled_size else f" (full: {full_size[0]}x{full_size[1]})"))
+    finally:
+        if tmp_dir:
+            tmp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -74,11 +74,12 @@ echo "Checking remote: $REMOTE_PATH"
 rclone lsf "$REMOTE_PATH" --max-depth 1 >/dev/null
 
 if [ -z "$BACKUP_NAME" ]; then
-  BACKUP_NAME="$(rclone lsf "$REMOTE_PATH" --files-only | grep '^fastimg-backup-.*\.age$' | sort | tail -n 1 || true)"
+  # 完整备份与增量快照按时间戳（前缀之后的部分）统一排序
+  BACKUP_NAME="$(rclone lsf "$REMOTE_PATH" --files-only | grep -E '^fastimg-(backup|snapshot)-.*\.age$' | sort -t- -k3 | tail -n 1 || true)"
 fi
 
 if [ -z "$BACKUP_NAME" ]; then
-  echo "No fastimg-backup-*.age files found in $REMOTE_PATH" >&2
+  echo "No fastimg-backup-*.age or fastimg-snapshot-*.age files found in $REMOTE_PATH" >&2
   exit 4
 fi
 
@@ -111,9 +112,33 @@ zstd -d -f "$TMP_DIR/backup.tar.zst" -o "$TMP_DIR/backup.tar"
 
 echo "Extracting and validating..."
 mkdir -p "$TMP_DIR/extract"
-python3 "$SCRIPT_DIR/restore_from_remote.py" extract-validate \
-  --tar "$TMP_DIR/backup.tar" \
-  --dest "$TMP_DIR/extract"
+case "$BACKUP_NAME" in
+  fastimg-snapshot-*)
+    python3 "$SCRIPT_DIR/restore_from_remote.py" extract \
+      --tar "$TMP_DIR/backup.tar" \
+      --dest "$TMP_DIR/extract"
+    rm -f "$TMP_DIR/backup.age" "$TMP_DIR/backup.tar.zst" "$TMP_DIR/backup.tar"
+    PACKS_REMOTE="$(remote_join "$REMOTE_PATH" "packs")"
+    for PACK in $(python3 "$SCRIPT_DIR/restore_from_remote.py" list-packs --extract "$TMP_DIR/extract"); do
+      echo "Downloading pack: $PACK"
+      rclone copyto "$(remote_join "$PACKS_REMOTE" "$PACK")" "$TMP_DIR/pack.age"
+      age -d -i "$TMP_DIR/identity.txt" -o "$TMP_DIR/pack.tar.zst" "$TMP_DIR/pack.age"
+      zstd -d -f -q "$TMP_DIR/pack.tar.zst" -o "$TMP_DIR/pack.tar"
+      python3 "$SCRIPT_DIR/restore_from_remote.py" unpack-pack \
+        --extract "$TMP_DIR/extract" \
+        --tar "$TMP_DIR/pack.tar" \
+        --pack "$PACK"
+      rm -f "$TMP_DIR/pack.age" "$TMP_DIR/pack.tar.zst" "$TMP_DIR/pack.tar"
+    done
+    python3 "$SCRIPT_DIR/restore_from_remote.py" validate \
+      --dest "$TMP_DIR/extract"
+    ;;
+  *)
+    python3 "$SCRIPT_DIR/restore_from_remote.py" extract-validate \
+      --tar "$TMP_DIR/backup.tar" \
+      --dest "$TMP_DIR/extract"
+    ;;
+esac
 
 echo "Stopping existing FastImg container if docker compose is available..."
 if docker compose version >/dev/null 2>&1 && [ -f "$PROJECT_DIR/docker-compose.yml" ]; then
@@ -123,6 +148,8 @@ fi
 ROLLBACK_DIR="$DATA_DIR/rollback/restore-$(date +%Y%m%d-%H%M%S)"
 mkdir -p "$ROLLBACK_DIR"
 if [ -f "$DATA_DIR/database.db" ]; then
+  # 应用使用 WAL，先把 -wal 中的提交合并进主文件再复制
+  python3 "$SCRIPT_DIR/restore_from_remote.py" checkpoint-db --db "$DATA_DIR/database.db"
   mkdir -p "$ROLLBACK_DIR/data"
   cp "$DATA_DIR/database.db" "$ROLLBACK_DIR/data/database.db"
 fi
@@ -137,6 +164,7 @@ mkdir -p "$UPLOADS_DIR"
 restore_rollback() {
   echo "Restore failed; rolling back local data copy..." >&2
   if [ -f "$ROLLBACK_DIR/data/database.db" ]; then
+    rm -f "$DATA_DIR/database.db-wal" "$DATA_DIR/database.db-shm"
     cp "$ROLLBACK_DIR/data/database.db" "$DATA_DIR/database.db"
   fi
   if [ -d "$ROLLBACK_DIR/uploads" ]; then
@@ -153,6 +181,7 @@ if ! (
   python3 "$SCRIPT_DIR/restore_from_remote.py" validate-db-uploads \
     --db "$TMP_DIR/extract/data/database.db" \
     --uploads "$UPLOADS_DIR"
+  rm -f "$DATA_DIR/database.db-wal" "$DATA_DIR/database.db-shm"
   cp "$TMP_DIR/extract/data/database.db" "$DATA_DIR/database.db"
   python3 "$SCRIPT_DIR/restore_from_remote.py" sanitize-db \
     --db "$DATA_DIR/database.db"
@@ -4,6 +4,7 @@ import base64
 import hashlib
 import json
 import os
+import shutil
 import sqlite3
 import tarfile
 from pathlib import Path
@@ -74,6 +75,21 @@ def upload_file_path(uploads_dir, filename):
     return os.path.join(uploads_dir, filename)
 
 
+def materialize_duplicates(uploads_dir, manifest):
+    for item in manifest.get("uploads", []):
+        source_name = item.get("same_as")
+        if not source_name:
+            continue
+        source = upload_file_path(uploads_dir, source_name)
+        dest = upload_file_path(uploads_dir, item["filename"])
+        if os.path.exists(dest) or not os.path.isfile(source):
+            continue
+        try:
+            os.link(source, dest)
+        except OSError:
+            shutil.copy2(source, dest)
+
+
 def validate(dest):
     manifest_path = os.path.join(dest, "manifest.json")
     db_path = os.path.join(dest, "data", "database.db")
@@ -84,6 +100,8 @@ def validate(dest):
     with open(manifest_path, "r", encoding="utf-8") as f:
         manifest = json.load(f)
 
+    materialize_duplicates(uploads_dir, manifest)
+
     if sha256_file(db_path) != manifest["database"]["sha256"]:
         raise SystemExit("Database checksum mismatch")
 
@@ -148,6 +166,9 @@ def sanitize_db(args):
                 SET active = 0, mode = NULL, reason = NULL, owner = NULL, started_at = NULL
                 WHERE id = 1
             """)
+            cur.execute("PRAGMA table_info(maintenance_state)")
+            if "pin_owner" in {row[1] for row in cur.fetchall()}:
+                cur.execute("UPDATE maintenance_state SET pin_owner = NULL, pinned_at = NULL WHERE id = 1")
         cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='backup_run'")
         if cur.fetchone():
             cur.execute("""
@@ -160,6 +181,20 @@ def sanitize_db(args):
         conn.close()
 
 
+def checkpoint_db(args):
+    """Fold any WAL left by the stopped app into the main file and switch it
+    back to a single-file journal, so it can be copied or replaced safely."""
+    db_path = args.db
+    if not os.path.isfile(db_path):
+        return
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("PRAGMA journal_mode = DELETE")
+    finally:
+        conn.close()
+
+
 def decrypt_identity(args):
     with open(args.input, "r", encoding="utf-8") as f:
         blob = f.read()
@@ -174,6 +209,47 @@ def extract_validate(args):
     validate(args.dest)
 
 
+def extract_only(args):
+    os.makedirs(args.dest, exist_ok=True)
+    safe_extract(args.tar, args.dest)
+
+
+def read_manifest(dest):
+    with open(os.path.join(dest, "manifest.json"), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def list_packs(args):
+    manifest = read_manifest(args.extract)
+    for name in manifest.get("packs", []):
+        if os.path.basename(name) != name or not name.endswith(".pack.age"):
+            raise SystemExit(f"Unsafe pack name in manifest: {name}")
+        print(name)
+
+
+def unpack_pack(args):
+    manifest = read_manifest(args.extract)
+    uploads_dir = os.path.join(args.extract, "uploads")
+    objects_root = os.path.join(args.extract, ".pack")
+    os.makedirs(uploads_dir, exist_ok=True)
+    os.makedirs(objects_root, exist_ok=True)
+    try:
+        safe_extract(args.tar, objects_root)
+        for item in manifest.get("uploads", []):
+            if item.get("pack") != args.pack or item.get("same_as"):
+                continue
+            source = os.path.join(objects_root, "objects", item["sha256"])
+            if not os.path.isfile(source):
+                raise SystemExit(f"Pack {args.pack} is missing object for {item['filename']}")
+            os.replace(source, upload_file_path(uploads_dir, item["filename"]))
+    finally:
+        shutil.rmtree(objects_root, ignore_errors=True)
+
+
+def validate_extract(args):
+    validate(args.dest)
+
+
 def write_env(args):
     env_snapshot = os.path.join(args.extract, "config", "fastimg-env.json")
     if not os.path.exists(env_snapshot):
@@ -216,6 +292,25 @@ def main():
     p.add_argument("--dest", required=True)
     p.set_defaults(func=extract_validate)
 
+    p = sub.add_parser("extract")
+    p.add_argument("--tar", required=True)
+    p.add_argument("--dest", required=True)
+    p.set_defaults(func=extract_only)
+
+    p = sub.add_parser("list-packs")
+    p.add_argument("--extract", required=True)
+    p.set_defaults(func=list_packs)
+
+    p = sub.add_parser("unpack-pack")
+    p.add_argument("--extract", required=True)
+    p.add_argument("--tar", required=True)
+    p.add_argument("--pack", required=True)
+    p.set_defaults(func=unpack_pack)
+
+    p = sub.add_parser("validate")
+    p.add_argument("--dest", required=True)
+    p.set_defaults(func=validate_extract)
+
     p = sub.add_parser("write-env")
     p.add_argument("--extract", required=True)
     p.add_argument("--env", required=True)
@@ -230,6 +325,10 @@ def main():
     p.add_argument("--db", required=True)
     p.set_defaults(func=sanitize_db)
 
+    p = sub.add_parser("checkpoint-db")
+    p.add_argument("--db", required=True)
+    p.set_defaults(func=checkpoint_db)
+
     p = sub.add_parser("unpack-kit")
     p.add_argument("--password", required=True)
     p.add_argument("--input", required=True)
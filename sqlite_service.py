@@ -0,0 +1,133 @@
+import threading
+import time
+
+from flask import current_app, g, has_request_context
+from sqlalchemy import create_engine, event
+from sqlalchemy.sql import Select
+
+from extensions import db
+
+
+READ_ENGINE_KEY = "fastimg_read_engine"
+
+_checkpoint_lock = threading.Lock()
+_checkpoint_started = False
+
+
+def sqlite_file(app):
+    uri = app.config.get("SQLALCHEMY_DATABASE_URI", "")
+    if not uri.startswith("sqlite:///") or ":memory:" in uri:
+        return None
+    return uri.replace("sqlite:///", "", 1)
+
+
+def _pragmas(app):
+    return [
+        f"PRAGMA busy_timeout = {int(app.config['SQLITE_BUSY_TIMEOUT_MS'])}",
+        "PRAGMA synchronous = NORMAL",
+        f"PRAGMA mmap_size = {int(app.config['SQLITE_MMAP_MB']) * 1024 * 1024}",
+        # 负数表示 KiB
+        f"PRAGMA cache_size = -{int(app.config['SQLITE_CACHE_MB']) * 1024}",
+        "PRAGMA temp_store = MEMORY",
+        "PRAGMA foreign_keys = OFF",
+    ]
+
+
+def _install_profile(engine, app, read_only=False):
+    pragmas = _pragmas(app)
+
+    @event.listens_for(engine, "connect")
+    def _on_connect(dbapi_conn, _record):
+        cur = dbapi_conn.cursor()
+        try:
+            if not read_only:
+                # journal_mode 是持久化在库文件里的，所有进程的连接都会跟着进入 WAL
+                cur.execute("PRAGMA journal_mode = WAL")
+            for pragma in pragmas:
+                cur.execute(pragma)
+            if read_only:
+                cur.execute("PRAGMA query_only = ON")
+        finally:
+            cur.close()
+
+
+def init_sqlite(app):
+    """Apply the SQLite profile to the app's engine and create the read-only
+    engine used by GET/HEAD requests. No-op for other databases."""
+    path = sqlite_file(app)
+    if not path or not app.config.get("SQLITE_PROFILE", True):
+        return
+    with app.app_context():
+        _install_profile(db.engine, app)
+        if app.config.get("SQLITE_READ_ENGINE", True):
+            read_engine = create_engine(
+                f"sqlite:///{path}",
+                pool_size=app.config.get("SQLITE_READ_POOL_SIZE", 8),
+                max_overflow=0,
+                pool_timeout=30,
+            )
+            _install_profile(read_engine, app, read_only=True)
+            app.extensions[READ_ENGINE_KEY] = read_engine
+
+
+def read_engine(app=None):
+    app = app or current_app
+    return app.extensions.get(READ_ENGINE_KEY)
+
+
+def dispose_engines(app):
+    """Close every pooled connection, e.g. before the DB file is replaced."""
+    db.session.remove()
+    db.engine.dispose()
+    engine = read_engine(app)
+    if engine is not None:
+        engine.dispose()
+
+
+def route_reads_for_request(method):
+    g.fastimg_read_only = method in ("GET", "HEAD")
+
+
+def reader_bind_for(session, clause):
+    """The read-only engine for a plain SELECT in a GET request that has not
+    written anything yet, else None (use the writer)."""
+    if not has_request_context() or not g.get("fastimg_read_only"):
+        return None
+    if session._flushing or session.info.get("fastimg_wrote"):
+        return None
+    if not isinstance(clause, Select):
+        return None
+    return read_engine()
+
+
+def checkpoint(app, mode="TRUNCATE"):
+    """Fold the WAL back into the main file. Returns SQLite's (busy, log, checkpointed)."""
+    if not sqlite_file(app):
+        return None
+    with app.app_context():
+        with db.engine.connect() as conn:
+            row = conn.exec_driver_sql(f"PRAGMA wal_checkpoint({mode})").fetchone()
+            conn.commit()
+    return tuple(row) if row else None
+
+
+def _checkpoint_loop(app, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            checkpoint(app)
+        except Exception as exc:
+            app.logger.warning(f"WAL checkpoint failed: {exc}")
+
+
+def start_wal_checkpointer(app):
+    global _checkpoint_started
+    interval = app.config.get("SQLITE_CHECKPOINT_INTERVAL", 0)
+    if interval <= 0 or not sqlite_file(app) or not app.config.get("SQLITE_PROFILE", True):
+        return
+    with _checkpoint_lock:
+        if _checkpoint_started:
+            return
+        _checkpoint_started = True
+        thread = threading.Thread(target=_checkpoint_loop, args=(app, interval), daemon=True)
+        thread.start()
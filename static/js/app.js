@@ -1,6 +1,7 @@
 // State
 let currentUser = null;
-let currentPage = 1;
+let nextImagesCursor = null; // 图库 keyset 分页游标，null 表示没有更多
+let loadingMoreImages = false;
 let currentImage = null;
 let csrfToken = null;
 
@@ -76,6 +77,11 @@ function setupScrollListener() {
         } else {
             dom.topBar.classList.remove('scrolled');
         }
+        // 无限滚动：接近底部时按游标加载下一批
+        if (nextImagesCursor && !dom.viewGallery.classList.contains('hidden')
+            && scrollEl.scrollTop + scrollEl.clientHeight >= scrollEl.scrollHeight - 600) {
+            loadMoreImages();
+        }
     });
 }
 
@@ -86,7 +92,7 @@ async function checkAuth() {
         if (res.ok) {
             currentUser = await res.json();
             updateUI(true);
-            loadImages(1);
+            loadImages();
         } else {
             updateUI(false);
         }
@@ -203,9 +209,8 @@ function switchView(viewName, resetFilter = false) {
         if (resetFilter) {
             filterUserId = null;
             filterUsername = null;
-            currentPage = 1;
         }
-        loadImages(currentPage);
+        loadImages();
     } else if (viewName === 'upload') {
         dom.viewUpload.classList.remove('hidden');
         loadMaxQuality();
@@ -231,21 +236,29 @@ let lastLoadImagesTimestamp = 0;
 
 window.openFolder = function(id) {
     currentFolderId = id;
-    loadImages(1);
+    loadImages();
 };
 
-async function loadImages(page) {
-    const timestamp = Date.now();
-    lastLoadImagesTimestamp = timestamp;
+const IMAGES_PAGE_SIZE = 40;
 
-    currentPage = page;
+function imagesQueryUrl() {
     const sort = currentSort.split('_');
     const sortBy = sort[0]; // time, size, name
     const sortOrder = sort[1]; // asc, desc
 
-    let url = `/api/images?page=${page}&sort=${sortBy}&order=${sortOrder}`;
+    let url = `/api/images?sort=${sortBy}&order=${sortOrder}&limit=${IMAGES_PAGE_SIZE}`;
+    if (filterUserId) url += `&user_id=${filterUserId}`;
+    if (currentFolderId) url += `&folder_id=${currentFolderId}`;
+    return url;
+}
+
+async function loadImages() {
+    const timestamp = Date.now();
+    lastLoadImagesTimestamp = timestamp;
+    nextImagesCursor = null;
+
+    let url = imagesQueryUrl();
     if (filterUserId) {
-        url += `&user_id=${filterUserId}`;
         // Show indicator that we are filtering
         const header = document.querySelector('.gallery-header h2');
         if (header && !header.originalText) header.originalText = header.innerText;
@@ -260,10 +273,6 @@ async function loadImages(page) {
     dom.galleryGrid.style.pointerEvents = 'none'; // Prevent clicks while loading
 
     try {
-        if (currentFolderId) {
-            url += `&folder_id=${currentFolderId}`;
-        }
-
         const res = await fetch(url);
         if (timestamp !== lastLoadImagesTimestamp) return;
 
@@ -344,83 +353,110 @@ async function loadImages(page) {
         data.images.forEach(img => img._virtualName = prefix + img.original_name);
 
         loadedImages = data.images; // Cache for multi-select
+        renderImageCards(data.images);
+
+        // Update Stats
+        document.getElementById('statTotal').innerText = `${data.total} 张图片`;
+
+        nextImagesCursor = data.next_cursor || null;
+        updateLoadMore();
+
+        // Refresh icons
+        refreshIcons();
+    } catch (e) {
+        if (timestamp !== lastLoadImagesTimestamp) return;
+        dom.galleryGrid.style.opacity = '1';
+        dom.galleryGrid.style.pointerEvents = 'auto';
+        console.error(e);
+    }
+}
 
-        data.images.forEach((img, index) => {
-            const div = document.createElement('div');
-            div.className = 'img-card';
-            div.dataset.imgId = img.id;
+function renderImageCards(images) {
+    images.forEach((img, index) => {
+        const div = document.createElement('div');
+        div.className = 'img-card';
+        div.dataset.imgId = img.id;
 
-            const sizeStr = img.size > 1024 * 1024
-                ? (img.size / (1024 * 1024)).toFixed(1) + ' MB'
-                : (img.size / 1024).toFixed(1) + ' KB';
+        const sizeStr = img.size > 1024 * 1024
+            ? (img.size / (1024 * 1024)).toFixed(1) + ' MB'
+            : (img.size / 1024).toFixed(1) + ' KB';
 
-            const isSelected = selectedImages.has(img.id);
+        const isSelected = selectedImages.has(img.id);
 
-            const safeName = escapeHtml(img.original_name);
-            const safeVirtualName = escapeHtml(img._virtualName);
+        const safeName = escapeHtml(img.original_name);
+        const safeVirtualName = escapeHtml(img._virtualName);
 
-            div.innerHTML = `
-            ${isSelectMode ? `<div class="img-select-check ${isSelected ? 'checked' : ''}" data-id="${img.id}"><i data-lucide="check"></i></div>` : ''}
-            <img src="/i/${img.filename}" loading="lazy" decoding="async" alt="${safeName}" style="transform:translateZ(0)" onload="this.parentNode.classList.add('loaded')">
-            <div class="img-overlay">
-                <div class="overlay-top">
-                    <button class="overlay-btn" onclick="event.stopPropagation();showDetail(loadedImages.find(i=>i.id===${img.id}))" title="详情">
-                        <i data-lucide="more-horizontal" style="width:18px;height:18px"></i>
-                    </button>
-                </div>
-                <div class="overlay-bottom">
-                    <div style="min-width:0;flex:1">
-                        <div class="img-name">${safeName}</div>
-                        <div class="img-meta">
-                            <span>${sizeStr}</span>
-                            <span>${img.width}×${img.height}</span>
-                        </div>
-                    </div>
-                    <div style="display:flex;gap:0.5rem;flex-shrink:0">
-                        <button class="overlay-btn" onclick="event.stopPropagation();copyImageLink('${img.filename}', '${safeVirtualName}')" title="拷贝链接">
-                            <i data-lucide="link-2" style="width:16px;height:16px"></i>
-                        </button>
-                        <button class="overlay-btn overlay-btn-danger" onclick="event.stopPropagation();quickDelete(${img.id})" title="删除">
-                            <i data-lucide="trash-2" style="width:16px;height:16px"></i>
-                        </button>
+        div.innerHTML = `
+        ${isSelectMode ? `<div class="img-select-check ${isSelected ? 'checked' : ''}" data-id="${img.id}"><i data-lucide="check"></i></div>` : ''}
+        <img src="/t/256/${img.filename}" srcset="/t/256/${img.filename} 256w, /t/1024/${img.filename} 1024w" sizes="(min-width: 1024px) 20vw, (min-width: 768px) 33vw, 50vw" loading="lazy" decoding="async" alt="${safeName}" style="transform:translateZ(0)" onload="this.parentNode.classList.add('loaded')">
+        <div class="img-overlay">
+            <div class="overlay-top">
+                <button class="overlay-btn" onclick="event.stopPropagation();showDetail(loadedImages.find(i=>i.id===${img.id}))" title="详情">
+                    <i data-lucide="more-horizontal" style="width:18px;height:18px"></i>
+                </button>
+            </div>
+            <div class="overlay-bottom">
+                <div style="min-width:0;flex:1">
+                    <div class="img-name">${safeName}</div>
+                    <div class="img-meta">
+                        <span>${sizeStr}</span>
+                        <span>${img.width}×${img.height}</span>
                     </div>
                 </div>
+                <div style="display:flex;gap:0.5rem;flex-shrink:0">
+                    <button class="overlay-btn" onclick="event.stopPropagation();copyImageLink('${img.filename}', '${safeVirtualName}')" title="拷贝链接">
+                        <i data-lucide="link-2" style="width:16px;height:16px"></i>
+                    </button>
+                    <button class="overlay-btn overlay-btn-danger" onclick="event.stopPropagation();quickDelete(${img.id})" title="删除">
+                        <i data-lucide="trash-2" style="width:16px;height:16px"></i>
+                    </button>
+                </div>
             </div>
-        `;
-            if (isSelectMode) {
-                if (isSelected) div.classList.add('selected');
-                div.onclick = () => toggleImageSelect(img);
-            } else {
-                div.onclick = () => showDetail(img);
-            }
-            dom.galleryGrid.appendChild(div);
-        });
-
-        // Update Stats
-        document.getElementById('statTotal').innerText = `${data.total} 张图片`;
-
-        // Pagination Controls
-        const pag = document.getElementById('pagination');
-        if (data.pages > 1) {
-            pag.classList.remove('hidden');
-            document.getElementById('pageIndicator').innerText = `${data.current_page} / ${data.pages}`;
+        </div>
+    `;
+        if (isSelectMode) {
+            if (isSelected) div.classList.add('selected');
+            div.onclick = () => toggleImageSelect(img);
         } else {
-            pag.classList.add('hidden');
+            div.onclick = () => showDetail(img);
         }
+        dom.galleryGrid.appendChild(div);
+    });
+}
 
-        // Refresh icons
+function updateLoadMore() {
+    const pag = document.getElementById('pagination');
+    if (pag) pag.classList.toggle('hidden', !nextImagesCursor);
+}
+
+async function loadMoreImages() {
+    if (!nextImagesCursor || loadingMoreImages) return;
+    loadingMoreImages = true;
+    const timestamp = lastLoadImagesTimestamp;
+    const prefix = window.currentFolderPath || '';
+    try {
+        const res = await fetch(`${imagesQueryUrl()}&cursor=${encodeURIComponent(nextImagesCursor)}`);
+        if (timestamp !== lastLoadImagesTimestamp) return;
+        if (!res.ok) throw new Error('加载失败');
+        const data = await res.json();
+        if (timestamp !== lastLoadImagesTimestamp) return;
+
+        data.images.forEach(img => img._virtualName = prefix + img.original_name);
+        loadedImages = loadedImages.concat(data.images);
+        renderImageCards(data.images);
+        nextImagesCursor = data.next_cursor || null;
+        updateLoadMore();
         refreshIcons();
     } catch (e) {
-        if (timestamp !== lastLoadImagesTimestamp) return;
-        dom.galleryGrid.style.opacity = '1';
-        dom.galleryGrid.style.pointerEvents = 'auto';
         console.error(e);
+    } finally {
+        loadingMoreImages = false;
     }
 }
 
 function changeSortOrder() {
     currentSort = document.getElementById('sortSelect').value;
-    loadImages(1); // Reset to first page when sorting changes
+    loadImages(); // Reset to the first batch when sorting changes
 }
 
 function setViewMode(mode) {
@@ -438,14 +474,6 @@ function setViewMode(mode) {
     }
 }
 
-function prevPage() {
-    if (currentPage > 1) loadImages(currentPage - 1);
-}
-function nextPage() {
-    const totalPages = parseInt(document.getElementById('pageIndicator')?.textContent?.split('/')[1]) || 1;
-    if (currentPage < totalPages) loadImages(currentPage + 1);
-}
-
 // --- Upload ---
 let uploadQueue = [];
 let isUploading = false;
@@ -638,13 +666,135 @@ async function uploadFiles(files) {
     processQueue();
 }
 
-async function processQueue() {
+// 多个文件合并成一次 /api/upload/batch 请求，单批文件数和总大小都有上限
+const UPLOAD_BATCH_FILES = 20;
+const UPLOAD_BATCH_BYTES = 48 * 1024 * 1024;
+
+function uploadPathFor(file) {
+    // Path of the file inside a dropped folder, without the file name
+    if (!file.webkitRelativePath) return '';
+    const parts = file.webkitRelativePath.split('/');
+    parts.pop();
+    return parts.join('/');
+}
+
+function nextUploadGroup() {
+    const first = uploadQueue.find(u => u.status === 'pending');
+    if (!first) return [];
+    const group = [first];
+    let bytes = first.file.size;
+    for (const u of uploadQueue) {
+        if (group.length >= UPLOAD_BATCH_FILES) break;
+        if (u === first || u.status !== 'pending') continue;
+        if (u.quality !== first.quality || u.passthrough !== first.passthrough) continue;
+        if (bytes + u.file.size > UPLOAD_BATCH_BYTES) continue;
+        group.push(u);
+        bytes += u.file.size;
+    }
+    return group;
+}
+
+function processQueue() {
     if (isUploading) return;
 
-    const pending = uploadQueue.find(u => u.status === 'pending');
-    if (!pending) return;
+    const group = nextUploadGroup();
+    if (group.length === 0) return;
 
     isUploading = true;
+    if (group.length === 1) {
+        uploadSingle(group[0]);
+    } else {
+        uploadBatch(group);
+    }
+}
+
+function setUploadItemState(item, text, color, percent) {
+    const el = document.getElementById(item.id);
+    const statusEl = el?.querySelector('.upload-status');
+    const progressEl = el?.querySelector('.progress-bar-fill');
+    if (statusEl) {
+        statusEl.textContent = text;
+        if (color) statusEl.style.color = color;
+    }
+    if (progressEl && percent !== undefined) progressEl.style.width = `${percent}%`;
+    if (progressEl && color === 'var(--danger)') progressEl.style.backgroundColor = 'var(--danger)';
+}
+
+function uploadBatch(group) {
+    group.forEach(item => {
+        item.status = 'uploading';
+        setUploadItemState(item, '准备上传...');
+    });
+
+    const formData = new FormData();
+    group.forEach(item => {
+        formData.append('file', item.file);
+        formData.append('path', uploadPathFor(item.file));
+    });
+    formData.append('quality', group[0].quality);
+    if (group[0].passthrough) {
+        formData.append('passthrough', 'true');
+    }
+    if (currentFolderId) {
+        formData.append('folder_id', currentFolderId);
+    }
+
+    const xhr = new XMLHttpRequest();
+
+    xhr.upload.onprogress = (e) => {
+        if (!e.lengthComputable) return;
+        const percent = (e.loaded / e.total) * 100;
+        group.forEach(item => setUploadItemState(
+            item, percent < 100 ? `上传中 ${Math.round(percent)}%` : '服务器处理中...', null, percent
+        ));
+    };
+
+    const failAll = (message) => {
+        group.forEach(item => {
+            item.status = 'error';
+            setUploadItemState(item, message, 'var(--danger)');
+        });
+    };
+
+    xhr.onload = () => {
+        let data = null;
+        try { data = JSON.parse(xhr.responseText); } catch (e) { }
+
+        if (data && Array.isArray(data.results)) {
+            data.results.forEach((result, idx) => {
+                const item = group[idx];
+                if (!item) return;
+                if (result && result.ok) {
+                    item.status = 'done';
+                    item.result = result.image;
+                    setUploadItemState(item, '完成', 'var(--success)', 100);
+                } else {
+                    item.status = 'error';
+                    setUploadItemState(item, (result && result.error) || '失败', 'var(--danger)');
+                }
+            });
+        } else {
+            failAll((data && data.error) || '失败');
+        }
+
+        isUploading = false;
+        checkNext();
+    };
+
+    xhr.onerror = () => {
+        failAll('网络中断');
+        isUploading = false;
+        checkNext();
+    };
+
+    xhr.open('POST', '/api/upload/batch');
+    if (csrfToken) {
+        xhr.setRequestHeader('X-CSRFToken', csrfToken);
+    }
+    xhr.send(formData);
+}
+
+function uploadSingle(pending) {
     pending.status = 'uploading';
 
     const el = document.getElementById(pending.id);
@@ -666,12 +816,9 @@ async function processQueue() {
     }
 
     // Add path if it's a folder upload
-    if (pending.file.webkitRelativePath) {
-        const parts = pending.file.webkitRelativePath.split('/');
-        if (parts.length > 1) {
-            parts.pop(); // remove filename
-            formData.append('path', parts.join('/'));
-        }
+    const uploadPath = uploadPathFor(pending.file);
+    if (uploadPath) {
+        formData.append('path', uploadPath);
     }
 
     // Use XHR for progress events
@@ -757,7 +904,7 @@ function checkNext() {
     } else {
         // All done
         if (doneCount > 0) {
-            loadImages(1); // Refresh gallery
+            loadImages(); // Refresh gallery
         }
 
         if (batchModalActive) {
@@ -932,7 +1079,10 @@ function setupEventListeners() {
 // --- Detail Modal ---
 function showDetail(img) {
     currentImage = img;
-    document.getElementById('detailImg').src = `/i/${img.filename}`;
+    // 详情预览用 1024 缩略图；GIF 缩略图只有首帧，仍显示原图
+    document.getElementById('detailImg').src = img.mime_type === 'image/gif'
+        ? `/i/${img.filename}`
+        : `/t/1024/${img.filename}`;
     document.getElementById('detailTitle').innerText = img.original_name;
     document.getElementById('detailSize').innerText = (img.size / 1024).toFixed(1) + ' KB';
     document.getElementById('detailDims').innerText = `${img.width} x ${img.height}`;
@@ -950,7 +1100,7 @@ async function deleteCurrentImg() {
     const res = await fetch(`/api/images/${currentImage.id}`, { method: 'DELETE' });
     if (res.ok) {
         closeModal('detailModal');
-        loadImages(currentPage);
+        loadImages();
         showToast('已删除');
     }
 }
@@ -971,6 +1121,8 @@ const CONFIG_META = {
     // 图片处理
     'compress_quality': { group: 'process', label: '压缩质量限制', desc: '上传时自动压缩的目标质量 (10-100)', type: 'range', min: 10, max: 100 },
     'ENABLE_WEBP_CONVERT': { group: 'process', label: '自动转 WebP', desc: '自动将上传的 JPG/PNG 转换为 WebP 以节省空间', type: 'switch' },
+    'ENABLE_FORMAT_VARIANTS': { group: 'process', label: 'WebP/AVIF 按需分发', desc: 'JPG/PNG 保留原格式，后台额外生成 WebP（及服务器支持时的 AVIF）副本，按浏览器 Accept 头返回最小的可用格式；开启后「自动转 WebP」对 JPG/PNG 不再生效', type: 'switch' },
+    'ENABLE_GIF_WEBP_CONVERT': { group: 'process', label: '动图转 WebP', desc: '将上传的 GIF（含动图）转码为动态 WebP，通常可减小 50% 以上；转码后更大或动图过长时保留原 GIF', type: 'switch' },
     'WATERMARK_TEXT': { group: 'process', label: '水印文字', desc: '留空则不添加水印', type: 'text' },
     'WATERMARK_OPACITY': { group: 'process', label: '水印透明度', desc: '0 (透明) - 255 (不透明)', type: 'range', min: 0, max: 255 },
     'WATERMARK_SIZE': { group: 'process', label: '水印字体基准', desc: '基准像素值，会自动按比例缩放', type: 'number' },
@@ -978,13 +1130,18 @@ const CONFIG_META = {
     // 访问限流
     'rate_limit_global': { group: 'ratelimit', label: '全局每日请求上限', desc: '同一 IP 每天最大请求数，0 = 不限', type: 'number', unit: '' },
     'rate_limit_per_image': { group: 'ratelimit', label: '单图片每日访问上限', desc: '单张图片每天最大被访问次数，0 = 不限', type: 'number', unit: '' },
+
+    // 分发缓存
+    'IMAGE_CACHE_IMMUTABLE': { group: 'delivery', label: '长期缓存外链图片', desc: '为 /i/ 和 /t/ 返回 public, immutable 缓存头，浏览器与 CDN 不再回源校验；删除的图片可能在缓存中保留到过期', type: 'switch' },
+    'IMAGE_CACHE_MAX_AGE': { group: 'delivery', label: '缓存时长', desc: '单位: 秒。默认 31536000（一年）', type: 'number', unit: '秒' },
 };
 
 const CONFIG_GROUPS = {
     'basic': '基础设置',
     'upload': '上传控制',
     'process': '图片处理',
-    'ratelimit': '访问限流'
+    'ratelimit': '访问限流',
+    'delivery': '分发缓存'
 };
 
 async function showAdminModal() {
@@ -1162,7 +1319,7 @@ function viewUserFiles(userId, username) {
     filterUserId = userId;
     filterUsername = username;
     switchView('gallery');
-    loadImages(1);
+    loadImages();
 }
 
 async function changeUserPassword(userId) {
@@ -1600,7 +1757,7 @@ function toggleSelectMode() {
         selectedImages.clear();
     }
     // Re-render gallery to show/hide checkboxes
-    loadImages(currentPage);
+    loadImages();
 }
 
 function toggleImageSelect(img) {
@@ -1610,7 +1767,7 @@ function toggleImageSelect(img) {
         selectedImages.set(img.id, { filename: img.filename, original_name: img.original_name });
     }
     updateSelectUI();
-    loadImages(currentPage);
+    loadImages();
 }
 
 function updateSelectUI() {
@@ -1620,7 +1777,7 @@ function updateSelectUI() {
 function clearSelection() {
     selectedImages.clear();
     updateSelectUI();
-    loadImages(currentPage);
+    loadImages();
 }
 
 // --- Drag-to-Select (Rubber Band) ---
@@ -1722,7 +1879,7 @@ function clearSelection() {
                     if (bar) bar.classList.remove('hidden');
                 }
                 updateSelectUI();
-                loadImages(currentPage);
+                loadImages();
             }
         }
 
@@ -1762,6 +1919,29 @@ function copySelectedLinks() {
     });
 }
 
+async function deleteSelectedImages() {
+    if (selectedImages.size === 0) {
+        showToast('请先选择至少一张图片', 'error');
+        return;
+    }
+    if (!confirm(`确定删除选中的 ${selectedImages.size} 张图片?`)) return;
+    const res = await fetch('/api/images/bulk-delete', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ ids: Array.from(selectedImages.keys()) })
+    });
+    const data = await res.json().catch(() => ({}));
+    if (!res.ok) {
+        showToast(data.error || '删除失败', 'error');
+        return;
+    }
+    selectedImages.clear();
+    updateSelectUI();
+    loadImages();
+    loadSidebarStorage();
+    showToast(`已删除 ${data.deleted} 张图片`);
+}
+
 // --- Icon Refresh (Lucide) ---
 function refreshIcons() {
     if (window.lucide) lucide.createIcons();
@@ -1810,7 +1990,7 @@ async function quickDelete(imgId) {
     const res = await fetch(`/api/images/${imgId}`, { method: 'DELETE' });
     if (res.ok) {
         showToast('已删除');
-        loadImages(currentPage);
+        loadImages();
     } else {
         showToast('删除失败', 'error');
     }
@@ -1880,6 +2060,7 @@ async function loadAdminView() {
     // Load invites section in parallel
     loadInlineInvites();
     loadBackupPanel();
+    loadUploadTimings();
 
     try {
         const res = await fetch('/api/admin/users');
@@ -1996,6 +2177,44 @@ async function loadAdminView() {
     }
 }
 
+// 最近上传的分阶段耗时 (各 worker 汇总)，按 源格式->输出格式 分组
+async function loadUploadTimings() {
+    const panel = document.getElementById('uploadTimingPanel');
+    if (!panel) return;
+    try {
+        const res = await fetch('/api/admin/upload-timings');
+        const data = await res.json();
+        if (!res.ok) throw new Error(data.error || '加载失败');
+        if (!data.formats.length) {
+            panel.innerHTML = '<div style="text-align:center;padding:1.5rem;color:var(--text-muted)">暂无上传记录</div>';
+            return;
+        }
+        const ms = v => v == null ? '-' : (v >= 1000 ? (v / 1000).toFixed(2) + ' s' : v.toFixed(1) + ' ms');
+        const kb = v => v == null ? '-' : (v > 1024 * 1024 ? (v / (1024 * 1024)).toFixed(1) + ' MB' : (v / 1024).toFixed(1) + ' KB');
+        const cells = p => p ? `<td>${ms(p.p50)}</td><td>${ms(p.p95)}</td><td>${ms(p.p99)}</td>` : '<td>-</td><td>-</td><td>-</td>';
+        const rows = data.formats.map(f => {
+            const mp = f.pixels ? (f.pixels.p50 / 1e6).toFixed(1) + ' MP' : '-';
+            const head = `
+                <tr>
+                    <td rowspan="${f.stages.length + 1}" style="vertical-align:top">
+                        <div style="font-weight:600">${escapeHtml(f.format)}</div>
+                        <div style="font-size:0.75rem;color:var(--text-muted)">${f.count} 次 · ${mp} · ${kb(f.input_bytes && f.input_bytes.p50)} → ${kb(f.output_bytes && f.output_bytes.p50)}</div>
+                    </td>
+                    <td style="font-weight:600">总计</td>${cells(f.total_ms)}
+                </tr>`;
+            return head + f.stages.map(st => `<tr><td>${escapeHtml(st.stage)}</td>${cells(st)}</tr>`).join('');
+        }).join('');
+        panel.innerHTML = `
+            <table class="data-table">
+                <thead><tr><th>格式 (中位数像素 / 大小)</th><th>阶段</th><th>p50</th><th>p95</th><th>p99</th></tr></thead>
+                <tbody>${rows}</tbody>
+            </table>
+            <div style="padding:0.75rem 1.5rem;font-size:0.75rem;color:var(--text-muted)">每个进程保留每种格式最近 ${data.window} 次上传</div>`;
+    } catch (e) {
+        panel.innerHTML = `<div style="text-align:center;padding:1.5rem;color:var(--text-muted)">${escapeHtml(e.message || '加载失败')}</div>`;
+    }
+}
+
 async function loadBackupPanel(options = {}) {
     const panel = document.getElementById('backupPanel');
     const badge = document.getElementById('backupStatusBadge');
@@ -2317,6 +2536,13 @@ function renderBackupPanel(config, provider, tools, runs, remoteFiles, maintenan
                         <input id="backupTimezone" class="input-control" value="${escapeAttr(config.timezone || 'Asia/Shanghai')}">
                     </div>
                 </div>
+                <div class="form-group" style="margin-bottom:0.85rem">
+                    <label>备份方式</label>
+                    <select id="backupMode" class="input-control">
+                        <option value="full" ${config.backup_mode !== 'incremental' ? 'selected' : ''}>完整备份（每次打包全部文件）</option>
+                        <option value="incremental" ${config.backup_mode === 'incremental' ? 'selected' : ''}>增量备份（只上传新增文件）</option>
+                    </select>
+                </div>
                 <label class="checkbox-label" style="display:flex;align-items:center;gap:0.5rem;margin-bottom:0.85rem">
                     <input id="backupEnabled" type="checkbox" ${config.enabled ? 'checked' : ''}>
                     启用定时备份
@@ -2458,6 +2684,7 @@ function backupStageLabel(stage, trigger) {
         encrypting: '压缩加密',
         uploading_identity: '上传恢复身份',
         creating_remote_dir: '准备远端目录',
+        uploading_packs: '上传增量包',
         uploading_backup: '上传密文包',
         retention: '清理旧备份',
         done: '完成',
@@ -2467,7 +2694,8 @@ function backupStageLabel(stage, trigger) {
         queued: '排队中',
         preparing_restore: '准备恢复',
         downloading_identity: '下载身份',
-        downloading_backup: '下载备份',
+        downloading_backup: '下载并解包',
+        downloading_packs: '下载增量包',
         decrypting: '解密',
         decompressing: '解压',
         validating: '校验',
@@ -2593,7 +2821,8 @@ async function saveBackupConfig() {
         enabled: document.getElementById('backupEnabled')?.checked || false,
         schedule_time: document.getElementById('backupScheduleTime')?.value || '03:30',
         timezone: document.getElementById('backupTimezone')?.value || 'Asia/Shanghai',
-        retention_count: parseInt(document.getElementById('backupRetention')?.value || '7', 10)
+        retention_count: parseInt(document.getElementById('backupRetention')?.value || '7', 10),
+        backup_mode: document.getElementById('backupMode')?.value || 'full'
     };
     const res = await fetch('/api/admin/backups/config', {
         method: 'POST',
@@ -3071,35 +3300,34 @@ async function copyFolderLinks(folderId, folderName) {
     closeFolderMenus();
 
     let allImages = [];
-    let page = 1;
-    let totalPages = 1;
+    let cursor = null;
 
     showToast(`正在收集「${folderName}」的链接...`);
 
     try {
-        while (page <= totalPages) {
-            let url = `/api/images?page=${page}&sort=name&order=asc&folder_id=${folderId}`;
+        let prefix = '';
+        do {
+            let url = `/api/images?sort=name&order=asc&limit=100&folder_id=${folderId}`;
             if (filterUserId) url += `&user_id=${filterUserId}`;
+            if (cursor) url += `&cursor=${encodeURIComponent(cursor)}`;
 
             const res = await fetch(url);
             if (!res.ok) throw new Error('请求失败');
             const data = await res.json();
 
-            totalPages = data.pages;
+            cursor = data.next_cursor || null;
 
-            // Build path prefix from breadcrumbs
-            const pathStr = data.breadcrumbs
-                ? data.breadcrumbs.map(b => b.name).filter(n => n !== '首页').join('/')
-                : '';
-            const prefix = pathStr ? pathStr + '/' : '';
+            // Build path prefix from breadcrumbs (only on the first batch)
+            if (data.breadcrumbs) {
+                const pathStr = data.breadcrumbs.map(b => b.name).filter(n => n !== '首页').join('/');
+                prefix = pathStr ? pathStr + '/' : '';
+            }
 
             data.images.forEach(img => {
                 const displayName = prefix + img.original_name;
                 allImages.push(`![${displayName}](${window.location.origin}/i/${img.filename})`);
             });
-
-            page++;
-        }
+        } while (cursor);
 
         if (allImages.length === 0) {
             showToast(`「${folderName}」中没有图片`, 'error');
@@ -0,0 +1,225 @@
+import atexit
+import threading
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from sqlalchemy import bindparam, case, func
+
+from extensions import db
+from models import Image, ImageStat
+
+
+_counter_lock = threading.Lock()
+_flusher_started = False
+
+# /i/ 一次请求需要的图片行字段：计数、ETag 和格式副本协商共用
+ImageEntry = namedtuple('ImageEntry', ['id', 'filename', 'content_hash', 'variants', 'day_date', 'day_count'])
+
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+
+class ViewCounter:
+    """进程内的访问计数聚合器。
+
+    /i/ 热路径只在内存里累加，由后台线程每 flush_interval 秒或累计
+    flush_events 次访问后，用一条批量 UPDATE 写回 image_stat。
+    """
+
+    def __init__(self, flush_interval=5.0, flush_events=1000):
+        self.flush_interval = flush_interval
+        self.flush_events = flush_events
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        # image_id -> {'views', 'day', 'day_views', 'first_view', 'last_view', 'referer'}
+        self._pending = {}
+        self._pending_events = 0
+        # filename -> ImageEntry，每次 flush 后清空以重新读取其他 worker 的计数和图片行
+        self._lookup = {}
+
+    def lookup(self, filename):
+        """The ImageEntry of filename, or None if no image has that name.
+        Cached until the next flush, so /i/ resolves each image at most once
+        per flush interval."""
+        with self._lock:
+            cached = self._lookup.get(filename)
+        if cached is not None:
+            return cached
+        row = db.session.query(Image.id, Image.content_hash, Image.variants, ImageStat.day_date, ImageStat.day_count)\
+            .outerjoin(ImageStat, ImageStat.image_id == Image.id)\
+            .filter(Image.filename == filename)\
+            .first()
+        if not row:
+            return None
+        entry = ImageEntry(row[0], filename, row[1], row[2], row[3], row[4] or 0)
+        with self._lock:
+            self._lookup[filename] = entry
+        return entry
+
+    def hit(self, filename, referer=None, daily_limit=0):
+        """记录一次访问。返回 None 表示图片不存在，False 表示超过单图每日上限。"""
+        entry = self.lookup(filename)
+        if entry is None:
+            return None
+        image_id, day_date, day_count = entry.id, entry.day_date, entry.day_count
+        now = utcnow()
+        today = now.strftime("%Y-%m-%d")
+        baseline = day_count if day_date == today else 0
+
+        with self._lock:
+            pending = self._pending.get(image_id)
+            local_today = pending['day_views'] if pending and pending['day'] == today else 0
+            if daily_limit > 0 and baseline + local_today >= daily_limit:
+                return False
+
+            if pending is None:
+                pending = {
+                    'views': 0,
+                    'day': today,
+                    'day_views': 0,
+                    'first_view': now,
+                    'last_view': now,
+                    'referer': None,
+                }
+                self._pending[image_id] = pending
+            if pending['day'] != today:
+                pending['day'] = today
+                pending['day_views'] = 0
+            pending['views'] += 1
+            pending['day_views'] += 1
+            pending['last_view'] = now
+            if referer:
+                pending['referer'] = referer[:256]
+            self._pending_events += 1
+            should_wake = self._pending_events >= self.flush_events
+
+        if should_wake:
+            self._wakeup.set()
+        return True
+
+    def pending_count(self):
+        with self._lock:
+            return self._pending_events
+
+    def discard(self):
+        """丢弃尚未写回的计数（例如数据库被恢复替换之后）。"""
+        with self._lock:
+            self._pending = {}
+            self._pending_events = 0
+            self._lookup = {}
+
+    def _drain(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._pending_events = 0
+            self._lookup = {}
+        return pending
+
+    def flush(self):
+        """把缓冲的计数用一次 executemany UPDATE 写回数据库，返回写回的图片数。"""
+        pending = self._drain()
+        if not pending:
+            return 0
+
+        rows = [
+            {
+                'b_image_id': image_id,
+                'b_views': item['views'],
+                'b_day': item['day'],
+                'b_day_views': item['day_views'],
+                'b_first_view': item['first_view'],
+                'b_last_view': item['last_view'],
+                'b_referer': item['referer'],
+            }
+            for image_id, item in pending.items()
+        ]
+        stat = ImageStat.__table__
+        stmt = stat.update().\
+            where(stat.c.image_id == bindparam('b_image_id')).\
+            values(
+                view_count=func.coalesce(stat.c.view_count, 0) + bindparam('b_views'),
+                day_count=case(
+                    (stat.c.day_date == bindparam('b_day'), func.coalesce(stat.c.day_count, 0) + bindparam('b_day_views')),
+                    else_=bindparam('b_day_views'),
+                ),
+                day_date=bindparam('b_day'),
+                first_view=func.coalesce(stat.c.first_view, bindparam('b_first_view', type_=stat.c.first_view.type)),
+                last_view=bindparam('b_last_view', type_=stat.c.last_view.type),
+                last_referer=func.coalesce(bindparam('b_referer'), stat.c.last_referer),
+            )
+        try:
+            db.session.execute(stmt, rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            self._requeue(pending)
+            raise
+        return len(rows)
+
+    def _requeue(self, pending):
+        with self._lock:
+            for image_id, item in pending.items():
+                current = self._pending.get(image_id)
+                if current is None:
+                    self._pending[image_id] = item
+                    continue
+                current['views'] += item['views']
+                if current['day'] == item['day']:
+                    current['day_views'] += item['day_views']
+                current['first_view'] = min(current['first_view'], item['first_view'])
+                current['referer'] = current['referer'] or item['referer']
+            self._pending_events += sum(item['views'] for item in pending.values())
+
+    def wait(self):
+        self._wakeup.wait(self.flush_interval)
+        self._wakeup.clear()
+
+
+view_counter = ViewCounter()
+
+
+def flush_view_counts(app):
+    from backup_service import current_maintenance
+
+    with app.app_context():
+        try:
+            # 维护期间保持缓冲，等快照/恢复结束后再写回
+            if current_maintenance():
+                return 0
+            return view_counter.flush()
+        finally:
+            db.session.remove()
+
+
+def flusher_loop(app):
+    with app.app_context():
+        app.logger.info("FastImg view counter flusher started")
+    while True:
+        view_counter.wait()
+        try:
+            flush_view_counts(app)
+        except Exception:
+            with app.app_context():
+                app.logger.exception("View counter flush failed")
+
+
+def start_view_counter(app):
+    global _flusher_started
+    with _counter_lock:
+        if _flusher_started:
+            return
+        _flusher_started = True
+        view_counter.flush_interval = app.config.get("VIEW_COUNT_FLUSH_INTERVAL", 5.0)
+        view_counter.flush_events = app.config.get("VIEW_COUNT_FLUSH_EVENTS", 1000)
+        thread = threading.Thread(target=flusher_loop, args=(app,), daemon=True)
+        thread.start()
+        atexit.register(_flush_at_exit, app)
+
+
+def _flush_at_exit(app):
+    try:
+        flush_view_counts(app)
+    except Exception:
+        pass
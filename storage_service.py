@@ -0,0 +1,146 @@
+import os
+import uuid
+from datetime import datetime, timezone
+
+from sqlalchemy import func, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from extensions import db
+from backup_service import upload_files_pinned
+from models import Blob, DeferredDelete, Image
+from utils import file_sha256, remove_upload_files
+
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+
+def _replace_with_link(source, path):
+    """Atomically swap path for a hard link to source. Returns False when the
+    filesystem cannot link (the upload then simply keeps its own copy)."""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.link"
+    try:
+        if os.path.getsize(source) != os.path.getsize(path):
+            return False
+        os.link(source, tmp_path)
+        os.replace(tmp_path, path)
+        return True
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+
+def register_upload(meta, upload_folder):
+    """Attach a freshly stored upload to the blob with the same digest.
+
+    If the content already exists on disk the new file is replaced by a hard
+    link to it, so identical uploads share one copy of the bytes. The blob's
+    ref_count is bumped in the caller's transaction.
+    """
+    digest = meta.get('sha256')
+    if not digest:
+        return None
+
+    path = os.path.join(upload_folder, meta['filename'])
+    blob = db.session.get(Blob, digest)
+    if blob and blob.filename != meta['filename']:
+        source = os.path.join(upload_folder, blob.filename)
+        if os.path.isfile(source):
+            _replace_with_link(source, path)
+        else:
+            # 链接源已丢失，改用这次上传的文件作为新的源
+            blob.filename = meta['filename']
+
+    stmt = sqlite_insert(Blob.__table__).values(
+        digest=digest,
+        filename=meta['filename'],
+        size=meta['size'],
+        ref_count=1,
+        created_at=utcnow(),
+    ).on_conflict_do_update(
+        index_elements=['digest'],
+        set_={'ref_count': Blob.__table__.c.ref_count + 1},
+    )
+    db.session.execute(stmt)
+    if blob:
+        db.session.expire(blob, ['ref_count'])
+    return digest
+
+
+# 每轮最多给这么多张旧图片补摘要；文件在事务外哈希，写锁每张只占用很短时间
+HASH_BACKFILL_BATCH = 100
+
+
+def backfill_content_hashes(upload_folder, after_id=0, limit=HASH_BACKFILL_BATCH):
+    """Record the digest of images stored before content hashing existed,
+    attaching each to the matching blob like a fresh upload would.
+
+    Walks image ids above after_id; returns (hashed, last_id), last_id being
+    None once no image without a digest is left. Images whose file is missing
+    are skipped, and rows hashed concurrently by another worker are left alone.
+    """
+    rows = db.session.query(Image.id, Image.filename)\
+        .filter(Image.id > after_id, Image.content_hash.is_(None))\
+        .order_by(Image.id)\
+        .limit(limit)\
+        .all()
+    db.session.commit()
+    hashed = 0
+    for image_id, filename in rows:
+        path = os.path.join(upload_folder, filename)
+        try:
+            meta = {'filename': filename, 'size': os.path.getsize(path), 'sha256': file_sha256(path)}
+        except OSError:
+            continue
+        # 先条件更新抢到这一行再登记 blob，其他 worker 同时补同一张时不会重复计数
+        result = db.session.execute(
+            update(Image)
+            .where(Image.id == image_id, Image.filename == filename, Image.content_hash.is_(None))
+            .values(content_hash=meta['sha256'])
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount:
+            register_upload(meta, upload_folder)
+            hashed += 1
+        db.session.commit()
+    if len(rows) < limit:
+        return hashed, None
+    return hashed, rows[-1][0]
+
+
+def release_upload(image, upload_folder=None):
+    """Drop the image's reference to its blob and unlink its file name.
+
+    Every image owns its own (possibly hard-linked) name, so the name is always
+    removed; the shared bytes are only freed by the filesystem once the last
+    reference is gone, and the blob row is deleted at the same point. While a
+    backup is packing uploads the name is queued in deferred_delete instead.
+    """
+    if image.content_hash:
+        # 相对 UPDATE 先拿到写锁再读回计数，并发删除同一内容的图片不会互相覆盖
+        db.session.execute(
+            update(Blob)
+            .where(Blob.digest == image.content_hash)
+            .values(ref_count=func.coalesce(Blob.ref_count, 1) - 1)
+            .execution_options(synchronize_session=False)
+        )
+        blob = db.session.get(Blob, image.content_hash, populate_existing=True)
+        if blob:
+            if blob.ref_count > 0 and blob.filename == image.filename:
+                other = db.session.query(Image.filename)\
+                    .filter(Image.content_hash == image.content_hash, Image.id != image.id)\
+                    .first()
+                if other:
+                    blob.filename = other[0]
+                else:
+                    # 计数与实际引用不一致，已没有其他图片引用
+                    blob.ref_count = 0
+            if blob.ref_count <= 0:
+                db.session.delete(blob)
+    if upload_files_pinned():
+        # 备份正在打包冻结的文件列表，原文件登记下来等打包结束再删
+        db.session.add(DeferredDelete(filename=image.filename))
+        remove_upload_files(image.filename, upload_folder, keep_original=True)
+    else:
+        remove_upload_files(image.filename, upload_folder)
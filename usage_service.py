@@ -0,0 +1,51 @@
+from sqlalchemy import func, select, update
+
+from extensions import db
+from models import Image, User
+
+
+# 旧库加列后 / 恢复旧备份后用于回填的 SQL，与 reconcile_usage 结果一致
+USAGE_BACKFILL_SQL = """
+    UPDATE user SET
+        used_bytes = COALESCE((SELECT SUM(size) FROM image WHERE image.user_id = user.id), 0),
+        image_count = (SELECT COUNT(*) FROM image WHERE image.user_id = user.id)
+"""
+
+
+def adjust_usage(user_id, bytes_delta, count_delta):
+    """Apply a usage delta in the caller's transaction. The UPDATE is relative,
+    so concurrent uploads by the same user cannot lose each other's bytes."""
+    db.session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(
+            used_bytes=User.used_bytes + bytes_delta,
+            image_count=User.image_count + count_delta,
+        )
+    )
+
+
+def charge_upload(image):
+    adjust_usage(image.user_id, image.size or 0, 1)
+
+
+def refund_upload(image):
+    adjust_usage(image.user_id, -(image.size or 0), -1)
+
+
+def reconcile_usage(user_id=None):
+    """Recompute used_bytes / image_count from the image table. Returns the
+    number of users whose counters were wrong."""
+    used = select(func.coalesce(func.sum(Image.size), 0))\
+        .where(Image.user_id == User.id).scalar_subquery()
+    count = select(func.count(Image.id))\
+        .where(Image.user_id == User.id).scalar_subquery()
+    stmt = update(User)\
+        .where((User.used_bytes != used) | (User.image_count != count))\
+        .values(used_bytes=used, image_count=count)\
+        .execution_options(synchronize_session=False)
+    if user_id is not None:
+        stmt = stmt.where(User.id == user_id)
+    result = db.session.execute(stmt)
+    db.session.commit()
+    return result.rowcount
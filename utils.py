@@ -1,12 +1,34 @@
+import hashlib
 import os
+import re
+import struct
+import time
 import uuid
-from PIL import Image, ImageDraw, ImageFont, ImageOps
+from contextlib import contextmanager
+from functools import lru_cache
+from PIL import Image, ImageDraw, ImageFont, ImageOps, features
 # Prevent DecompressionBombError for large images, but set a reasonable limit (e.g. 100M pixels)
 Image.MAX_IMAGE_PIXELS = 100_000_000
 from werkzeug.utils import secure_filename
 from flask import current_app
 from models import SystemConfig
 
+# 缩略图尺寸 (最长边像素)，以 WebP 存放在原图旁边: <stem>.t<size>.webp
+THUMBNAIL_SIZES = (256, 1024)
+THUMBNAIL_QUALITY = 80
+
+# /i/<filename>?w=&h=&fit=&fmt=&q= 动态变换参数
+TRANSFORM_MAX_DIMENSION = 4096
+# 宽高向上取整到 16 的倍数、质量取整到 5 的倍数，限制同一张图能派生出的组合数
+TRANSFORM_SIZE_STEP = 16
+TRANSFORM_QUALITY_STEP = 5
+TRANSFORM_FITS = ('contain', 'cover', 'fill')
+TRANSFORM_FORMATS = {'webp': 'WEBP', 'avif': 'AVIF', 'jpeg': 'JPEG', 'jpg': 'JPEG'}
+# 按 Accept 协商返回的预生成格式 (原图旁的 <stem>.v.<fmt>)，Pillow 不支持的格式自动跳过
+VARIANT_FORMATS = ('avif', 'webp')
+# 上传原图一律存为 <uuid hex>.<ext>；缩略图、格式副本和临时文件名都多带一段，不能当作原图
+UPLOAD_NAME_RE = re.compile(r'[0-9a-f]{32}\.[A-Za-z0-9]+')
+
 def validate_image_header(stream):
     header = stream.read(512)
     stream.seek(0)
@@ -23,48 +45,381 @@ def validate_image_header(stream):
         
     return format
 
-def add_watermark(image):
-    """Add text watermark to image if configured"""
-    text = SystemConfig.get('WATERMARK_TEXT')
-    if not text:
-        return image
-        
-    # Create watermark layer
-    txt_layer = Image.new('RGBA', image.size, (255,255,255,0))
-    d = ImageDraw.Draw(txt_layer)
-    
-    # Calculate font size (5% of height)
-    font_size = max(20, int(image.height * 0.05))
+INGEST_CHUNK_SIZE = 1024 * 1024
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(INGEST_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+@contextmanager
+def timed_stage(stages, name):
+    """Add the wall time of the with-block to stages[name] (seconds)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages[name] = stages.get(name, 0.0) + time.perf_counter() - start
+
+def ingest_stream(stream, upload_folder, max_bytes=0):
+    """Copy an upload stream into a temp file in the upload folder chunk by
+    chunk, hashing and size-checking as it goes. Aborts as soon as max_bytes
+    (0 = unlimited) is exceeded. Returns (temp_path, size, sha256, first_chunk)."""
+    temp_path = os.path.join(upload_folder, f".{uuid.uuid4().hex}.upload")
+    digest = hashlib.sha256()
+    size = 0
+    header = b''
+    try:
+        with open(temp_path, 'wb') as f:
+            while True:
+                chunk = stream.read(INGEST_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if not header:
+                    header = chunk
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise ValueError(f"File too large. Max {round(max_bytes / 1024 / 1024, 2)}MB")
+                digest.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return temp_path, size, digest.hexdigest(), header
+
+WATERMARK_MARGIN = 20
+# 渲染好的水印贴图按 (文字, 字号, 透明度) 缓存在进程内，超出后按 LRU 淘汰
+WATERMARK_SPRITE_CACHE_SIZE = 64
+
+@lru_cache(maxsize=16)
+def _watermark_font(font_size):
     try:
         # Use default font or custom if available
-        font = ImageFont.truetype("arial.ttf", font_size)
+        return ImageFont.truetype("arial.ttf", font_size)
     except IOError:
-        font = ImageFont.load_default()
+        return ImageFont.load_default()
 
-    # Calculate text position (bottom right with padding)
+@lru_cache(maxsize=WATERMARK_SPRITE_CACHE_SIZE)
+def _watermark_sprite(text, font_size, opacity):
+    """Render text once into an RGBA sprite the size of its glyph box.
+    Returns (sprite, (offset_x, offset_y), (text_w, text_h)); callers must not
+    modify the sprite, it is shared."""
+    font = _watermark_font(font_size)
+    probe = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
     try:
-        bbox = d.textbbox((0, 0), text, font=font)
-        text_w = bbox[2] - bbox[0]
-        text_h = bbox[3] - bbox[1]
+        left, top, right, bottom = probe.textbbox((0, 0), text, font=font)
     except AttributeError:
         # Fallback for older Pillow
-        text_w, text_h = d.textsize(text, font=font)
-        
-    x = image.width - text_w - 20
-    y = image.height - text_h - 20
-    
-    # Draw text
-    opacity = int(SystemConfig.get('WATERMARK_OPACITY', 128))
-    d.text((x, y), text, font=font, fill=(255, 255, 255, opacity))
-    
-    # Composite
-    if image.mode != 'RGBA':
-        image = image.convert('RGBA')
-    return Image.alpha_composite(image, txt_layer).convert('RGB')
+        right, bottom = probe.textsize(text, font=font)
+        left = top = 0
+    sprite = Image.new('RGBA', (max(1, right - left), max(1, bottom - top)), (255, 255, 255, 0))
+    ImageDraw.Draw(sprite).text((-left, -top), text, font=font, fill=(255, 255, 255, int(opacity)))
+    return sprite, (left, top), (right - left, bottom - top)
+
+def add_watermark(image, text=None, opacity=128):
+    """Add text watermark to image if configured.
+
+    Only the box under the text is composited; the rest of the image is left
+    untouched, so cost does not grow with the image size (apart from a mode
+    conversion for palette/greyscale/CMYK sources)."""
+    if not text:
+        return image
+
+    # Calculate font size (5% of height)
+    font_size = max(20, int(image.height * 0.05))
+    sprite, (off_x, off_y), (text_w, text_h) = _watermark_sprite(text, font_size, int(opacity))
+
+    # Text position: bottom right with padding
+    x = image.width - text_w - WATERMARK_MARGIN + off_x
+    y = image.height - text_h - WATERMARK_MARGIN + off_y
+    box = (max(x, 0), max(y, 0), min(x + sprite.width, image.width), min(y + sprite.height, image.height))
+    if box[0] >= box[2] or box[1] >= box[3]:
+        return image
+    if box != (x, y, x + sprite.width, y + sprite.height):
+        sprite = sprite.crop((box[0] - x, box[1] - y, box[2] - x, box[3] - y))
+
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if _has_alpha(image) else 'RGB')
+    region = image.crop(box).convert('RGBA')
+    region.alpha_composite(sprite)
+    image.paste(region if image.mode == 'RGBA' else region.convert('RGB'), box[:2])
+    return image
+
+def _has_alpha(img):
+    return img.mode in ('LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+
+def is_upload_name(filename):
+    """True if filename has the shape of a stored original (not a thumbnail,
+    format variant or temp file), so it may be used as a render source."""
+    return bool(filename) and UPLOAD_NAME_RE.fullmatch(filename) is not None
+
+def thumbnail_name(filename, size):
+    stem, _ = os.path.splitext(filename)
+    return f"{stem}.t{size}.webp"
+
+def variant_name(filename, fmt):
+    """Precomputed modern-format sibling of an upload: <stem>.v.<fmt>."""
+    stem, _ = os.path.splitext(filename)
+    return f"{stem}.v.{fmt}"
+
+def supported_variant_formats():
+    return [fmt for fmt in VARIANT_FORMATS if save_format_supported(TRANSFORM_FORMATS[fmt])]
+
+def render_variants(upload_folder, filename, formats, quality):
+    """Encode the upload into each of formats next to the original. Only
+    variants smaller than the original are kept. Returns the kept formats,
+    smallest first. Takes no Flask/DB state so it can run in the worker pool."""
+    source = os.path.join(upload_folder, filename)
+    original_size = os.path.getsize(source)
+    with Image.open(source) as src:
+        img = _thumbnail_source(decode_for_target(src))
+    kept = []
+    for fmt in formats:
+        path = os.path.join(upload_folder, variant_name(filename, fmt))
+        _save_atomic(img, path, format=TRANSFORM_FORMATS[fmt], quality=quality)
+        size = os.path.getsize(path)
+        if size < original_size:
+            kept.append((size, fmt))
+        else:
+            os.remove(path)
+    return [fmt for _, fmt in sorted(kept)]
+
+def thumbnail_urls(filename):
+    return {str(size): f"/t/{size}/{filename}" for size in THUMBNAIL_SIZES}
+
+# 缩小输出时，解码分辨率至少保留目标尺寸的这么多倍，再用 LANCZOS 缩到最终尺寸（同 Pillow thumbnail 的 reducing_gap）
+DECODE_REDUCING_GAP = 2.0
+EXIF_ORIENTATION_TAG = 0x0112
+_ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+def _orientation(img):
+    try:
+        return img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+    except Exception:
+        return 1
+
+def probe_image(img):
+    """(width, height, orientation) of an opened image as displayed after EXIF
+    rotation. Reads only the header, no pixel data is decoded."""
+    orientation = _orientation(img)
+    width, height = img.size
+    if orientation in (5, 6, 7, 8):
+        width, height = height, width
+    return width, height, orientation
+
+def decode_for_target(img, target=None):
+    """Decode an opened (not yet loaded) image for an output of target=(w, h)
+    display pixels, and apply its EXIF orientation.
+
+    JPEGs are decoded at a reduced DCT scale (draft), other formats are
+    box-reduced right after decoding, as long as at least DECODE_REDUCING_GAP
+    times the target is kept. target=None decodes at full size."""
+    width, height, orientation = probe_image(img)
+    if target:
+        need_w = max(1, int(target[0] * DECODE_REDUCING_GAP))
+        need_h = max(1, int(target[1] * DECODE_REDUCING_GAP))
+        if orientation in (5, 6, 7, 8):
+            need_w, need_h = need_h, need_w
+        if img.format == 'JPEG' and need_w < img.width and need_h < img.height:
+            img.draft(None, (need_w, need_h))
+        img.load()
+        factor = min(img.width // need_w, img.height // need_h)
+        # reduce 不支持调色板/1 位/16 位图，这些留给后面的 LANCZOS 缩放
+        if factor >= 2 and img.mode not in ('P', '1', 'I;16', 'I;16B', 'I;16L'):
+            img = img.reduce(factor)
+    method = _ORIENTATION_TRANSPOSE.get(orientation)
+    if method is not None:
+        img = img.transpose(method)
+    return img
+
+def fit_within(size, box):
+    """Size after scaling size=(w, h) down to fit box (None = unbounded side); never enlarges."""
+    width, height = size
+    scale = min(box[0] / width if box[0] else 1, box[1] / height if box[1] else 1, 1)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def _thumbnail_source(img):
+    # 动图只取第一帧；统一转成 WebP 支持的模式
+    if getattr(img, 'is_animated', False):
+        img.seek(0)
+    if img.mode in ('RGB', 'RGBA'):
+        return img.copy()
+    has_alpha = _has_alpha(img)
+    return img.convert('RGBA' if has_alpha else 'RGB')
+
+def _save_atomic(img, path, **params):
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        img.save(tmp_path, **params)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def generate_thumbnails(img, filename, upload_folder=None, sizes=THUMBNAIL_SIZES):
+    """Render WebP thumbnails for an already opened image. Largest size first,
+    smaller ones are downscaled from the previous result."""
+    upload_folder = upload_folder or current_app.config['UPLOAD_FOLDER']
+    thumb = _thumbnail_source(img)
+    paths = {}
+    for size in sorted(sizes, reverse=True):
+        thumb.thumbnail((size, size), Image.LANCZOS)
+        path = os.path.join(upload_folder, thumbnail_name(filename, size))
+        _save_atomic(thumb, path, format='WEBP', quality=THUMBNAIL_QUALITY, method=4)
+        paths[size] = path
+    return paths
+
+def ensure_thumbnail(filename, size):
+    """Return the thumbnail path for an upload, generating it on first use
+    (for images uploaded before thumbnails existed). None if the original is missing."""
+    if size not in THUMBNAIL_SIZES or not is_upload_name(filename):
+        return None
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    path = os.path.join(upload_folder, thumbnail_name(filename, size))
+    if os.path.isfile(path):
+        return path
+    source = os.path.join(upload_folder, filename)
+    if not os.path.isfile(source):
+        return None
+    with Image.open(source) as img:
+        # 只按缩略图需要的分辨率解码
+        target = fit_within(probe_image(img)[:2], (size, size))
+        generate_thumbnails(decode_for_target(img, target), filename, upload_folder, sizes=[size])
+    return path
+
+def save_format_supported(pil_format):
+    Image.init()
+    return pil_format in Image.SAVE
+
+def parse_transform(args, default_quality=80):
+    """Parse ?w=&h=&fit=&fmt=&q= into a normalized transform dict, with sizes
+    and quality quantized. Returns None when the request has no transform
+    parameters."""
+    if not any(k in args for k in ('w', 'h', 'fit', 'fmt', 'q')):
+        return None
+
+    def dimension(key):
+        value = args.get(key)
+        if value in (None, ''):
+            return None
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid {key}")
+        if value < 1 or value > TRANSFORM_MAX_DIMENSION:
+            raise ValueError(f"{key} must be between 1 and {TRANSFORM_MAX_DIMENSION}")
+        return min(-(-value // TRANSFORM_SIZE_STEP) * TRANSFORM_SIZE_STEP, TRANSFORM_MAX_DIMENSION)
+
+    width = dimension('w')
+    height = dimension('h')
+
+    fit = (args.get('fit') or 'contain').lower()
+    if fit not in TRANSFORM_FITS:
+        raise ValueError(f"fit must be one of: {', '.join(TRANSFORM_FITS)}")
+
+    fmt = (args.get('fmt') or 'webp').lower()
+    if fmt not in TRANSFORM_FORMATS:
+        raise ValueError("fmt must be one of: webp, avif, jpeg")
+    if fmt == 'jpg':
+        fmt = 'jpeg'
+    if fmt == 'avif' and not save_format_supported('AVIF'):
+        # 当前 Pillow 不支持 AVIF 编码时退回 WebP，保证外链仍可用
+        fmt = 'webp'
+
+    try:
+        quality = int(args.get('q') or default_quality)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid q")
+    quality = round(min(max(quality, 10), 95) / TRANSFORM_QUALITY_STEP) * TRANSFORM_QUALITY_STEP
+
+    return {'w': width, 'h': height, 'fit': fit, 'fmt': fmt, 'q': quality}
+
+def _transform_target(size, transform):
+    """Display size the transform needs from the source (None = full size)."""
+    width, height, fit = transform['w'], transform['h'], transform['fit']
+    if not (width or height):
+        return None
+    if fit == 'contain':
+        return fit_within(size, (width, height))
+    if fit == 'cover' and width and height:
+        scale = max(width / size[0], height / size[1])
+        return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+    if fit == 'fill' and width and height:
+        return width, height
+    # 只给了一边时按比例推出另一边
+    if width:
+        return width, max(1, round(size[1] * width / size[0]))
+    return max(1, round(size[0] * height / size[1])), height
+
+def render_transform(source_path, dest_path, transform):
+    """Resize/convert an upload according to a parse_transform() result.
+    Animated images are rendered from their first frame."""
+    width, height, fit = transform['w'], transform['h'], transform['fit']
+    pil_format = TRANSFORM_FORMATS[transform['fmt']]
+    with Image.open(source_path) as src:
+        if getattr(src, 'is_animated', False):
+            src.seek(0)
+        img = _thumbnail_source(decode_for_target(src, _transform_target(probe_image(src)[:2], transform)))
+
+    if fit == 'contain' and (width or height):
+        # contain: 等比缩放到框内，不放大
+        img.thumbnail((width or img.width, height or img.height), Image.LANCZOS)
+    elif width or height:
+        if not width:
+            width = max(1, round(img.width * height / img.height))
+        if not height:
+            height = max(1, round(img.height * width / img.width))
+        if fit == 'cover':
+            img = ImageOps.fit(img, (width, height), Image.LANCZOS)
+        else:
+            img = img.resize((width, height), Image.LANCZOS)
+
+    if pil_format == 'JPEG' and img.mode == 'RGBA':
+        # JPEG 没有透明通道，铺白底
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        img = background
+    _save_atomic(img, dest_path, format=pil_format, quality=transform['q'])
+    return dest_path
+
+def remove_upload_files(filename, upload_folder=None, keep_original=False):
+    """Delete an upload and its derivatives from disk. keep_original leaves
+    the upload itself in place (a running backup is still reading it)."""
+    upload_folder = upload_folder or current_app.config['UPLOAD_FOLDER']
+    names = [thumbnail_name(filename, size) for size in THUMBNAIL_SIZES]
+    names += [variant_name(filename, fmt) for fmt in VARIANT_FORMATS]
+    if not keep_original:
+        names.insert(0, filename)
+    for name in names:
+        try:
+            os.remove(os.path.join(upload_folder, name))
+        except FileNotFoundError:
+            # 可能已被另一个进程的回收线程删掉
+            pass
 
 def process_and_save_image(file_storage, user_id, user_quality=None, passthrough=False):
+    job = prepare_upload(file_storage, user_quality=user_quality, passthrough=passthrough)
+    return encode_prepared(job)
+
+def prepare_upload(file_storage, user_quality=None, passthrough=False):
+    """Validate and ingest one upload without encoding it. The returned job is
+    handed to encode_prepared / encode_prepared_batch, or discard_prepared."""
+    # 各阶段耗时 (秒)，随 meta['timing'] 返回并汇总到管理后台
+    stages = {}
     # 1. Validate Header
-    fmt = validate_image_header(file_storage.stream)
+    with timed_stage(stages, 'validate'):
+        fmt = validate_image_header(file_storage.stream)
     if not fmt:
         raise ValueError("Invalid image definition")
         
@@ -107,61 +462,59 @@ def process_and_save_image(file_storage, user_id, user_quality=None, passthrough
         max_mb = float(max_mb_str) if max_mb_str and max_mb_str != 'None' else 0
     except (ValueError, TypeError):
         max_mb = 0  # Default to unlimited if invalid
-        
-    file_storage.stream.seek(0, os.SEEK_END)
-    size = file_storage.stream.tell()
-    file_storage.stream.seek(0)
-    
-    if max_mb > 0 and size > max_mb * 1024 * 1024:
-        raise ValueError(f"File too large. Max {max_mb}MB")
 
-    # Generate unique filename
-    unique_name = f"{uuid.uuid4().hex}.{ext}"
-    save_path = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_name)
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+
+    # 分块写入临时文件，边写边算 sha256，超过大小上限立即中止
+    with timed_stage(stages, 'ingest'):
+        source_path, size, digest, _ = ingest_stream(
+            file_storage.stream, upload_folder, int(max_mb * 1024 * 1024) if max_mb > 0 else 0
+        )
+    try:
+        job = _plan_encode(source_path, fmt, ext, original_name, upload_folder, user_quality, passthrough)
+    except BaseException:
+        if os.path.exists(source_path):
+            os.remove(source_path)
+        raise
+    job['ingested_path'] = source_path
+    job['ingested_size'] = size
+    job['sha256'] = digest
+    job['fmt'] = fmt
+    job['stages'] = stages
+    return job
 
+def _plan_encode(source_path, fmt, ext, original_name, upload_folder, user_quality, passthrough):
     # ===== PASSTHROUGH MODE =====
     # Save raw bytes without any processing (preserves PNG metadata chunks for Tavern cards etc.)
     if passthrough:
-        with open(save_path, 'wb') as f:
-            f.write(file_storage.stream.read())
-        
-        # Get dimensions using Pillow (read-only, doesn't modify)
-        with Image.open(save_path) as img:
-            width, height = img.size
-        
-        return {
-            'filename': unique_name,
-            'original_name': original_name,
-            'size': size,
-            'width': width,
-            'height': height,
-            'mime_type': f"image/{ext}"
+        unique_name = f"{uuid.uuid4().hex}.{ext}"
+        save_path = os.path.join(upload_folder, unique_name)
+        os.replace(source_path, save_path)
+        options = {
+            'passthrough': True,
+            'upload_folder': upload_folder,
+            'save_name': unique_name,
+            'ext': ext,
         }
+        return {'source_path': save_path, 'options': options, 'original_name': original_name, 'cleanup': [save_path]}
 
     # ===== NORMAL PROCESSING MODE =====
-    # 2. Open Image
-    try:
-        img = Image.open(file_storage.stream)
-        # Fix orientation (EXIF) - also removes EXIF by default when saving new
-        img = ImageOps.exif_transpose(img) 
-    except Exception:
-        raise ValueError("Broken image file")
-
     # 3. Process (WebP Convert config)
-    original_fmt = img.format or (fmt.upper() if fmt else 'JPEG')
-    target_fmt = original_fmt
-    
+    target_fmt = fmt.upper()
     enable_webp = SystemConfig.get('ENABLE_WEBP_CONVERT', 'false') == 'true'
-    if enable_webp and fmt in ['jpeg', 'png']:
+    stem = uuid.uuid4().hex
+    # GIF 转码失败/不划算/超出动图上限时保留原始字节，用原扩展名
+    original_name_on_disk = f"{stem}.{ext}"
+    # 开启格式协商时保留 JPG/PNG 原图，WebP/AVIF 副本由后台生成
+    variants = SystemConfig.get('ENABLE_FORMAT_VARIANTS', 'false') == 'true' and fmt in ['jpeg', 'png']
+    if enable_webp and fmt in ['jpeg', 'png'] and not variants:
         target_fmt = 'WEBP'
         ext = 'webp'
-        # Update filename with new extension
-        unique_name = f"{uuid.uuid4().hex}.{ext}"
-        save_path = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_name)
-    
-    # 4. Watermark (Skip for GIF)
-    if fmt != 'gif':
-        img = add_watermark(img)
+    elif fmt == 'gif' and SystemConfig.get('ENABLE_GIF_WEBP_CONVERT', 'false') == 'true' \
+            and features.check('webp_anim'):
+        target_fmt = 'WEBP'
+        ext = 'webp'
+    unique_name = f"{stem}.{ext}"
 
     # Compress Quality: admin limit from config, user can choose up to that limit
     admin_quality_str = SystemConfig.get('compress_quality')
@@ -175,25 +528,291 @@ def process_and_save_image(file_storage, user_id, user_quality=None, passthrough
         quality = min(max(int(user_quality), 10), admin_quality)
     else:
         quality = admin_quality
-    
+
+    options = {
+        'passthrough': False,
+        'upload_folder': upload_folder,
+        'save_name': unique_name,
+        'ext': ext,
+        'fmt': fmt,
+        'target_fmt': target_fmt,
+        'quality': quality,
+        'watermark_text': SystemConfig.get('WATERMARK_TEXT'),
+        'watermark_opacity': SystemConfig.get('WATERMARK_OPACITY', 128, type_func=int),
+        'original_save_name': original_name_on_disk,
+        'variants': variants,
+        'animation_max_pixels': current_app.config.get('ANIMATION_MAX_PIXELS', 0),
+    }
+    cleanup = [os.path.join(upload_folder, unique_name)]
+    if original_name_on_disk != unique_name:
+        cleanup.append(os.path.join(upload_folder, original_name_on_disk))
+    return {'source_path': source_path, 'options': options, 'original_name': original_name, 'cleanup': cleanup}
+
+def _remove_job_outputs(job):
+    for path in job['cleanup']:
+        try:
+            remove_upload_files(os.path.basename(path), os.path.dirname(path))
+        except OSError:
+            pass
+
+def _drop_ingested(job):
+    if os.path.exists(job['ingested_path']):
+        os.remove(job['ingested_path'])
+
+def discard_prepared(job):
+    """Throw away a prepared upload that will not be encoded."""
+    _drop_ingested(job)
+    _remove_job_outputs(job)
+
+def _upload_timing(job, meta, waited):
+    """Per-stage durations (ms), pixel count and byte sizes of one upload.
+    waited is the wall time the request spent on the worker pool; what the
+    worker did not account for is reported as the 'pool' stage (queue + IPC)."""
+    worker_stages = meta.pop('stages', {})
+    stages = dict(job['stages'])
+    stages.update(worker_stages)
+    stages['pool'] = max(0.0, waited - sum(worker_stages.values()))
+    output = 'passthrough' if job['options']['passthrough'] else os.path.splitext(meta['filename'])[1].lstrip('.')
+    return {
+        'format': f"{job['fmt']}->{output}",
+        'stages': {name: round(value * 1000, 2) for name, value in stages.items()},
+        'total_ms': round(sum(stages.values()) * 1000, 2),
+        'pixels': (meta.get('width') or 0) * (meta.get('height') or 0) * meta.pop('frames', 1),
+        'input_bytes': job['ingested_size'],
+        'output_bytes': meta.get('size'),
+    }
+
+def _finish_meta(job, meta, waited=0.0):
+    from metrics_service import record_upload_timing
+
+    if meta.pop('thumbnail_error', None):
+        # 缩略图失败不影响上传，/t/ 路由会在首次访问时补生成
+        current_app.logger.warning(f"Thumbnail generation failed for {meta['filename']}")
+    meta['original_name'] = job['original_name']
+    # 透传模式下磁盘文件就是上传的原始字节；处理模式由 encode_upload 给出编码后的摘要
+    meta.setdefault('sha256', job['sha256'])
+    meta['timing'] = _upload_timing(job, meta, waited)
+    record_upload_timing(meta['timing'])
+    return meta
+
+def encode_prepared(job):
+    from worker_pool import run_image_job
+
+    start = time.perf_counter()
+    try:
+        meta = run_image_job(
+            current_app, encode_upload, job['source_path'], job['options'],
+            on_abandoned=lambda: _remove_job_outputs(job),
+        )
+    except Exception:
+        _remove_job_outputs(job)
+        raise
+    finally:
+        _drop_ingested(job)
+    return _finish_meta(job, meta, time.perf_counter() - start)
+
+def encode_prepared_batch(jobs):
+    """Encode many prepared uploads at once across the image worker pool.
+    Returns one meta dict or exception per job, in order."""
+    from worker_pool import run_image_jobs
+
+    start = time.perf_counter()
+    finished_at = []
+    try:
+        results = run_image_jobs(
+            current_app, encode_upload,
+            [(job['source_path'], job['options']) for job in jobs],
+            on_abandoned=[(lambda job=job: _remove_job_outputs(job)) for job in jobs],
+            finished_at=finished_at,
+        )
+    finally:
+        for job in jobs:
+            _drop_ingested(job)
+    out = []
+    for job, result, finished in zip(jobs, results, finished_at):
+        if isinstance(result, BaseException):
+            _remove_job_outputs(job)
+            out.append(result)
+        else:
+            # 每个任务只算到它自己完成为止，不把整批的耗时记到每一张上
+            out.append(_finish_meta(job, result, (finished or time.perf_counter()) - start))
+    return out
+
+def encode_upload(source_path, options):
+    """CPU-heavy half of the upload pipeline: decode, watermark, re-encode and
+    render thumbnails. Takes no Flask/DB state so it can run in the worker pool."""
+    upload_folder = options['upload_folder']
+    unique_name = options['save_name']
+    save_path = os.path.join(upload_folder, unique_name)
+    ext = options['ext']
+    stages = {}
+    result = {'filename': unique_name, 'mime_type': f"image/{ext}", 'stages': stages}
+
+    if options['passthrough']:
+        return _describe_original(save_path, result)
+
+    fmt = options['fmt']
     if fmt == 'gif':
-        # Save GIF frames
-        img.save(save_path, save_all=True, optimize=True)
-    else:
-        # Save static
+        return _encode_gif(source_path, options, result)
+
+    # 2. Open Image
+    try:
+        with timed_stage(stages, 'decode'):
+            img = Image.open(source_path)
+            img.load()
+        # Fix orientation (EXIF) - also removes EXIF by default when saving new
+        with timed_stage(stages, 'orient'):
+            img = ImageOps.exif_transpose(img)
+    except Exception:
+        raise ValueError("Broken image file")
+
+    # 4. Watermark
+    with timed_stage(stages, 'watermark'):
+        img = add_watermark(img, options.get('watermark_text'), options.get('watermark_opacity', 128))
+
+    # 先写临时文件再原子替换，失败时不会留下半截图片
+    target_fmt = options['target_fmt']
+    with timed_stage(stages, 'encode'):
         if img.mode == 'RGBA' and target_fmt == 'JPEG':
             img = img.convert('RGB')
-        img.save(save_path, format=target_fmt, quality=quality, optimize=True)
+        _save_atomic(img, save_path, format=target_fmt, quality=options['quality'], optimize=True)
 
     # Get Stats
-    file_size = os.path.getsize(save_path)
-    width, height = img.size
-    
-    return {
-        'filename': unique_name,
-        'original_name': original_name,
-        'size': file_size,
-        'width': width,
-        'height': height,
-        'mime_type': f"image/{ext}"
-    }
+    result['size'] = os.path.getsize(save_path)
+    with timed_stage(stages, 'hash'):
+        result['sha256'] = file_sha256(save_path)
+    result['width'], result['height'] = img.size
+    with timed_stage(stages, 'thumbnails'):
+        result['thumbnail_error'] = not _try_thumbnails(img, unique_name, upload_folder)
+    if options.get('variants'):
+        # 空字符串 = 等待后台生成副本
+        result['variants'] = ''
+    return result
+
+def _describe_original(path, result):
+    """Metadata and thumbnails for a file stored with its uploaded bytes.
+    Dimensions come from the header; thumbnails decode only what they need."""
+    upload_folder, filename = os.path.split(path)
+    with Image.open(path) as img:
+        width, height, _ = probe_image(img)
+        result['width'], result['height'] = width, height
+        try:
+            if getattr(img, 'is_animated', False):
+                img.seek(0)
+            with timed_stage(result['stages'], 'decode'):
+                thumb_src = decode_for_target(img, fit_within((width, height), (max(THUMBNAIL_SIZES),) * 2))
+            with timed_stage(result['stages'], 'thumbnails'):
+                result['thumbnail_error'] = not _try_thumbnails(thumb_src, filename, upload_folder)
+        except Exception:
+            result['thumbnail_error'] = True
+    result['size'] = os.path.getsize(path)
+    return result
+
+def gif_frame_info(path):
+    """Walk the GIF block structure without decoding any pixels.
+    Returns (width, height, frame_durations_ms), or None if the file is malformed."""
+    durations = []
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(13)
+            if header[:6] not in (b'GIF87a', b'GIF89a') or len(header) < 13:
+                return None
+            width, height, packed = struct.unpack('<HHB', header[6:11])
+            if packed & 0x80:
+                f.seek(3 << ((packed & 7) + 1), os.SEEK_CUR)
+            delay = 0
+            while True:
+                block = f.read(1)
+                if not block or block == b'\x3b':
+                    break
+                if block == b'\x21':
+                    label = f.read(1)
+                    if label == b'\xf9':
+                        ext = f.read(6)
+                        delay = struct.unpack('<H', ext[2:4])[0] * 10
+                        if ext[5:6] != b'\x00':
+                            return None
+                    else:
+                        _skip_sub_blocks(f)
+                elif block == b'\x2c':
+                    desc = f.read(9)
+                    if len(desc) < 9:
+                        return None
+                    if desc[8] & 0x80:
+                        f.seek(3 << ((desc[8] & 7) + 1), os.SEEK_CUR)
+                    f.read(1)  # LZW minimum code size
+                    _skip_sub_blocks(f)
+                    # 与浏览器一致：不超过 10ms 的帧间隔按 100ms 播放
+                    durations.append(delay if delay > 10 else 100)
+                    delay = 0
+                else:
+                    return None
+    except (OSError, struct.error):
+        return None
+    return (width, height, durations) if durations else None
+
+def _skip_sub_blocks(f):
+    while True:
+        size = f.read(1)
+        if not size or size == b'\x00':
+            return
+        f.seek(size[0], os.SEEK_CUR)
+
+def _keep_original_gif(source_path, options, result):
+    keep_path = os.path.join(options['upload_folder'], options['original_save_name'])
+    os.replace(source_path, keep_path)
+    result['filename'] = options['original_save_name']
+    result['mime_type'] = 'image/gif'
+    # 字节与上传一致，sha256 由调用方用上传时算好的摘要补上
+    result.pop('sha256', None)
+    return _describe_original(keep_path, result)
+
+def _encode_gif(source_path, options, result):
+    """GIF uploads: transcode to animated WebP (ENABLE_GIF_WEBP_CONVERT) or
+    re-encode as GIF. Pillow's animated encoders seek through the frames and
+    hold one decoded frame at a time. Animations over animation_max_pixels
+    (frames x area), and WebP results that are not smaller than the upload,
+    keep the uploaded bytes instead."""
+    save_path = os.path.join(options['upload_folder'], options['save_name'])
+    info = gif_frame_info(source_path)
+    if info:
+        width, height, durations = info
+        result['frames'] = len(durations)
+        limit = options.get('animation_max_pixels') or 0
+        if limit and len(durations) * width * height > limit:
+            return _keep_original_gif(source_path, options, result)
+
+    try:
+        img = Image.open(source_path)
+    except Exception:
+        raise ValueError("Broken image file")
+    with img:
+        if options['target_fmt'] == 'WEBP':
+            params = {'loop': img.info.get('loop', 0)}
+            if info and len(info[2]) == getattr(img, 'n_frames', 1):
+                # Pillow 只会沿用第一帧的 duration，逐帧间隔从文件头里取
+                params['duration'] = info[2]
+            # 动图逐帧解码与编码交织进行，整体计入 encode
+            with timed_stage(result['stages'], 'encode'):
+                _save_atomic(img, save_path, format='WEBP', save_all=True, quality=options['quality'],
+                             allow_mixed=True, method=4, **params)
+            if os.path.getsize(save_path) >= os.path.getsize(source_path):
+                os.remove(save_path)
+                return _keep_original_gif(source_path, options, result)
+        else:
+            with timed_stage(result['stages'], 'encode'):
+                _save_atomic(img, save_path, format='GIF', save_all=True, optimize=True)
+        result['width'], result['height'] = img.size
+        with timed_stage(result['stages'], 'thumbnails'):
+            result['thumbnail_error'] = not _try_thumbnails(img, options['save_name'], options['upload_folder'])
+    result['size'] = os.path.getsize(save_path)
+    with timed_stage(result['stages'], 'hash'):
+        result['sha256'] = file_sha256(save_path)
+    return result
+
+def _try_thumbnails(img, filename, upload_folder):
+    try:
+        generate_thumbnails(img, filename, upload_folder)
+        return True
+    except Exception:
+        return False
@@ -0,0 +1,157 @@
+import os
+import threading
+
+from sqlalchemy import update
+
+from backup_service import current_maintenance
+from extensions import db
+from models import Image, SystemConfig
+from utils import render_variants, supported_variant_formats, variant_name
+from worker_pool import run_image_job
+
+
+# 排队中的图片每次最多取这么多张，剩下的下一轮再处理
+VARIANT_SWEEP_BATCH = 200
+
+_variant_lock = threading.Lock()
+_variant_started = False
+_variant_wakeup = threading.Event()
+_queue_lock = threading.Lock()
+_queued_ids = set()
+# 外链发现副本文件丢失的图片：由后台线程确认后把 variants 改回 '' 再重新渲染
+_repair_ids = set()
+
+
+def queue_variants(image_ids):
+    """Ask this process's variant thread to render the WebP/AVIF siblings of
+    the given images (rows with variants = '')."""
+    image_ids = [i for i in image_ids if i is not None]
+    if not image_ids:
+        return
+    with _queue_lock:
+        _queued_ids.update(image_ids)
+    _variant_wakeup.set()
+
+
+def queue_variant_repair(image_id):
+    """Report an image whose recorded variant file is missing. The serving
+    path only remembers the id; the variant thread resets and re-renders it."""
+    if image_id is None:
+        return
+    with _queue_lock:
+        _repair_ids.add(image_id)
+    _variant_wakeup.set()
+
+
+def _reset_missing(app, image_ids):
+    """Mark images whose recorded variants are missing on disk as pending
+    again. Returns the ids that were reset."""
+    upload_folder = app.config['UPLOAD_FOLDER']
+    reset = []
+    for image in db.session.query(Image).filter(Image.id.in_(image_ids)):
+        if image.variants in (None, '', 'none'):
+            continue
+        if all(os.path.isfile(os.path.join(upload_folder, variant_name(image.filename, fmt)))
+               for fmt in image.variants.split(',')):
+            continue
+        image.variants = ''
+        reset.append(image.id)
+    db.session.commit()
+    return reset
+
+
+def _render_one(app, image_id, formats, quality):
+    image = db.session.get(Image, image_id)
+    if image is None or image.variants != '':
+        return False
+    filename = image.filename
+    upload_folder = app.config['UPLOAD_FOLDER']
+    if not os.path.isfile(os.path.join(upload_folder, filename)):
+        ready = 'none'
+    else:
+        ready = ','.join(run_image_job(app, render_variants, upload_folder, filename, formats, quality)) or 'none'
+    result = db.session.execute(
+        update(Image)
+        .where(Image.id == image_id, Image.filename == filename, Image.variants == '')
+        .values(variants=ready)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    if result.rowcount == 0:
+        # 渲染期间图片被删除，副本没人引用了
+        for fmt in formats:
+            try:
+                os.remove(os.path.join(upload_folder, variant_name(filename, fmt)))
+            except FileNotFoundError:
+                pass
+    return True
+
+
+def render_pending(app, sweep=False):
+    """One pass of the variant thread: render queued images, plus every
+    pending row in the database when sweep is set. Returns the number rendered."""
+    with app.app_context():
+        try:
+            # 恢复期间数据库和上传目录正在被替换，等维护结束再处理
+            if current_maintenance():
+                return 0
+            with _queue_lock:
+                image_ids = set(_queued_ids)
+                _queued_ids.clear()
+                repair_ids = set(_repair_ids)
+                _repair_ids.clear()
+            if repair_ids:
+                image_ids.update(_reset_missing(app, sorted(repair_ids)))
+            if sweep:
+                rows = db.session.query(Image.id).filter(Image.variants == '')\
+                    .order_by(Image.id).limit(VARIANT_SWEEP_BATCH)
+                image_ids.update(i for (i,) in rows)
+            formats = supported_variant_formats()
+            quality = SystemConfig.get('compress_quality', 80, type_func=int)
+            rendered = 0
+            for image_id in sorted(image_ids):
+                try:
+                    rendered += _render_one(app, image_id, formats, quality)
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception(f"Rendering variants of image {image_id} failed")
+                    db.session.execute(
+                        update(Image)
+                        .where(Image.id == image_id, Image.variants == '')
+                        .values(variants='none')
+                        .execution_options(synchronize_session=False)
+                    )
+                    db.session.commit()
+            return rendered
+        finally:
+            db.session.remove()
+
+
+def _variant_loop(app, interval):
+    sweep = True
+    while True:
+        try:
+            rendered = render_pending(app, sweep=sweep)
+            # 一轮扫满说明还有积压，下一轮继续扫
+            sweep = sweep and rendered >= VARIANT_SWEEP_BATCH
+        except Exception:
+            sweep = False
+            with app.app_context():
+                app.logger.exception("Variant worker failed")
+        if not sweep:
+            _variant_wakeup.wait(interval)
+            _variant_wakeup.clear()
+
+
+def start_variant_worker(app):
+    """Background thread that renders the WebP/AVIF siblings served by Accept
+    negotiation. Uploads wake it after commit; its first pass sweeps rows left
+    pending by a restart or by another worker process."""
+    global _variant_started
+    with _variant_lock:
+        if _variant_started:
+            return
+        _variant_started = True
+        interval = app.config.get("FILE_RECLAIM_INTERVAL", 60)
+        thread = threading.Thread(target=_variant_loop, args=(app, interval), daemon=True)
+        thread.start()
@@ -0,0 +1,156 @@
+import atexit
+import math
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from concurrent.futures.process import BrokenProcessPool
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_pending = 0
+
+
+class ImageJobTimeout(RuntimeError):
+    pass
+
+
+def _get_pool(app):
+    """每个 gunicorn worker 在第一次使用时创建自己的进程池（fork 之后才创建）。"""
+    global _pool
+    workers = app.config.get("IMAGE_WORKERS", 0)
+    if workers <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            # spawn: 池子由带后台线程的 web 进程创建，避免 fork 继承线程持有的锁
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            atexit.register(shutdown_pool)
+        return _pool
+
+
+def _reset_pool(broken):
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def pending_jobs():
+    return _pending
+
+
+def run_image_job(app, fn, *args, on_abandoned=None):
+    """Run fn(*args) in the image worker pool and wait for it, bounded by
+    IMAGE_WORKER_TIMEOUT. Falls back to running inline when the pool is
+    disabled (IMAGE_WORKERS=0) or has crashed. on_abandoned() is called once a
+    timed-out job finally finishes, so its output can be cleaned up."""
+    global _pending
+    pool = _get_pool(app)
+    if pool is None:
+        return fn(*args)
+
+    timeout = app.config.get("IMAGE_WORKER_TIMEOUT", 120)
+    with _pool_lock:
+        _pending += 1
+    try:
+        try:
+            future = pool.submit(fn, *args)
+        except BrokenProcessPool:
+            _reset_pool(pool)
+            app.logger.warning("Image worker pool was broken, processing inline")
+            return fn(*args)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            if not future.cancel() and on_abandoned:
+                future.add_done_callback(lambda _: on_abandoned())
+            raise ImageJobTimeout(f"Image processing timed out after {timeout}s")
+        except BrokenProcessPool:
+            _reset_pool(pool)
+            raise RuntimeError("Image worker crashed")
+    finally:
+        with _pool_lock:
+            _pending -= 1
+
+
+def run_image_jobs(app, fn, args_list, on_abandoned=None, finished_at=None):
+    """Run fn(*args) for every args tuple concurrently in the image worker
+    pool. Returns one result or exception per job, in order; a failing job
+    does not affect the others. The whole batch gets IMAGE_WORKER_TIMEOUT
+    for each round of jobs the pool has to run.
+
+    If finished_at is a list, it receives the time.perf_counter() at which
+    each job completed (None for jobs that timed out)."""
+    global _pending
+    on_abandoned = on_abandoned or [None] * len(args_list)
+    if finished_at is not None:
+        finished_at[:] = [None] * len(args_list)
+    pool = _get_pool(app)
+    if pool is None:
+        return _run_inline(fn, args_list, finished_at)
+
+    timeout = app.config.get("IMAGE_WORKER_TIMEOUT", 120)
+    rounds = math.ceil(len(args_list) / max(app.config.get("IMAGE_WORKERS", 1), 1))
+    with _pool_lock:
+        _pending += len(args_list)
+    try:
+        try:
+            futures = [pool.submit(fn, *args) for args in args_list]
+        except BrokenProcessPool:
+            _reset_pool(pool)
+            app.logger.warning("Image worker pool was broken, processing batch inline")
+            return _run_inline(fn, args_list, finished_at)
+        if finished_at is not None:
+            # 完成回调里记时间戳，批量里每个任务各自的等待时间才准确
+            for index, future in enumerate(futures):
+                future.add_done_callback(lambda _, i=index: finished_at.__setitem__(i, time.perf_counter()))
+        wait(futures, timeout=timeout * rounds)
+
+        results = []
+        broken = False
+        for future, abandoned in zip(futures, on_abandoned):
+            if not future.done():
+                if not future.cancel() and abandoned:
+                    future.add_done_callback(lambda _, cb=abandoned: cb())
+                results.append(ImageJobTimeout(f"Image processing timed out after {timeout * rounds}s"))
+                continue
+            try:
+                results.append(future.result())
+            except BrokenProcessPool:
+                broken = True
+                results.append(RuntimeError("Image worker crashed"))
+            except Exception as exc:
+                results.append(exc)
+        if broken:
+            _reset_pool(pool)
+        return results
+    finally:
+        with _pool_lock:
+            _pending -= len(args_list)
+
+
+def _run_inline(fn, args_list, finished_at=None):
+    results = []
+    for index, args in enumerate(args_list):
+        results.append(_call_inline(fn, args))
+        if finished_at is not None:
+            finished_at[index] = time.perf_counter()
+    return results
+
+
+def _call_inline(fn, args):
+    try:
+        return fn(*args)
+    except Exception as exc:
+        return exc